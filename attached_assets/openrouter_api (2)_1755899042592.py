@@ -1,11 +1,55 @@
 import os
+import re
 import json
+import time
+import random
+import asyncio
 import logging
-import requests
+import datetime
+import email.utils
+import hashlib
+import threading
+import collections
+import concurrent.futures
+import importlib
+import importlib.util
+import socket
+import unicodedata
 import urllib.parse
-from bs4 import BeautifulSoup
+import weakref
+import zlib
 from dotenv import load_dotenv
 
+class _LazyModule:
+    """
+    Moduł importowany dopiero przy pierwszym odczycie atrybutu - ciężkie zależności
+    (requests, httpx) nie spowalniają importu openrouter_api ani zimnego startu workerów.
+    """
+
+    def __init__(self, name, *submodules):
+        self._name = name
+        self._submodules = submodules
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            module = importlib.import_module(self._name)
+            for submodule in self._submodules:
+                importlib.import_module(f"{self._name}.{submodule}")
+            self._module = module
+        return getattr(self._module, attr)
+
+requests = _LazyModule("requests", "adapters")
+sqlite3 = _LazyModule("sqlite3")
+
+# httpx jest wymagany tylko przez API asynchroniczne i transport HTTP/2
+httpx = _LazyModule("httpx") if importlib.util.find_spec("httpx") is not None else None
+
+try:
+    import orjson
+except ImportError:  # opcjonalny szybszy kodek JSON - bez niego używany jest moduł json
+    orjson = None
+
 # Load environment variables from .env file with override
 load_dotenv(override=True)
 
@@ -15,24 +59,30 @@ logger = logging.getLogger(__name__)
 OPENROUTER_API_KEY = os.environ.get("OPENROUTER_API_KEY", "").strip()
 
 # Validate API key format and content
-def validate_api_key():
-    if not OPENROUTER_API_KEY:
-        logger.error("❌ OPENROUTER_API_KEY nie jest ustawiony w pliku .env")
+def validate_api_key(api_key=None, name="OPENROUTER_API_KEY"):
+    api_key = OPENROUTER_API_KEY if api_key is None else api_key.strip()
+
+    if not api_key:
+        logger.error(f"❌ {name} nie jest ustawiony w pliku .env")
         return False
 
-    if OPENROUTER_API_KEY.startswith('TWÓJ_') or len(OPENROUTER_API_KEY) < 20:
-        logger.error("❌ OPENROUTER_API_KEY w .env zawiera przykładową wartość - ustaw prawdziwy klucz!")
+    if api_key.startswith('TWÓJ_') or len(api_key) < 20:
+        logger.error(f"❌ {name} w .env zawiera przykładową wartość - ustaw prawdziwy klucz!")
         return False
 
-    if not OPENROUTER_API_KEY.startswith('sk-or-v1-'):
-        logger.error("❌ OPENROUTER_API_KEY nie ma poprawnego formatu (powinien zaczynać się od 'sk-or-v1-')")
+    if not api_key.startswith('sk-or-v1-'):
+        logger.error(f"❌ {name} nie ma poprawnego formatu (powinien zaczynać się od 'sk-or-v1-')")
         return False
 
-    logger.info(f"✅ OpenRouter API key załadowany poprawnie (długość: {len(OPENROUTER_API_KEY)})")
+    logger.info(f"✅ OpenRouter API key załadowany poprawnie (długość: {len(api_key)})")
     return True
 
-# Validate on module import
-API_KEY_VALID = validate_api_key()
+def __getattr__(name):
+    # Klucz jest walidowany przy pierwszym odczycie API_KEY_VALID, a nie przy imporcie modułu
+    if name == "API_KEY_VALID":
+        value = globals()["API_KEY_VALID"] = validate_api_key()
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1/chat/completions"
 MODEL = "qwen/qwen-2.5-72b-instruct:free"
@@ -86,28 +136,2353 @@ headers = {
     "HTTP-Referer": "https://cv-optimizer-pro.repl.co/"
 }
 
-def send_api_request(prompt, max_tokens=2000, language='pl', user_tier='free', task_type='default', industry='general'):
+# KONFIGURACJA PULI POŁĄCZEŃ HTTP (keep-alive)
+HTTP_POOL_CONNECTIONS = int(os.environ.get("OPENROUTER_POOL_CONNECTIONS", "10"))
+HTTP_POOL_MAXSIZE = int(os.environ.get("OPENROUTER_POOL_MAXSIZE", "20"))
+# Transport zapytań: "http1" (requests + pula keep-alive) lub "http2" (httpx, multipleksacja na jednym połączeniu)
+HTTP_TRANSPORT = os.environ.get("OPENROUTER_HTTP_TRANSPORT", "http1").strip().lower()
+
+# TIMEOUTY I PONAWIANIE ZAPYTAŃ
+CONNECT_TIMEOUT = float(os.environ.get("OPENROUTER_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.environ.get("OPENROUTER_READ_TIMEOUT", "90"))
+JOB_FETCH_TIMEOUT = float(os.environ.get("JOB_FETCH_TIMEOUT", "15"))
+MAX_RETRIES = int(os.environ.get("OPENROUTER_MAX_RETRIES", "3"))
+RETRY_BACKOFF_BASE = float(os.environ.get("OPENROUTER_RETRY_BACKOFF_BASE", "1.0"))
+RETRY_BACKOFF_MAX = float(os.environ.get("OPENROUTER_RETRY_BACKOFF_MAX", "30"))
+
+# CIRCUIT BREAKER (osobny dla każdego modelu i endpointu)
+CIRCUIT_WINDOW_SECONDS = float(os.environ.get("OPENROUTER_CIRCUIT_WINDOW_SECONDS", "60"))
+CIRCUIT_MIN_CALLS = int(os.environ.get("OPENROUTER_CIRCUIT_MIN_CALLS", "10"))
+CIRCUIT_FAILURE_RATE = float(os.environ.get("OPENROUTER_CIRCUIT_FAILURE_RATE", "0.5"))
+CIRCUIT_SLOW_CALL_SECONDS = float(os.environ.get("OPENROUTER_CIRCUIT_SLOW_CALL_SECONDS", "45"))
+CIRCUIT_SLOW_CALL_RATE = float(os.environ.get("OPENROUTER_CIRCUIT_SLOW_CALL_RATE", "0.8"))
+CIRCUIT_OPEN_SECONDS = float(os.environ.get("OPENROUTER_CIRCUIT_OPEN_SECONDS", "30"))
+CIRCUIT_HALF_OPEN_PROBES = int(os.environ.get("OPENROUTER_CIRCUIT_HALF_OPEN_PROBES", "1"))
+
+# LIMITY PO STRONIE KLIENTA (0 wyłącza dany limit)
+RATE_LIMIT_REQUESTS_PER_MINUTE = float(os.environ.get("OPENROUTER_REQUESTS_PER_MINUTE", "20"))
+RATE_LIMIT_TOKENS_PER_MINUTE = float(os.environ.get("OPENROUTER_TOKENS_PER_MINUTE", "100000"))
+# Szacunkowa liczba znaków na token dla tekstów polskich
+CHARS_PER_TOKEN = 3.5
+
+# PULA KLUCZY API - czas wycofania klucza po 429 (bez Retry-After) oraz po 401/403
+KEY_RATE_LIMIT_COOLDOWN = float(os.environ.get("OPENROUTER_KEY_RATE_LIMIT_COOLDOWN", "60"))
+KEY_AUTH_COOLDOWN = float(os.environ.get("OPENROUTER_KEY_AUTH_COOLDOWN", "600"))
+
+# ADAPTACYJNY LIMIT WSPÓŁBIEŻNOŚCI (AIMD) - wspólny dla całego procesu
+CONCURRENCY_INITIAL_LIMIT = float(os.environ.get("OPENROUTER_CONCURRENCY_INITIAL", "8"))
+CONCURRENCY_MIN_LIMIT = float(os.environ.get("OPENROUTER_CONCURRENCY_MIN", "1"))
+CONCURRENCY_MAX_LIMIT = float(os.environ.get("OPENROUTER_CONCURRENCY_MAX", "64"))
+CONCURRENCY_BACKOFF_RATIO = float(os.environ.get("OPENROUTER_CONCURRENCY_BACKOFF", "0.7"))
+CONCURRENCY_LATENCY_SPIKE = float(os.environ.get("OPENROUTER_CONCURRENCY_LATENCY_SPIKE", "3.0"))
+
+# HEDGING - zapytania zabezpieczające przy wolnych replikach upstream (opt-in)
+HEDGE_PERCENTILE = float(os.environ.get("OPENROUTER_HEDGE_PERCENTILE", "0.95"))
+HEDGE_MIN_DELAY = float(os.environ.get("OPENROUTER_HEDGE_MIN_DELAY", "1.0"))
+HEDGE_BUDGET = float(os.environ.get("OPENROUTER_HEDGE_BUDGET", "0.1"))
+HEDGE_MIN_SAMPLES = int(os.environ.get("OPENROUTER_HEDGE_MIN_SAMPLES", "20"))
+HEDGE_ALTERNATE_MODEL = os.environ.get("OPENROUTER_HEDGE_MODEL") or None
+# Zapytanie główne i zabezpieczające działają w puli wątków - po dwa wątki na każde miejsce w limicie
+# współbieżności, żeby przy pełnym limicie hedge nie czekał w kolejce za zapytaniami głównymi
+HEDGE_MAX_WORKERS = int(os.environ.get("OPENROUTER_HEDGE_MAX_WORKERS", str(int(CONCURRENCY_MAX_LIMIT * 2))))
+
+# KOLEJKA DOPUSZCZEŃ - ile wywołań może czekać na miejsce w limicie współbieżności i jak długo (0 = bez kolejki).
+# Oczekiwanie na limit RPM/TPM po przydzieleniu miejsca ogranicza tylko rate_limit_wait i deadline.
+# Przy przepełnieniu najpierw odrzucane są zadania o niskim priorytecie,
+# np. OPENROUTER_TASK_PRIORITIES="interview_prep=low,cv_optimization=high"
+ADMISSION_MAX_QUEUE = int(os.environ.get("OPENROUTER_ADMISSION_MAX_QUEUE", "64"))
+ADMISSION_MAX_WAIT = float(os.environ.get("OPENROUTER_ADMISSION_MAX_WAIT", "10"))
+# Część kolejki dostępna dla priorytetu - zadania "low" odrzucamy już przy połowie zapełnienia
+ADMISSION_QUEUE_SHARES = {"low": 0.5, "normal": 0.8, "high": 1.0}
+TASK_PRIORITIES = {
+    "cv_optimization": "high",
+    "cv_improvement": "high",
+    "cover_letter": "normal",
+    "default": "normal",
+    "recruiter_feedback": "low",
+    "interview_prep": "low"
+}
+TASK_PRIORITIES.update(
+    route.strip().split("=", 1) for route in os.environ.get("OPENROUTER_TASK_PRIORITIES", "").split(",") if "=" in route
+)
+
+# SZEREGOWANIE KOLEJKI (WFQ) - miejsca przydzielane proporcjonalnie do wagi planu użytkownika × wagi priorytetu
+# zadania, np. OPENROUTER_TIER_WEIGHTS="premium=8,paid=4,free=1"; czekający dłużej niż
+# SCHEDULER_STARVATION_AGE sekund są obsługiwani w pierwszej kolejności, żeby plan free nie był zagłodzony
+TIER_WEIGHTS = {"free": 1.0, "paid": 4.0, "premium": 8.0}
+TIER_WEIGHTS.update(
+    (tier.strip(), float(weight)) for tier, _, weight in
+    (route.partition("=") for route in os.environ.get("OPENROUTER_TIER_WEIGHTS", "").split(",") if "=" in route)
+)
+PRIORITY_WEIGHTS = {"low": 0.5, "normal": 1.0, "high": 2.0}
+SCHEDULER_STARVATION_AGE = float(os.environ.get("OPENROUTER_SCHEDULER_STARVATION_AGE", "5"))
+
+# KLUCZE IDEMPOTENCJI - jak długo i ile wyników przechowujemy lokalnie
+IDEMPOTENCY_TTL = float(os.environ.get("OPENROUTER_IDEMPOTENCY_TTL", "600"))
+IDEMPOTENCY_MAX_ENTRIES = int(os.environ.get("OPENROUTER_IDEMPOTENCY_MAX_ENTRIES", "1000"))
+# Plik, do którego shutdown() zapisuje wyniki (i z którego są wczytywane po restarcie); pusty = tylko w pamięci
+IDEMPOTENCY_STORE_PATH = os.environ.get("OPENROUTER_IDEMPOTENCY_STORE_PATH", "").strip()
+
+# BUDŻET CZASU (deadline) - szacowane tempo generowania odpowiedzi i najmniejszy max_tokens, do którego
+# deadline skraca zapytanie
+DEADLINE_TOKENS_PER_SECOND = float(os.environ.get("OPENROUTER_DEADLINE_TOKENS_PER_SECOND", "40"))
+DEADLINE_MIN_TOKENS = int(os.environ.get("OPENROUTER_DEADLINE_MIN_TOKENS", "64"))
+
+# KONTYNUACJA - odpowiedź uciętą przez max_tokens (finish_reason == "length") dokańczamy kolejnymi
+# zapytaniami, które łącznie wygenerują najwyżej CONTINUATION_MAX_TOKENS tokenów ponad max_tokens
+# pierwszego zapytania; 0 wyłącza kontynuację
+CONTINUATION_MAX_TOKENS = int(os.environ.get("OPENROUTER_CONTINUATION_MAX_TOKENS", "8000"))
+# Każda runda odsyła cały prompt z dotychczasową odpowiedzią - najwięcej CONTINUATION_MAX_ROUNDS dodatkowych
+# zapytań, a część krótsza niż CONTINUATION_MIN_ROUND_RATIO swojego limitu (dostawca ucina wcześniej) kończy kontynuację
+CONTINUATION_MAX_ROUNDS = int(os.environ.get("OPENROUTER_CONTINUATION_MAX_ROUNDS", "4"))
+CONTINUATION_MIN_ROUND_RATIO = float(os.environ.get("OPENROUTER_CONTINUATION_MIN_ROUND_RATIO", "0.5"))
+
+# CACHE ODPOWIEDZI - czas życia w sekundach dla task_type (0 wyłącza cache), np.
+# OPENROUTER_RESPONSE_CACHE_TTLS="cover_letter=0,cv_optimization=7200", oraz limit rozmiaru w bajtach
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("OPENROUTER_RESPONSE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+RESPONSE_CACHE_TTLS = {
+    "cv_optimization": 3600.0,
+    "cv_improvement": 1800.0,
+    "recruiter_feedback": 1800.0,
+    "interview_prep": 1800.0,
+    "cover_letter": 900.0,
+    "default": 3600.0
+}
+RESPONSE_CACHE_TTLS.update(
+    (task_type.strip(), float(ttl)) for task_type, _, ttl in
+    (route.partition("=") for route in os.environ.get("OPENROUTER_RESPONSE_CACHE_TTLS", "").split(",") if "=" in route)
+)
+# Trwały cache na dysku (SQLite w trybie WAL) współdzielony przez procesy workerów; pusta ścieżka = tylko pamięć
+RESPONSE_CACHE_PATH = os.environ.get("OPENROUTER_RESPONSE_CACHE_PATH", "").strip()
+RESPONSE_CACHE_DISK_MAX_BYTES = int(os.environ.get("OPENROUTER_RESPONSE_CACHE_DISK_MAX_BYTES",
+                                                   str(256 * 1024 * 1024)))
+
+# PREFIX CACHING - stały prompt systemowy i CV na początku zapytania, instrukcje zadania na końcu.
+# Modele, dla których dostawca przyjmuje jawne znaczniki cache_control (pozostali, np. OpenAI i DeepSeek,
+# cache'ują wspólny prefiks automatycznie)
+PROMPT_CACHE_CONTROL_MODELS = tuple(
+    prefix.strip() for prefix in
+    os.environ.get("OPENROUTER_PROMPT_CACHE_CONTROL_MODELS", "anthropic/,google/gemini").split(",") if prefix.strip()
+)
+
+# ZAMYKANIE - ile sekund shutdown() czeka na dokończenie wywołań w toku
+SHUTDOWN_GRACE_PERIOD = float(os.environ.get("OPENROUTER_SHUTDOWN_GRACE_PERIOD", "30"))
+
+# BACKENDY - serwer zgodny z OpenAI (llama.cpp, vLLM) i przypisanie task_type do backendów,
+# np. OPENROUTER_BACKEND_ROUTES="cv_improvement=openai_compatible"
+OPENAI_COMPATIBLE_BASE_URL = os.environ.get("OPENAI_COMPATIBLE_BASE_URL", "").strip()
+OPENAI_COMPATIBLE_API_KEY = os.environ.get("OPENAI_COMPATIBLE_API_KEY", "").strip()
+OPENAI_COMPATIBLE_MODEL = os.environ.get("OPENAI_COMPATIBLE_MODEL", "").strip() or None
+BACKEND_ROUTES = dict(
+    route.strip().split("=", 1) for route in os.environ.get("OPENROUTER_BACKEND_ROUTES", "").split(",") if "=" in route
+)
+
+# KODEK JSON - "auto" wybiera orjson, jeśli jest zainstalowany
+JSON_CODEC = os.environ.get("OPENROUTER_JSON_CODEC", "auto").strip().lower()
+
+class JSONCodec:
+    """
+    Kodek JSON dla zapytań i odpowiedzi: dumps zwraca bytes w UTF-8, loads przyjmuje str lub bytes.
+    Błędy dekodowania są podklasą ValueError niezależnie od implementacji.
+    """
+
+    def __init__(self, name, dumps, loads):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+
+def _stdlib_json_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+STDLIB_JSON_CODEC = JSONCodec("json", _stdlib_json_dumps, json.loads)
+ORJSON_CODEC = JSONCodec("orjson", orjson.dumps, orjson.loads) if orjson is not None else None
+
+def _resolve_json_codec(codec):
+    if isinstance(codec, JSONCodec):
+        return codec
+    if codec == "auto":
+        return ORJSON_CODEC or STDLIB_JSON_CODEC
+    if codec == "orjson":
+        if ORJSON_CODEC is None:
+            raise RuntimeError("Kodek orjson wymaga pakietu orjson (pip install orjson)")
+        return ORJSON_CODEC
+    if codec == "json":
+        return STDLIB_JSON_CODEC
+    raise ValueError(f"Nieznany kodek JSON: {codec} (dozwolone: auto, orjson, json)")
+
+# Kodek używany przez moduł - podmieniany przez set_json_codec()
+json_codec = _resolve_json_codec(JSON_CODEC)
+
+def set_json_codec(codec):
     """
-    Send a request to the OpenRouter API with enhanced configuration
+    Ustawia kodek JSON modułu: "auto", "orjson", "json" lub własna instancja JSONCodec
     """
-    if not OPENROUTER_API_KEY or not API_KEY_VALID:
-        error_msg = "OpenRouter API key nie jest poprawnie skonfigurowany w pliku .env"
-        logger.error(error_msg)
-        raise ValueError(error_msg)
+    global json_codec
+    json_codec = _resolve_json_codec(codec)
+    return json_codec
 
-    # Language-specific system prompts
-    language_prompts = {
-        'pl': "Jesteś ekspertem w optymalizacji CV i doradcą kariery. ZAWSZE odpowiadaj w języku polskim, niezależnie od języka CV lub opisu pracy. Używaj polskiej terminologii HR i poprawnej polszczyzny. KRYTYCZNE: NIE DODAWAJ żadnych nowych firm, stanowisk, dat ani osiągnięć które nie są w oryginalnym CV - to oszukiwanie kandydata!",
-        'en': "You are an expert resume editor and career advisor. ALWAYS respond in English, regardless of the language of the CV or job description. Use proper English HR terminology and grammar. CRITICAL: DO NOT ADD any new companies, positions, dates or achievements that are not in the original CV - this is deceiving the candidate!"
-    }
+def _warmup_url(base_url):
+    """
+    Tanie zapytanie rozgrzewające: GET listy modeli API (.../v1/models) - endpoint czatu odpowiada na HEAD kodem 405
+    """
+    api_base = base_url.rstrip("/")
+    if api_base.endswith("/chat/completions"):
+        api_base = api_base[:-len("/chat/completions")]
+    return api_base + "/models"
+
+def _warmed_connections(url, responses):
+    """
+    Liczba udanych zapytań rozgrzewających - odpowiedź z błędem HTTP nie jest liczona jako rozgrzane połączenie
+    """
+    failed = [response.status_code for response in responses if response.status_code >= 400]
+    if failed:
+        logger.warning(f"⚠️ Rozgrzewanie połączeń: {len(failed)}/{len(responses)} zapytań do {url} "
+                       f"zakończonych HTTP {failed[0]}")
+    return len(responses) - len(failed)
 
-    system_prompt = get_enhanced_system_prompt(task_type, language) + "\n" + language_prompts.get(language, language_prompts['pl'])
+class OpenRouterClient:
+    """
+    Klient HTTP z trwałą sesją requests i pulą połączeń keep-alive.
+    Jedna instancja na proces - wszystkie zapytania do OpenRouter i pobieranie
+    ofert pracy korzystają z tych samych połączeń TCP/TLS.
+    """
+
+    transport = "http1"
+
+    def __init__(self, base_url=OPENROUTER_BASE_URL, pool_connections=HTTP_POOL_CONNECTIONS,
+                 pool_maxsize=HTTP_POOL_MAXSIZE):
+        self.base_url = base_url
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self._session = None
+        self._lock = threading.Lock()
+
+    def _create_session(self):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update({"Connection": "keep-alive"})
+        return session
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    self._session = self._create_session()
+        return self._session
+
+    def configure_pool(self, pool_connections=None, pool_maxsize=None):
+        """
+        Zmienia rozmiar puli połączeń - obecna sesja zostaje zamknięta i utworzona na nowo
+        """
+        with self._lock:
+            if pool_connections is not None:
+                self.pool_connections = pool_connections
+            if pool_maxsize is not None:
+                self.pool_maxsize = pool_maxsize
+            old_session, self._session = self._session, None
+        if old_session is not None:
+            old_session.close()
+
+    def post(self, payload, request_headers=None, stream=False, timeout=None):
+        return self.session.post(self.base_url, headers=request_headers or headers, data=_encode_payload(payload),
+                                 stream=stream, timeout=_timeout_pair(timeout))
+
+    def get(self, url, **kwargs):
+        return self.session.get(url, **kwargs)
+
+    def warmup(self, connections=1, timeout=None):
+        """
+        Otwiera do `connections` połączeń keep-alive z hostem base_url równoległymi zapytaniami GET
+        o listę modeli; zwraca liczbę udanych
+        """
+        connections = max(1, min(connections, self.pool_maxsize))
+        url = _warmup_url(self.base_url)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=connections) as executor:
+            responses = list(executor.map(lambda _: self.session.get(url, timeout=_timeout_pair(timeout)),
+                                          range(connections)))
+        return _warmed_connections(url, responses)
+
+    def close(self):
+        with self._lock:
+            old_session, self._session = self._session, None
+        if old_session is not None:
+            old_session.close()
+
+class _HTTPXResponse:
+    """
+    Odpowiedź httpx z interfejsem używanym przez moduł dla requests.Response
+    (elapsed jako TTFB, content, reason, iter_lines(decode_unicode=...)).
+    """
+
+    def __init__(self, response, elapsed):
+        self._response = response
+        self.elapsed = elapsed
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    @property
+    def encoding(self):
+        return self._response.encoding
+
+    @encoding.setter
+    def encoding(self, value):
+        self._response.encoding = value
+
+    @property
+    def content(self):
+        return self._response.read()
 
-    payload = {
+    @property
+    def text(self):
+        self._response.read()
+        return self._response.text
+
+    @property
+    def reason(self):
+        return self._response.reason_phrase
+
+    def iter_lines(self, decode_unicode=False):
+        return self._response.iter_lines()
+
+class HTTPXOpenRouterClient:
+    """
+    Synchroniczny klient oparty na httpx.Client z tym samym interfejsem co OpenRouterClient.
+    Przy http2=True równoległe zapytania do OpenRouter są multipleksowane na jednym połączeniu TLS
+    zamiast otwierać osobne gniazdo dla każdego (wymaga pakietu h2: pip install httpx[http2]).
+    """
+
+    def __init__(self, base_url=OPENROUTER_BASE_URL, pool_connections=HTTP_POOL_CONNECTIONS,
+                 pool_maxsize=HTTP_POOL_MAXSIZE, http2=True):
+        self.base_url = base_url
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.http2 = http2
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def transport(self):
+        return "http2" if self.http2 else "http1"
+
+    def _create_client(self):
+        _require_httpx()
+        return httpx.Client(
+            http2=self.http2,
+            limits=httpx.Limits(
+                max_connections=self.pool_maxsize,
+                max_keepalive_connections=self.pool_connections
+            ),
+            timeout=None,
+            follow_redirects=True
+        )
+
+    @property
+    def session(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._create_client()
+        return self._client
+
+    def configure_pool(self, pool_connections=None, pool_maxsize=None):
+        """
+        Zmienia limity połączeń - obecny klient zostaje zamknięty i utworzony na nowo
+        """
+        with self._lock:
+            if pool_connections is not None:
+                self.pool_connections = pool_connections
+            if pool_maxsize is not None:
+                self.pool_maxsize = pool_maxsize
+            old_client, self._client = self._client, None
+        if old_client is not None:
+            old_client.close()
+
+    def _send(self, request, stream):
+        started = time.monotonic()
+        # Zawsze w trybie strumieniowym httpx - moment powrotu to czas do pierwszego bajtu (TTFB)
+        response = self.session.send(request, stream=True)
+        elapsed = datetime.timedelta(seconds=time.monotonic() - started)
+        if not stream:
+            try:
+                response.read()
+            finally:
+                response.close()
+        return _HTTPXResponse(response, elapsed)
+
+    def post(self, payload, request_headers=None, stream=False, timeout=None):
+        request = self.session.build_request("POST", self.base_url, headers=request_headers or headers,
+                                             content=_encode_payload(payload), timeout=_httpx_timeout(timeout))
+        return self._send(request, stream)
+
+    def get(self, url, headers=None, timeout=None, stream=False):
+        request = self.session.build_request("GET", url, headers=headers, timeout=_httpx_timeout(timeout))
+        return self._send(request, stream)
+
+    def warmup(self, connections=1, timeout=None):
+        """
+        Otwiera połączenia z hostem base_url - przy HTTP/2 wystarcza jedno, multipleksowane przez wszystkie zapytania
+        """
+        connections = 1 if self.http2 else max(1, min(connections, self.pool_maxsize))
+        url = _warmup_url(self.base_url)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=connections) as executor:
+            responses = list(executor.map(lambda _: self.session.get(url, timeout=_httpx_timeout(timeout)),
+                                          range(connections)))
+        return _warmed_connections(url, responses)
+
+    def close(self):
+        with self._lock:
+            old_client, self._client = self._client, None
+        if old_client is not None:
+            old_client.close()
+
+def create_client(transport=None, base_url=OPENROUTER_BASE_URL):
+    """
+    Tworzy klienta synchronicznego dla wybranego transportu ("http1" lub "http2") -
+    pozwala porównać pulę HTTP/1.1 z multipleksacją HTTP/2 w tym samym procesie
+    """
+    transport = (transport or HTTP_TRANSPORT).lower()
+    if transport == "http2":
+        return HTTPXOpenRouterClient(base_url=base_url, http2=True)
+    if transport != "http1":
+        raise ValueError(f"Nieznany transport HTTP: {transport} (dozwolone: http1, http2)")
+    return OpenRouterClient(base_url=base_url)
+
+# Współdzielony klient modułu
+client = create_client()
+
+def _resolve_host(url):
+    parsed_url = urllib.parse.urlsplit(url)
+    port = parsed_url.port or (443 if parsed_url.scheme == "https" else 80)
+    return socket.getaddrinfo(parsed_url.hostname, port, type=socket.SOCK_STREAM)
+
+def warmup(connections=HTTP_POOL_CONNECTIONS, timeout=None):
+    """
+    Przygotowuje worker do pierwszego zapytania: wczytuje pulę kluczy API, rozwiązuje DNS hosta
+    OpenRouter i otwiera połączenia w puli klienta. Błędy sieci są tylko logowane - warmup()
+    nie przerywa startu aplikacji. Zwraca czasy poszczególnych kroków.
+    """
+    started = time.monotonic()
+    stats = {"transport": client.transport, "api_keys": len(api_key_pool), "dns_seconds": None, "connections": 0}
+    try:
+        step_started = time.monotonic()
+        _resolve_host(client.base_url)
+        stats["dns_seconds"] = time.monotonic() - step_started
+        stats["connections"] = client.warmup(connections, timeout)
+    except (OSError,) + _sync_transport_errors() as e:
+        logger.warning(f"⚠️ Rozgrzewanie połączeń z OpenRouter nie powiodło się: {str(e)}")
+    stats["seconds"] = time.monotonic() - started
+    logger.info(f"🔥 Klient OpenRouter rozgrzany w {stats['seconds']:.2f}s "
+                f"({stats['connections']} połączeń {stats['transport']})")
+    return stats
+
+# KONFIGURACJA KLIENTA ASYNCHRONICZNEGO (httpx)
+ASYNC_MAX_CONNECTIONS = int(os.environ.get("OPENROUTER_ASYNC_MAX_CONNECTIONS", "200"))
+ASYNC_MAX_KEEPALIVE = int(os.environ.get("OPENROUTER_ASYNC_MAX_KEEPALIVE", "50"))
+
+def _require_httpx():
+    if httpx is None:
+        raise RuntimeError("Asynchroniczne API wymaga pakietu httpx (pip install httpx)")
+
+class AsyncOpenRouterClient:
+    """
+    Asynchroniczny odpowiednik OpenRouterClient oparty na httpx.AsyncClient.
+    Jedna pętla zdarzeń obsługuje setki równoległych zapytań bez blokowania wątków.
+    """
+
+    def __init__(self, base_url=OPENROUTER_BASE_URL, max_connections=ASYNC_MAX_CONNECTIONS,
+                 max_keepalive_connections=ASYNC_MAX_KEEPALIVE, http2=None):
+        self.base_url = base_url
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.http2 = HTTP_TRANSPORT == "http2" if http2 is None else http2
+        # Pętla zdarzeń -> httpx.AsyncClient; wpis znika razem z pętlą zwolnioną przez garbage collector
+        self._clients = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    @property
+    def transport(self):
+        return "http2" if self.http2 else "http1"
+
+    def _get_client(self):
+        _require_httpx()
+        loop = asyncio.get_running_loop()
+        # Połączenia httpx są związane z pętlą zdarzeń, w której powstały - każda pętla ma własnego klienta
+        http_client = self._clients.get(loop)
+        if http_client is not None:
+            return http_client
+        http_client = httpx.AsyncClient(
+            http2=self.http2,
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections
+            ),
+            timeout=None,
+            follow_redirects=True
+        )
+        with self._lock:
+            # Klienta pętli zamkniętej bez aclose() nie da się już zamknąć asynchronicznie - zwalniamy go,
+            # a jego gniazda zamknie garbage collector
+            for closed_loop in [other for other in self._clients if other.is_closed()]:
+                del self._clients[closed_loop]
+            self._clients[loop] = http_client
+        return http_client
+
+    async def post(self, payload, request_headers=None, stream=False, timeout=None):
+        http_client = self._get_client()
+        request = http_client.build_request("POST", self.base_url, headers=request_headers or headers,
+                                            content=_encode_payload(payload), timeout=_httpx_timeout(timeout))
+        return await http_client.send(request, stream=stream)
+
+    async def get(self, url, timeout=None, **kwargs):
+        return await self._get_client().get(url, timeout=_httpx_timeout(timeout), **kwargs)
+
+    async def warmup(self, connections=1, timeout=None):
+        """
+        Asynchroniczna wersja OpenRouterClient.warmup() - połączenia należą do bieżącej pętli zdarzeń
+        """
+        http_client = self._get_client()
+        connections = 1 if self.http2 else max(1, min(connections, self.max_keepalive_connections))
+        url = _warmup_url(self.base_url)
+        responses = await asyncio.gather(*(http_client.get(url, timeout=_httpx_timeout(timeout))
+                                           for _ in range(connections)))
+        return _warmed_connections(url, responses)
+
+    async def aclose(self):
+        """
+        Zamyka klienta bieżącej pętli zdarzeń - wywoływać przed jej zakończeniem (async_shutdown() robi to
+        dla klientów wszystkich backendów)
+        """
+        with self._lock:
+            http_client = self._clients.pop(asyncio.get_running_loop(), None)
+        if http_client is not None:
+            await http_client.aclose()
+
+# Współdzielony klient asynchroniczny modułu
+async_client = AsyncOpenRouterClient()
+
+def _timeout_pair(timeout):
+    """
+    Normalizuje timeout do pary (connect, read) - akceptuje liczbę, parę lub None (wartości domyślne)
+    """
+    if timeout is None:
+        return (CONNECT_TIMEOUT, READ_TIMEOUT)
+    if isinstance(timeout, (int, float)):
+        return (min(CONNECT_TIMEOUT, timeout), timeout)
+    return tuple(timeout)
+
+def _httpx_timeout(timeout):
+    connect, read = _timeout_pair(timeout)
+    # Oczekiwanie na wolne połączenie z puli nie jest ograniczane - limitem jest liczba połączeń
+    return httpx.Timeout(connect=connect, read=read, write=read, pool=None)
+
+# TYPOWANE BŁĘDY KOMUNIKACJI Z UPSTREAM
+
+class UpstreamError(Exception):
+    """
+    Bazowy błąd komunikacji z OpenRouter (lub stroną z ofertą pracy).
+    retryable mówi, czy ponowienie zapytania ma sens; retry_after to sugerowana pauza w sekundach.
+    """
+    retryable = False
+
+    def __init__(self, message, status_code=None, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+class RateLimitedError(UpstreamError):
+    """HTTP 429 - przekroczony limit zapytań po stronie upstream"""
+    retryable = True
+
+class UpstreamTimeoutError(UpstreamError):
+    """Przekroczony timeout połączenia lub odczytu"""
+    retryable = True
+
+class UpstreamServerError(UpstreamError):
+    """Błąd 5xx po stronie upstream"""
+    retryable = True
+
+class UpstreamConnectionError(UpstreamError):
+    """Nie udało się nawiązać lub utrzymać połączenia"""
+    retryable = True
+
+class BadResponseError(UpstreamError):
+    """Odpowiedź w nieoczekiwanym formacie"""
+
+class CircuitOpenError(UpstreamError):
+    """Circuit breaker jest otwarty - zapytanie odrzucone bez kontaktu z upstream"""
+
+class RateLimitExceededError(UpstreamError):
+    """Lokalny limiter nie przydzielił limitu w wymaganym czasie - zapytanie nie zostało wysłane"""
+
+class DeadlineExceededError(UpstreamError):
+    """Budżet czasu wywołania (deadline) się wyczerpał - kolejny krok nie został wykonany"""
+
+class OverloadedError(UpstreamError):
+    """Kolejka dopuszczeń jest pełna albo minął ADMISSION_MAX_WAIT - zapytanie odrzucone bez kontaktu z upstream"""
+
+class ShuttingDownError(UpstreamError):
+    """Klient jest zamykany (shutdown) - nowe wywołania są odrzucane bez kontaktu z upstream"""
+
+class Deadline:
+    """
+    Bezwzględny termin zakończenia wywołania, przekazywany do ponowień, limiterów, pobierania ofert
+    i kolejnych zapytań LLM. Każdy krok skraca swój timeout i max_tokens do pozostałego czasu
+    albo kończy się DeadlineExceededError, zanim wyśle zapytanie, na którego wynik nikt nie czeka.
+    """
+
+    def __init__(self, seconds):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def check(self, step="sending the request"):
+        remaining = self.remaining()
+        if remaining <= 0.0:
+            raise DeadlineExceededError(f"Deadline exceeded before {step}")
+        return remaining
+
+    def timeout(self, timeout=None, step="sending the request"):
+        """
+        Para (connect, read) przycięta do pozostałego czasu
+        """
+        remaining = self.check(step)
+        connect, read = _timeout_pair(timeout)
+        return (min(connect, remaining), min(read, remaining))
+
+    def wait(self, wait=None):
+        """
+        Maksymalne oczekiwanie na lokalny limiter - nie dłużej niż pozostały czas
+        """
+        remaining = self.remaining()
+        return remaining if wait is None else min(wait, remaining)
+
+    def max_tokens(self, max_tokens):
+        """
+        max_tokens zmniejszone do liczby tokenów, które zdążą się wygenerować (DEADLINE_TOKENS_PER_SECOND),
+        nie mniej niż DEADLINE_MIN_TOKENS - szacunek tempa jest przybliżony, więc wysyłamy mniejszy budżet
+        zamiast odrzucać wywołanie; DeadlineExceededError dopiero po faktycznym upływie terminu
+        """
+        fitting_tokens = max(int(self.check() * DEADLINE_TOKENS_PER_SECOND), DEADLINE_MIN_TOKENS)
+        return min(max_tokens, fitting_tokens)
+
+def _resolve_deadline(deadline):
+    """
+    deadline jako Deadline, liczba sekund od teraz albo None (bez limitu)
+    """
+    if deadline is None or isinstance(deadline, Deadline):
+        return deadline
+    return Deadline(deadline)
+
+def _parse_retry_after(value):
+    """
+    Retry-After jako liczba sekund lub data HTTP
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+def _status_error(status_code, response_headers, detail, prefix="Failed to communicate with OpenRouter API"):
+    retry_after = _parse_retry_after(response_headers.get("Retry-After")) if response_headers else None
+    message = f"{prefix}: HTTP {status_code} - {detail}"
+
+    if status_code == 429:
+        return RateLimitedError(message, status_code, retry_after)
+    if status_code == 408:
+        return UpstreamTimeoutError(message, status_code, retry_after)
+    if status_code >= 500:
+        return UpstreamServerError(message, status_code, retry_after)
+    return UpstreamError(message, status_code, retry_after)
+
+def _transport_error(error, prefix="Failed to communicate with OpenRouter API"):
+    # Wyjątki timeoutów httpx często nie mają treści
+    message = f"{prefix}: {str(error) or type(error).__name__}"
+
+    if isinstance(error, requests.exceptions.Timeout) or (httpx is not None and isinstance(error, httpx.TimeoutException)):
+        return UpstreamTimeoutError(message)
+    if isinstance(error, requests.exceptions.ConnectionError) or (httpx is not None and isinstance(error, httpx.TransportError)):
+        return UpstreamConnectionError(message)
+    return UpstreamError(message)
+
+def _sync_transport_errors():
+    """
+    Wyjątki sieciowe obu transportów synchronicznych (requests i httpx) - wyliczane dopiero
+    przy obsłudze wyjątku, żeby nie importować transportu, który nie jest używany
+    """
+    return (requests.exceptions.RequestException,) + ((httpx.HTTPError,) if httpx is not None else ())
+
+def _error_detail(response):
+    try:
+        error = json_codec.loads(response.content).get('error')
+        if isinstance(error, dict) and error.get('message'):
+            return error['message']
+    except (ValueError, AttributeError):
+        pass
+    return (response.text or getattr(response, 'reason', None) or getattr(response, 'reason_phrase', ''))[:300]
+
+def _retry_delay(attempt, retry_after=None):
+    """
+    Exponential backoff z pełnym jitterem; Retry-After z odpowiedzi ma pierwszeństwo.
+    Zwraca None, gdy serwer każe czekać dłużej niż RETRY_BACKOFF_MAX - wtedy nie ponawiamy.
+    """
+    if retry_after is not None:
+        if retry_after > RETRY_BACKOFF_MAX:
+            return None
+        return retry_after + random.uniform(0, RETRY_BACKOFF_BASE)
+    return random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * (2 ** attempt)))
+
+def _with_retries(attempt_fn, max_retries=None, deadline=None):
+    """
+    Wykonuje attempt_fn, ponawiając ją dla błędów z retryable=True, w granicach deadline (jeśli podany)
+    """
+    max_retries = MAX_RETRIES if max_retries is None else max_retries
+    attempt = 0
+    while True:
+        try:
+            return attempt_fn()
+        except UpstreamError as e:
+            delay = _retry_delay(attempt, e.retry_after) if e.retryable and attempt < max_retries else None
+            if delay is not None and deadline is not None and delay >= deadline.remaining():
+                # Ponowienie i tak nie zmieściłoby się w budżecie czasu
+                delay = None
+            if delay is None:
+                raise
+            logger.warning(f"⚠️ {str(e)} - ponowienie {attempt + 1}/{max_retries} za {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+
+async def _awith_retries(attempt_fn, max_retries=None, deadline=None):
+    """
+    Asynchroniczna wersja _with_retries() - attempt_fn zwraca korutynę
+    """
+    max_retries = MAX_RETRIES if max_retries is None else max_retries
+    attempt = 0
+    while True:
+        try:
+            return await attempt_fn()
+        except UpstreamError as e:
+            delay = _retry_delay(attempt, e.retry_after) if e.retryable and attempt < max_retries else None
+            if delay is not None and deadline is not None and delay >= deadline.remaining():
+                # Ponowienie i tak nie zmieściłoby się w budżecie czasu
+                delay = None
+            if delay is None:
+                raise
+            logger.warning(f"⚠️ {str(e)} - ponowienie {attempt + 1}/{max_retries} za {delay:.1f}s")
+            await asyncio.sleep(delay)
+            attempt += 1
+
+class CircuitBreaker:
+    """
+    Circuit breaker dla jednego modelu/endpointu.
+    Śledzi odsetek błędów i wolnych odpowiedzi w oknie czasowym; po przekroczeniu progu
+    otwiera się i odrzuca zapytania natychmiast, a po CIRCUIT_OPEN_SECONDS wpuszcza próbne zapytania (half-open).
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    # Błędy świadczące o kondycji upstream - błędy klienta (4xx) i limity nie otwierają obwodu
+    FAILURE_ERRORS = (UpstreamTimeoutError, UpstreamServerError, UpstreamConnectionError)
+
+    def __init__(self, name, window_seconds=CIRCUIT_WINDOW_SECONDS, min_calls=CIRCUIT_MIN_CALLS,
+                 failure_rate=CIRCUIT_FAILURE_RATE, slow_call_seconds=CIRCUIT_SLOW_CALL_SECONDS,
+                 slow_call_rate=CIRCUIT_SLOW_CALL_RATE, open_seconds=CIRCUIT_OPEN_SECONDS,
+                 half_open_probes=CIRCUIT_HALF_OPEN_PROBES):
+        self.name = name
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self.state = self.CLOSED
+        self._calls = collections.deque()  # (czas, błąd, wolne)
+        self._opened_at = 0.0
+        self._probes_in_flight = 0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """
+        Rzuca CircuitOpenError, jeśli zapytanie ma zostać odrzucone
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self.state == self.OPEN:
+                remaining = self._opened_at + self.open_seconds - now
+                if remaining > 0:
+                    raise CircuitOpenError(
+                        f"Circuit breaker open for {self.name} - upstream unavailable, retry in {remaining:.0f}s",
+                        retry_after=remaining
+                    )
+                self.state = self.HALF_OPEN
+                self._probes_in_flight = 0
+                logger.info(f"🔌 Circuit breaker {self.name}: half-open, wysyłam zapytania próbne")
+
+            if self.state == self.HALF_OPEN:
+                if self._probes_in_flight >= self.half_open_probes:
+                    raise CircuitOpenError(
+                        f"Circuit breaker half-open for {self.name} - probe in progress",
+                        retry_after=self.open_seconds
+                    )
+                self._probes_in_flight += 1
+
+    def record_success(self, latency):
+        self._record(latency, failed=False)
+
+    def record_error(self, error, latency):
+        if isinstance(error, self.FAILURE_ERRORS):
+            self._record(latency, failed=True)
+        else:
+            self._release_probe()
+
+    def _release_probe(self):
+        with self._lock:
+            if self.state == self.HALF_OPEN and self._probes_in_flight > 0:
+                self._probes_in_flight -= 1
+
+    def _record(self, latency, failed):
+        slow = latency >= self.slow_call_seconds
+        with self._lock:
+            now = time.monotonic()
+            if self.state == self.HALF_OPEN:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+                if failed or slow:
+                    self._open(now)
+                else:
+                    self.state = self.CLOSED
+                    self._calls.clear()
+                    logger.info(f"🔌 Circuit breaker {self.name}: zamknięty, upstream znów odpowiada")
+                return
+
+            self._calls.append((now, failed, slow))
+            self._trim(now)
+            if self.state == self.CLOSED and len(self._calls) >= self.min_calls:
+                failures = sum(1 for _, f, _ in self._calls if f)
+                slow_calls = sum(1 for _, _, sl in self._calls if sl)
+                if failures / len(self._calls) >= self.failure_rate or slow_calls / len(self._calls) >= self.slow_call_rate:
+                    self._open(now)
+
+    def _trim(self, now):
+        while self._calls and self._calls[0][0] < now - self.window_seconds:
+            self._calls.popleft()
+
+    def _open(self, now):
+        self.state = self.OPEN
+        self._opened_at = now
+        self._calls.clear()
+        logger.warning(f"🔌 Circuit breaker {self.name}: otwarty na {self.open_seconds:.0f}s")
+
+    def stats(self):
+        with self._lock:
+            self._trim(time.monotonic())
+            calls = len(self._calls)
+            return {
+                "state": self.state,
+                "calls_in_window": calls,
+                "failure_rate": sum(1 for _, f, _ in self._calls if f) / calls if calls else 0.0,
+                "slow_call_rate": sum(1 for _, _, sl in self._calls if sl) / calls if calls else 0.0
+            }
+
+class CircuitBreakerRegistry:
+    """
+    Circuit breakery tworzone na żądanie, po jednym na (model, endpoint)
+    """
+
+    def __init__(self):
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, model, endpoint):
+        key = f"{model}@{endpoint}"
+        with self._lock:
+            breaker = self._breakers.get(key)
+            if breaker is None:
+                breaker = self._breakers[key] = CircuitBreaker(key)
+            return breaker
+
+    def stats(self):
+        with self._lock:
+            breakers = dict(self._breakers)
+        return {key: breaker.stats() for key, breaker in breakers.items()}
+
+    def reset(self):
+        with self._lock:
+            self._breakers.clear()
+
+circuit_breakers = CircuitBreakerRegistry()
+
+class TokenBucket:
+    """
+    Kubełek tokenów uzupełniany w stałym tempie (rate_per_minute), o pojemności równej limitowi na minutę
+    """
+
+    def __init__(self, rate_per_minute):
+        self.capacity = float(rate_per_minute)
+        self.refill_per_second = self.capacity / 60.0
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.refill_per_second)
+        self._updated = now
+
+    def wait_time(self, amount, now):
+        """
+        Czas do uzbierania amount tokenów (0, jeśli są dostępne od razu)
+        """
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.refill_per_second
+
+    def consume(self, amount):
+        self.tokens -= min(amount, self.capacity)
+
+    def refund(self, amount):
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+class RateLimiter:
+    """
+    Limiter zapytań na minutę i szacowanych tokenów na minutę (dwa kubełki).
+    acquire() blokuje do uzyskania limitu; wait=0 odrzuca od razu, wait=N czeka najwyżej N sekund.
+    """
+
+    def __init__(self, requests_per_minute=RATE_LIMIT_REQUESTS_PER_MINUTE, tokens_per_minute=RATE_LIMIT_TOKENS_PER_MINUTE):
+        self._lock = threading.Lock()
+        self.configure(requests_per_minute, tokens_per_minute)
+
+    def configure(self, requests_per_minute, tokens_per_minute):
+        # Pod blokadą - _try_acquire() i headroom() nie mogą zobaczyć wymiany kubełków w połowie
+        with self._lock:
+            self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+            self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    def _try_acquire(self, tokens):
+        """
+        Pobiera limit z obu kubełków naraz albo zwraca czas oczekiwania w sekundach
+        """
+        with self._lock:
+            now = time.monotonic()
+            wait = max(
+                self.requests.wait_time(1, now) if self.requests else 0.0,
+                self.tokens.wait_time(tokens, now) if self.tokens else 0.0
+            )
+            if wait == 0.0:
+                if self.requests:
+                    self.requests.consume(1)
+                if self.tokens:
+                    self.tokens.consume(tokens)
+            return wait
+
+    def _check_wait(self, needed, waited, wait):
+        if wait is not None and waited + needed > wait:
+            raise RateLimitExceededError(
+                f"Client-side rate limit reached - next slot in {needed:.1f}s",
+                retry_after=needed
+            )
+
+    def acquire(self, tokens=0, wait=None):
+        waited = 0.0
+        while True:
+            needed = self._try_acquire(tokens)
+            if needed == 0.0:
+                return waited
+            self._check_wait(needed, waited, wait)
+            time.sleep(needed)
+            waited += needed
+
+    async def acquire_async(self, tokens=0, wait=None):
+        waited = 0.0
+        while True:
+            needed = self._try_acquire(tokens)
+            if needed == 0.0:
+                return waited
+            self._check_wait(needed, waited, wait)
+            await asyncio.sleep(needed)
+            waited += needed
+
+    def reconcile(self, estimated_tokens, actual_tokens):
+        """
+        Zwraca do kubełka różnicę między szacunkiem a faktycznym zużyciem z pola usage
+        (0, gdy zapytanie skończyło się błędem bez odpowiedzi)
+        """
+        with self._lock:
+            if self.tokens and actual_tokens is not None and actual_tokens < estimated_tokens:
+                self.tokens.refund(estimated_tokens - actual_tokens)
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            for bucket in (self.requests, self.tokens):
+                if bucket:
+                    bucket._refill(now)
+            return {
+                "requests_available": self.requests.tokens if self.requests else None,
+                "tokens_available": self.tokens.tokens if self.tokens else None
+            }
+
+API_KEY_ERROR_MESSAGE = "OpenRouter API key nie jest poprawnie skonfigurowany w pliku .env"
+
+class APIKey:
+    """
+    Klucz z puli: własne nagłówki, limiter (RPM/TPM) i stan zdrowia.
+    Klucz wycofany po 401/403/429 nie jest wybierany do chwili disabled_until.
+    """
+
+    def __init__(self, api_key, requests_per_minute, tokens_per_minute):
+        self.api_key = api_key
+        self.label = f"{api_key[:9]}...{api_key[-4:]}"
+        self.headers = dict(headers, Authorization=f"Bearer {api_key}")
+        self.limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.disabled_until = 0.0
+        self.failures = 0
+
+    def headroom(self, now):
+        """
+        Wolna część limitu (0-1) - mniejsza z wartości dla kubełka zapytań i tokenów
+        """
+        with self.limiter._lock:
+            fractions = [1.0]
+            for bucket in (self.limiter.requests, self.limiter.tokens):
+                if bucket:
+                    bucket._refill(now)
+                    fractions.append(bucket.tokens / bucket.capacity)
+            return min(fractions)
+
+class APIKeyPool:
+    """
+    Pula kluczy OpenRouter - każde zapytanie dostaje klucz z największym zapasem limitu.
+    acquire() ma semantykę RateLimiter.acquire(): wait=None blokuje, 0 odrzuca od razu, N czeka najwyżej N sekund.
+    Gdy wszystkie klucze są wycofane na dłużej niż RETRY_BACKOFF_MAX, acquire() od razu zgłasza RateLimitedError.
+    """
+
+    def __init__(self, api_keys=None, requests_per_minute=RATE_LIMIT_REQUESTS_PER_MINUTE,
+                 tokens_per_minute=RATE_LIMIT_TOKENS_PER_MINUTE):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        # None - klucze z konfiguracji zostaną wczytane i zwalidowane przy pierwszym użyciu puli
+        self._keys = None
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        if api_keys is not None:
+            self.reload(api_keys)
+
+    def _ensure_loaded(self):
+        if self._keys is None:
+            with self._load_lock:
+                if self._keys is None:
+                    self.reload(_configured_api_keys())
+        return self._keys
+
+    def __len__(self):
+        return len(self._ensure_loaded())
+
+    def reload(self, api_keys):
+        """
+        Podmienia klucze puli bez restartu - klucze obecne już wcześniej zachowują limiter i stan
+        """
+        valid_keys = []
+        for index, api_key in enumerate(api_keys):
+            api_key = api_key.strip()
+            if api_key not in valid_keys and validate_api_key(api_key, f"OPENROUTER_API_KEYS[{index}]"):
+                valid_keys.append(api_key)
+
+        with self._lock:
+            existing = {key.api_key: key for key in self._keys or ()}
+            self._keys = [existing.get(api_key) or APIKey(api_key, self.requests_per_minute, self.tokens_per_minute)
+                          for api_key in valid_keys]
+        logger.info(f"🔑 Pula kluczy OpenRouter: {len(valid_keys)} aktywnych")
+        return len(valid_keys)
+
+    def configure(self, requests_per_minute, tokens_per_minute):
+        """
+        Zmienia limity RPM/TPM wszystkich kluczy (0 wyłącza dany limit)
+        """
+        with self._lock:
+            self.requests_per_minute = requests_per_minute
+            self.tokens_per_minute = tokens_per_minute
+            for key in self._keys or ():
+                key.limiter.configure(requests_per_minute, tokens_per_minute)
+
+    def _try_acquire(self, tokens):
+        """
+        Zwraca (klucz, 0.0) albo (None, czas do zwolnienia najbliższego klucza)
+        """
+        self._ensure_loaded()
+        with self._lock:
+            if not self._keys:
+                raise ValueError(API_KEY_ERROR_MESSAGE)
+            now = time.monotonic()
+            available = [key for key in self._keys if key.disabled_until <= now]
+            if not available:
+                needed = min(key.disabled_until for key in self._keys) - now
+                # Nie blokujemy dłużej, niż czekałoby ponowienie zapytania - wywołujący dostaje 429 od razu
+                if needed > RETRY_BACKOFF_MAX:
+                    raise RateLimitedError(f"All API keys are cooling down after upstream errors - "
+                                           f"next key in {needed:.0f}s", retry_after=needed)
+                return None, needed
+
+            waits = []
+            for key in sorted(available, key=lambda key: key.headroom(now), reverse=True):
+                wait = key.limiter._try_acquire(tokens)
+                if wait == 0.0:
+                    return key, 0.0
+                waits.append(wait)
+            return None, min(waits)
+
+    def _check_wait(self, needed, waited, wait):
+        if wait is not None and waited + needed > wait:
+            raise RateLimitExceededError(
+                f"Client-side rate limit reached for all API keys - next slot in {needed:.1f}s",
+                retry_after=needed
+            )
+
+    def acquire(self, tokens=0, wait=None):
+        waited = 0.0
+        while True:
+            key, needed = self._try_acquire(tokens)
+            if key is not None:
+                return key
+            self._check_wait(needed, waited, wait)
+            time.sleep(needed)
+            waited += needed
+
+    async def acquire_async(self, tokens=0, wait=None):
+        waited = 0.0
+        while True:
+            key, needed = self._try_acquire(tokens)
+            if key is not None:
+                return key
+            self._check_wait(needed, waited, wait)
+            await asyncio.sleep(needed)
+            waited += needed
+
+    def on_success(self, key):
+        key.failures = 0
+
+    def on_error(self, key, error):
+        """
+        Wycofuje klucz czasowo po 401/403 (odrzucony klucz) lub 429 (wyczerpany limit).
+        Gdy w puli zostały inne klucze, błąd staje się ponawialny od razu - na innym kluczu.
+        Ostatniego dostępnego klucza 429 bez Retry-After nie wycofujemy na dłużej niż backoff ponowienia -
+        limit darmowych modeli OpenRouter jest często wspólny dla upstream, a nie przypisany do klucza.
+        """
+        if error.status_code not in (401, 403, 429):
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            key.failures += 1
+            remaining = sum(1 for other in self._keys if other is not key and other.disabled_until <= now)
+            if error.status_code != 429:
+                cooldown = KEY_AUTH_COOLDOWN
+            elif error.retry_after:
+                cooldown = error.retry_after
+            elif remaining:
+                cooldown = KEY_RATE_LIMIT_COOLDOWN
+            else:
+                cooldown = min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * (2 ** (key.failures - 1)))
+            key.disabled_until = now + cooldown
+        logger.warning(f"🔑 Klucz {key.label} wycofany na {cooldown:.0f}s (HTTP {error.status_code}), "
+                       f"dostępnych kluczy: {remaining}")
+
+        if remaining:
+            error.retryable = True
+            error.retry_after = None
+
+    def reconcile(self, key, estimated_tokens, actual_tokens):
+        if key is not None:
+            key.limiter.reconcile(estimated_tokens, actual_tokens)
+
+    def stats(self):
+        self._ensure_loaded()
+        with self._lock:
+            keys = list(self._keys)
+        now = time.monotonic()
+        return {
+            key.label: dict(
+                key.limiter.stats(),
+                available=key.disabled_until <= now,
+                disabled_for=max(0.0, key.disabled_until - now),
+                failures=key.failures
+            )
+            for key in keys
+        }
+
+def _configured_api_keys():
+    """
+    Klucze z OPENROUTER_API_KEYS (rozdzielone przecinkami), a bez niej - pojedynczy OPENROUTER_API_KEY
+    """
+    api_keys = [api_key for api_key in os.environ.get("OPENROUTER_API_KEYS", "").split(",") if api_key.strip()]
+    return api_keys or [os.environ.get("OPENROUTER_API_KEY", "")]
+
+# Współdzielona pula kluczy modułu
+api_key_pool = APIKeyPool()
+
+def reload_api_keys(api_keys=None):
+    """
+    Przeładowuje pulę kluczy w trakcie działania - bez argumentu ponownie czyta .env i zmienne środowiskowe
+    """
+    if api_keys is None:
+        load_dotenv(override=True)
+        api_keys = _configured_api_keys()
+    return api_key_pool.reload(api_keys)
+
+class _Waiter:
+    __slots__ = ('event', 'loop', 'future', 'granted', 'tier', 'flow', 'start', 'finish', 'enqueued_at')
+
+    def __init__(self, event=None, loop=None, future=None, tier='free', flow=None):
+        self.event = event
+        self.loop = loop
+        self.future = future
+        self.granted = False
+        self.tier = tier
+        self.flow = flow
+        self.start = 0.0
+        self.finish = 0.0
+        self.enqueued_at = time.monotonic()
+
+def _resolve_future(future):
+    if not future.done():
+        future.set_result(True)
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Limit równoczesnych zapytań do upstream sterowany algorytmem AIMD.
+    Zdrowe odpowiedzi podnoszą limit o ~1 na każde `limit` sukcesów, a 429/5xx/timeout lub skok
+    opóźnienia (CONCURRENCY_LATENCY_SPIKE × średnia dla task_type) mnożą go przez CONCURRENCY_BACKOFF_RATIO.
+    Wspólny dla wątków i pętli asyncio. Oczekujący są szeregowani algorytmem WFQ według planu użytkownika
+    i priorytetu zadania (TIER_WEIGHTS × PRIORITY_WEIGHTS), w obrębie jednego przepływu (tier, task_type) - FIFO;
+    czekający dłużej niż starvation_age dostają co drugie wolne miejsce, od najstarszego.
+    Miejsce obejmuje też pobranie klucza API z limitem RPM/TPM - na limit czeka naraz tylko jeden wywołujący
+    (kolejka WFQ stoi), więc przy wyczerpanym limicie minutowym kolejność też wyznacza WFQ.
+    Kolejka oczekujących jest ograniczona (max_queue, max_queue_wait) - nadmiar dostaje OverloadedError,
+    a zadania o niższym priorytecie (TASK_PRIORITIES) są odrzucane przy mniejszym zapełnieniu kolejki.
+    Wywołanie czekające na limit RPM/TPM zajmuje kolejkę - pozostałe czekają za nim w jej granicach.
+    """
+
+    # Błędy oznaczające przeciążenie upstream
+    OVERLOAD_ERRORS = (RateLimitedError, UpstreamServerError, UpstreamTimeoutError)
+
+    def __init__(self, initial_limit=CONCURRENCY_INITIAL_LIMIT, min_limit=CONCURRENCY_MIN_LIMIT,
+                 max_limit=CONCURRENCY_MAX_LIMIT, backoff_ratio=CONCURRENCY_BACKOFF_RATIO,
+                 latency_spike=CONCURRENCY_LATENCY_SPIKE, decrease_cooldown=1.0, max_queue=ADMISSION_MAX_QUEUE,
+                 max_queue_wait=ADMISSION_MAX_WAIT, starvation_age=SCHEDULER_STARVATION_AGE):
+        self._limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff_ratio = backoff_ratio
+        self.latency_spike = latency_spike
+        self.decrease_cooldown = decrease_cooldown
+        self.max_queue = max_queue
+        self.max_queue_wait = max_queue_wait
+        self.starvation_age = starvation_age
+        self.in_flight = 0
+        self.shed = collections.Counter()
+        # Kolejki FIFO przepływów (tier, task_type) i znaczniki wirtualnego czasu WFQ
+        self._queues = {}
+        self._queued = 0
+        self._virtual_time = 0.0
+        self._flow_finish = {}
+        self._served_starved = False
+        # Czy któryś wywołujący z przydzielonym miejscem pobiera właśnie klucz API (czeka na limit RPM/TPM)
+        self._rate_turn_taken = False
+        self._tier_stats = {}
+        self._latency_ewma = {}
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def limit(self):
+        return max(1, int(self._limit))
+
+    def _has_capacity(self):
+        return self.in_flight < self.limit and not self._rate_turn_taken
+
+    def _take_slot(self):
+        # Wywoływane pod blokadą - miejsce w limicie razem z kolejką do limitu RPM/TPM
+        self.in_flight += 1
+        self._rate_turn_taken = True
+
+    def _enqueue(self, waiter, task_type):
+        # Wywoływane pod blokadą - znacznik zakończenia rośnie o 1/waga, więc cięższe przepływy są obsługiwane częściej
+        weight = TIER_WEIGHTS.get(waiter.tier, 1.0) * PRIORITY_WEIGHTS.get(TASK_PRIORITIES.get(task_type, "normal"), 1.0)
+        waiter.start = max(self._virtual_time, self._flow_finish.get(waiter.flow, 0.0))
+        waiter.finish = waiter.start + 1.0 / weight
+        self._flow_finish[waiter.flow] = waiter.finish
+        self._queues.setdefault(waiter.flow, collections.deque()).append(waiter)
+        self._queued += 1
+
+    def _dequeue(self):
+        # Wywoływane pod blokadą - najmniejszy znacznik zakończenia albo, co drugi przydział, najstarszy
+        # zagłodzony oczekujący (tak zagłodzeni nie blokują w całości przepływów o wyższej wadze)
+        heads = [queue[0] for queue in self._queues.values()]
+        oldest = min(heads, key=lambda head: head.enqueued_at)
+        starved = time.monotonic() - oldest.enqueued_at >= self.starvation_age and not self._served_starved
+        waiter = oldest if starved else min(heads, key=lambda head: head.finish)
+        self._served_starved = starved
+        self._remove(waiter)
+        self._virtual_time = max(self._virtual_time, waiter.start)
+        if not self._queued:
+            # Pusta kolejka - stare znaczniki przepływów nie mają już znaczenia
+            self._flow_finish.clear()
+        return waiter
+
+    def _remove(self, waiter):
+        queue = self._queues[waiter.flow]
+        queue.remove(waiter)
+        if not queue:
+            del self._queues[waiter.flow]
+        self._queued -= 1
+
+    def _record_wait(self, tier, wait):
+        # Wywoływane pod blokadą - metryki oczekiwania na miejsce dla planu użytkownika
+        tier_stats = self._tier_stats.setdefault(tier, {"granted": 0, "avg_wait": 0.0, "max_wait": 0.0})
+        tier_stats["granted"] += 1
+        tier_stats["avg_wait"] = wait if tier_stats["granted"] == 1 else 0.9 * tier_stats["avg_wait"] + 0.1 * wait
+        tier_stats["max_wait"] = max(tier_stats["max_wait"], wait)
+
+    def _grant_waiters(self):
+        # Wywoływane pod blokadą - przekazuje wolne miejsca kolejnym oczekującym
+        while self._queued and self._has_capacity():
+            waiter = self._dequeue()
+            waiter.granted = True
+            self._take_slot()
+            if waiter.event is not None:
+                waiter.event.set()
+            else:
+                waiter.loop.call_soon_threadsafe(_resolve_future, waiter.future)
+
+    def _abandon(self, waiter):
+        """
+        Wycofuje oczekującego po anulowaniu lub upływie czasu; zwraca True, jeśli miejsce zdążyło zostać przydzielone
+        """
+        with self._lock:
+            if waiter.granted:
+                return True
+            self._remove(waiter)
+            return False
+
+    def _check_queue(self, task_type):
+        # Wywoływane pod blokadą, gdy zapytanie musiałoby czekać w kolejce
+        priority = TASK_PRIORITIES.get(task_type, "normal")
+        queue_limit = int(self.max_queue * ADMISSION_QUEUE_SHARES.get(priority, 1.0))
+        if self._queued >= queue_limit:
+            self.shed[task_type] += 1
+            raise OverloadedError(f"Upstream overloaded - {self._queued} requests already queued, "
+                                  f"{task_type} request ({priority} priority) shed")
+
+    def _queue_timeout(self, timeout):
+        return self.max_queue_wait if timeout is None else min(timeout, self.max_queue_wait)
+
+    def _wait_error(self, timeout, task_type):
+        if timeout is not None and timeout <= self.max_queue_wait:
+            return DeadlineExceededError("Deadline exceeded while waiting for a concurrency slot")
+        with self._lock:
+            self.shed[task_type] += 1
+        return OverloadedError(f"Upstream overloaded - no concurrency slot within {self.max_queue_wait:.1f}s")
+
+    def _rate_limit_wait(self, enqueued_at, timeout, rate_limit_wait):
+        """
+        Oczekiwanie na limit RPM/TPM: rate_limit_wait (None = bez limitu), nie dłużej niż pozostały deadline
+        (timeout) - zwraca (czas, czy ogranicza go deadline)
+        """
+        if timeout is None:
+            return rate_limit_wait, False
+        remaining = max(0.0, enqueued_at + timeout - time.monotonic())
+        if rate_limit_wait is not None and rate_limit_wait <= remaining:
+            return rate_limit_wait, False
+        return remaining, True
+
+    def _end_rate_turn(self, tier, enqueued_at, acquired):
+        """
+        Kończy oczekiwanie na limit RPM/TPM - wliczając je do czasu oczekiwania planu - i wpuszcza kolejnego
+        oczekującego; bez klucza (acquired=False) zwalnia też miejsce
+        """
+        with self._lock:
+            self._rate_turn_taken = False
+            if acquired:
+                self._record_wait(tier, time.monotonic() - enqueued_at)
+            else:
+                self.in_flight -= 1
+            self._grant_waiters()
+
+    def _enter(self, task_type, user_tier, credentials, tokens, waiter_factory):
+        """
+        Zwraca (klucz, None), gdy miejsce i limit RPM/TPM są dostępne od razu, (None, None), gdy przydzielono
+        miejsce, ale trzeba poczekać na limit RPM/TPM, albo (None, waiter) - wywołujący czeka w kolejce
+        """
+        with self._lock:
+            if not self._queued and self._has_capacity():
+                try:
+                    api_key = credentials.acquire(tokens, 0)
+                except RateLimitExceededError:
+                    self._take_slot()
+                    return None, None
+                self.in_flight += 1
+                self._record_wait(user_tier, 0.0)
+                return api_key, None
+            self._check_queue(task_type)
+            waiter = waiter_factory()
+            self._enqueue(waiter, task_type)
+            return None, waiter
+
+    def acquire(self, timeout=None, task_type='default', user_tier='free', credentials=None, tokens=0,
+                rate_limit_wait=None):
+        """
+        Zajmuje miejsce w limicie; z credentials (pula kluczy) zwraca też klucz API z limitem na tokens tokenów,
+        rate_limit_wait ogranicza oczekiwanie na limit RPM/TPM jak w APIKeyPool.acquire()
+        """
+        credentials = credentials or _no_credentials
+        enqueued_at = time.monotonic()
+        api_key, waiter = self._enter(task_type, user_tier, credentials, tokens,
+                                      lambda: _Waiter(event=threading.Event(), tier=user_tier,
+                                                      flow=(user_tier, task_type)))
+        if api_key is not None:
+            return api_key
+        if waiter is not None and not waiter.event.wait(self._queue_timeout(timeout)) and not self._abandon(waiter):
+            raise self._wait_error(timeout, task_type)
+
+        wait, deadline_bound = self._rate_limit_wait(enqueued_at, timeout, rate_limit_wait)
+        try:
+            api_key = credentials.acquire(tokens, wait)
+        except RateLimitExceededError:
+            if not deadline_bound:
+                raise
+            raise DeadlineExceededError("Deadline exceeded while waiting for the rate limit") from None
+        finally:
+            self._end_rate_turn(user_tier, enqueued_at, api_key is not None)
+        return api_key
+
+    async def acquire_async(self, timeout=None, task_type='default', user_tier='free', credentials=None, tokens=0,
+                            rate_limit_wait=None):
+        credentials = credentials or _no_credentials
+        enqueued_at = time.monotonic()
+        loop = asyncio.get_running_loop()
+        api_key, waiter = self._enter(task_type, user_tier, credentials, tokens,
+                                      lambda: _Waiter(loop=loop, future=loop.create_future(), tier=user_tier,
+                                                      flow=(user_tier, task_type)))
+        if api_key is not None:
+            return api_key
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(waiter.future, self._queue_timeout(timeout))
+            except asyncio.TimeoutError:
+                if not self._abandon(waiter):
+                    raise self._wait_error(timeout, task_type)
+            except asyncio.CancelledError:
+                if self._abandon(waiter):
+                    self._end_rate_turn(user_tier, enqueued_at, False)
+                raise
+
+        wait, deadline_bound = self._rate_limit_wait(enqueued_at, timeout, rate_limit_wait)
+        try:
+            api_key = await credentials.acquire_async(tokens, wait)
+        except RateLimitExceededError:
+            if not deadline_bound:
+                raise
+            raise DeadlineExceededError("Deadline exceeded while waiting for the rate limit") from None
+        finally:
+            self._end_rate_turn(user_tier, enqueued_at, api_key is not None)
+        return api_key
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+            self._grant_waiters()
+
+    def on_success(self, task_type, latency):
+        with self._lock:
+            average = self._latency_ewma.get(task_type)
+            self._latency_ewma[task_type] = latency if average is None else 0.9 * average + 0.1 * latency
+            # Próg bezwzględny (1s) chroni przed szumem przy bardzo krótkich odpowiedziach
+            if average is not None and latency > max(1.0, average * self.latency_spike):
+                self._decrease(f"skok opóźnienia {latency:.1f}s przy średniej {average:.1f}s")
+            elif self.in_flight >= self._limit / 2:
+                # Podnosimy limit tylko wtedy, gdy jest faktycznie wykorzystywany
+                self._limit = min(self.max_limit, self._limit + 1.0 / self._limit)
+                self._grant_waiters()
+
+    def on_error(self, error):
+        if isinstance(error, self.OVERLOAD_ERRORS):
+            with self._lock:
+                self._decrease(type(error).__name__)
+
+    def _decrease(self, reason):
+        now = time.monotonic()
+        if now - self._last_decrease < self.decrease_cooldown:
+            return
+        self._last_decrease = now
+        self._limit = max(self.min_limit, self._limit * self.backoff_ratio)
+        logger.info(f"📉 Limit współbieżności OpenRouter obniżony do {self.limit} ({reason})")
+
+    def stats(self):
+        with self._lock:
+            tiers = {tier: dict(tier_stats, waiting=0) for tier, tier_stats in self._tier_stats.items()}
+            for (tier, _), queue in self._queues.items():
+                tiers.setdefault(tier, {"granted": 0, "avg_wait": 0.0, "max_wait": 0.0, "waiting": 0})
+                tiers[tier]["waiting"] += len(queue)
+            return {
+                "limit": self.limit,
+                "in_flight": self.in_flight,
+                "waiting": self._queued,
+                "max_queue": self.max_queue,
+                "shed": dict(self.shed),
+                "tiers": tiers
+            }
+
+concurrency_limiter = AdaptiveConcurrencyLimiter()
+
+class _IdempotencyEntry:
+    __slots__ = ('fingerprint', 'done', 'result', 'error', 'abandoned', 'expires_at', 'waiters')
+
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.abandoned = False
+        self.expires_at = None
+        self.waiters = []
+
+def _resolve_idempotent_future(future):
+    if not future.done():
+        future.set_result(None)
+
+def _owner_specific_error(error):
+    """
+    Anulowanie wywołania (np. rozłączony klient) albo koniec jego własnego deadline nie dotyczy dołączonych
+    """
+    return not isinstance(error, Exception) or isinstance(error, DeadlineExceededError)
+
+def _request_fingerprint(*parts):
+    """
+    Stabilny między procesami skrót parametrów wywołania (hash() napisów jest losowany przy starcie)
+    """
+    return hashlib.sha256(
+        json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str).encode('utf-8')
+    ).hexdigest()
+
+class IdempotencyStore:
+    """
+    Lokalny magazyn wyników dla kluczy idempotencji.
+    Powtórne wywołanie z tym samym kluczem w oknie ttl dołącza do trwającego wywołania albo dostaje
+    zapisany wynik. Błędy trafiają do oczekujących, ale nie są zapamiętywane - kolejna próba wykona się od nowa.
+    Gdy wywołanie zostanie anulowane albo skończy mu się deadline, przejmuje je jeden z oczekujących.
+    Z podanym path zakończone wyniki można zapisać (save(), wywoływane przez shutdown()) i wczytać po restarcie.
+    """
+
+    def __init__(self, ttl=IDEMPOTENCY_TTL, max_entries=IDEMPOTENCY_MAX_ENTRIES, path=IDEMPOTENCY_STORE_PATH):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.path = path
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            try:
+                self.load(path)
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logger.warning(f"⚠️ Nie udało się wczytać zapisanych wyników z {path}: {str(e)}")
+
+    def _evict(self, now):
+        # Wywoływane pod blokadą - usuwa przeterminowane i najstarsze zakończone wpisy
+        for key, entry in list(self._entries.items()):
+            if entry.expires_at is not None and (entry.expires_at <= now or len(self._entries) > self.max_entries):
+                del self._entries[key]
+
+    def _begin(self, key, fingerprint):
+        """
+        Zwraca (wpis, True) dla nowego wywołania albo (wpis, False), gdy wynik jest już znany lub w toku
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._evict(now)
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry.fingerprint != fingerprint:
+                    raise ValueError(f"Idempotency key {key!r} was already used with different parameters")
+                self._entries.move_to_end(key)
+                return entry, False
+            entry = self._entries[key] = _IdempotencyEntry(fingerprint)
+            return entry, True
+
+    def _finish(self, key, entry, result=None, error=None):
+        with self._lock:
+            entry.abandoned = error is not None and _owner_specific_error(error)
+            entry.result = result
+            entry.error = None if entry.abandoned else error
+            if error is None:
+                entry.expires_at = time.monotonic() + self.ttl
+            elif self._entries.get(key) is entry:
+                del self._entries[key]
+            waiters, entry.waiters = entry.waiters, []
+            entry.done.set()
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_resolve_idempotent_future, future)
+
+    def _outcome(self, entry):
+        if entry.error is not None:
+            raise entry.error
+        return entry.result
+
+    def _deadline_exceeded(self):
+        return DeadlineExceededError("Deadline exceeded while waiting for the in-flight call with the same key")
+
+    def run(self, key, fingerprint, fn, deadline=None):
+        """
+        deadline ogranicza tylko oczekiwanie dołączonego wywołującego - wywołanie w toku trwa dalej
+        """
+        while True:
+            entry, owner = self._begin(key, fingerprint)
+            if owner:
+                break
+            if not entry.done.wait(deadline.remaining() if deadline is not None else None):
+                raise self._deadline_exceeded()
+            if not entry.abandoned:
+                return self._outcome(entry)
+        try:
+            result = fn()
+        except BaseException as e:
+            self._finish(key, entry, error=e)
+            raise
+        self._finish(key, entry, result=result)
+        return result
+
+    async def arun(self, key, fingerprint, coro_fn, deadline=None):
+        while True:
+            entry, owner = self._begin(key, fingerprint)
+            if owner:
+                break
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            with self._lock:
+                waiting = not entry.done.is_set()
+                if waiting:
+                    entry.waiters.append((loop, future))
+            if waiting:
+                try:
+                    # Anulowanie oczekującego (albo jego deadline) nie przerywa wywołania, do którego dołączył
+                    await asyncio.wait_for(asyncio.shield(future),
+                                           deadline.remaining() if deadline is not None else None)
+                except asyncio.TimeoutError:
+                    raise self._deadline_exceeded() from None
+                finally:
+                    future.cancel()
+            if not entry.abandoned:
+                return self._outcome(entry)
+        try:
+            result = await coro_fn()
+        except BaseException as e:
+            self._finish(key, entry, error=e)
+            raise
+        self._finish(key, entry, result=result)
+        return result
+
+    def forget(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.done.is_set():
+                del self._entries[key]
+
+    def save(self, path=None):
+        """
+        Zapisuje zakończone, nieprzeterminowane wyniki (tekst lub CompletionResult) do pliku JSON
+        """
+        path = path or self.path
+        if not path:
+            return 0
+        with self._lock:
+            now = time.monotonic()
+            self._evict(now)
+            records = []
+            for key, entry in self._entries.items():
+                if entry.expires_at is None:
+                    continue
+                if isinstance(entry.result, CompletionResult):
+                    result = {"completion_result": {name: getattr(entry.result, name)
+                                                    for name in CompletionResult.__slots__}}
+                elif isinstance(entry.result, str):
+                    result = {"text": entry.result}
+                else:
+                    continue
+                records.append({"key": key, "fingerprint": entry.fingerprint, "ttl": entry.expires_at - now,
+                                "result": result})
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, 'w', encoding='utf-8') as f:
+            json.dump({"saved_at": time.time(), "entries": records}, f, ensure_ascii=False)
+        os.replace(temporary_path, path)
+        return len(records)
+
+    def load(self, path=None):
+        """
+        Wczytuje wyniki zapisane przez save() - pomija te, którym w międzyczasie minął ttl
+        """
+        path = path or self.path
+        with open(path, encoding='utf-8') as f:
+            saved = json.load(f)
+        elapsed = max(0.0, time.time() - saved["saved_at"])
+        loaded = 0
+        with self._lock:
+            now = time.monotonic()
+            for record in saved["entries"]:
+                ttl = record["ttl"] - elapsed
+                if ttl <= 0 or record["key"] in self._entries:
+                    continue
+                entry = _IdempotencyEntry(record["fingerprint"])
+                result = record["result"]
+                entry.result = (CompletionResult(**result["completion_result"]) if "completion_result" in result
+                                else result["text"])
+                entry.expires_at = now + ttl
+                entry.done.set()
+                self._entries[record["key"]] = entry
+                loaded += 1
+            self._evict(now)
+        return loaded
+
+    def stats(self):
+        with self._lock:
+            in_flight = sum(1 for entry in self._entries.values() if not entry.done.is_set())
+            return {"entries": len(self._entries), "in_flight": in_flight}
+
+# Współdzielony magazyn idempotencji modułu
+idempotency_store = IdempotencyStore()
+
+class SingleFlight(IdempotencyStore):
+    """
+    Łączenie równoczesnych identycznych wywołań (single-flight): dopóki trwa wywołanie z danym kluczem,
+    kolejne - z wątków i z pętli asyncio - czekają na jego wynik albo wyjątek zamiast wykonywać własne.
+    W przeciwieństwie do IdempotencyStore wynik nie jest przechowywany po zakończeniu.
+    """
+
+    def __init__(self):
+        super().__init__(ttl=0, max_entries=0, path=None)
+        self.coalesced = 0
+
+    def _begin(self, key, fingerprint):
+        entry, owner = super()._begin(key, fingerprint)
+        if not owner:
+            with self._lock:
+                self.coalesced += 1
+        return entry, owner
+
+    def _finish(self, key, entry, result=None, error=None):
+        with self._lock:
+            if self._entries.get(key) is entry:
+                del self._entries[key]
+        super()._finish(key, entry, result, error)
+
+    def do(self, key, fn, deadline=None):
+        return self.run(key, key, fn, deadline)
+
+    async def ado(self, key, coro_fn, deadline=None):
+        return await self.arun(key, key, coro_fn, deadline)
+
+    def stats(self):
+        stats = super().stats()
+        stats["coalesced"] = self.coalesced
+        return stats
+
+# Współdzielone łączenie identycznych wywołań modułu
+single_flight = SingleFlight()
+
+class DrainController:
+    """
+    Licznik wywołań w toku na potrzeby łagodnego zamykania (np. przy wdrożeniu).
+    shutdown() przestaje przyjmować nowe wywołania (ShuttingDownError), czeka do grace sekund na trwające,
+    anuluje pozostałe zadania asyncio i zadania w tle, a na koniec zapisuje magazyn wyników.
+    Otwarty strumień odpowiedzi liczy się jako wywołanie w toku aż do zamknięcia.
+    """
+
+    def __init__(self):
+        self.accepting = True
+        self.in_flight = 0
+        self._tasks = {}
+        self._condition = threading.Condition()
+
+    def enter(self, task=None):
+        with self._condition:
+            if not self.accepting:
+                raise ShuttingDownError("OpenRouter client is shutting down - new calls are rejected")
+            self.in_flight += 1
+            if task is not None:
+                self._tasks[task] = task.get_loop()
+
+    def exit(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def release_task(self, task):
+        with self._condition:
+            self._tasks.pop(task, None)
+
+    def _drain(self, grace):
+        with self._condition:
+            self.accepting = False
+            self._condition.wait_for(lambda: self.in_flight <= 0, grace)
+            return self.in_flight, list(self._tasks.items())
+
+    def _finish(self, started, in_flight, tasks):
+        for task, loop in tasks:
+            if not task.done():
+                loop.call_soon_threadsafe(task.cancel)
+        executor = _hedge_executor
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+        saved = 0
+        try:
+            saved = idempotency_store.save()
+        except OSError as e:
+            logger.error(f"Nie udało się zapisać wyników przy zamykaniu: {str(e)}")
+        stats = {"seconds": time.monotonic() - started, "abandoned": in_flight, "cancelled": len(tasks),
+                 "saved_results": saved}
+        if in_flight:
+            logger.warning(f"⚠️ Zamknięto klienta OpenRouter z {in_flight} niedokończonymi wywołaniami "
+                           f"(anulowano {len(tasks)} zadań asyncio)")
+        else:
+            logger.info(f"Klient OpenRouter zamknięty po {stats['seconds']:.2f}s - wszystkie wywołania dokończone")
+        return stats
+
+    def shutdown(self, grace=None):
+        """
+        Zamyka klienta; nie wywoływać z wątku pętli zdarzeń, na której działają wywołania async (async_shutdown())
+        """
+        started = time.monotonic()
+        in_flight, tasks = self._drain(SHUTDOWN_GRACE_PERIOD if grace is None else grace)
+        return self._finish(started, in_flight, tasks)
+
+    async def async_shutdown(self, grace=None):
+        started = time.monotonic()
+        in_flight, tasks = await asyncio.to_thread(self._drain, SHUTDOWN_GRACE_PERIOD if grace is None else grace)
+        stats = self._finish(started, in_flight, tasks)
+        # Jeden obrót pętli, żeby anulowane zadania z tej pętli zdążyły obsłużyć CancelledError
+        await asyncio.sleep(0)
+        return stats
+
+drain_controller = DrainController()
+
+class SQLiteResponseCache:
+    """
+    Trwały cache odpowiedzi w SQLite (tryb WAL) - przetrwa restart i jest współdzielony przez procesy
+    na jednej maszynie. Wartości są kompresowane zlib; przeterminowane wpisy i, po przekroczeniu max_bytes,
+    najdawniej używane są usuwane przy zapisie. Błędy bazy są logowane i traktowane jak brak wpisu.
+    """
+
+    # Czas ostatniego użycia (kolejność usuwania) odczyty zapisują paczkami - przy zapisie wpisu albo najwyżej
+    # raz na TOUCH_INTERVAL sekund, żeby odczyty ze wszystkich workerów nie konkurowały o blokadę zapisu bazy
+    TOUCH_INTERVAL = 60.0
+
+    def __init__(self, path, max_bytes=RESPONSE_CACHE_DISK_MAX_BYTES, busy_timeout=5.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.busy_timeout = busy_timeout
+        # Połączenie SQLite na wątek - obiektów połączeń nie można współdzielić między wątkami
+        self._local = threading.local()
+        self._touched = {}
+        self._touched_at = time.monotonic()
+        self._touch_lock = threading.Lock()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+                "size INTEGER NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+            self._local.connection = connection
+        return connection
+
+    def get(self, key):
+        """
+        Zwraca (CompletionResult, pozostały ttl w sekundach) albo None
+        """
+        now = time.time()
+        try:
+            connection = self._connection()
+            row = connection.execute("SELECT value, expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or row[1] <= now:
+                return None
+            fields = json.loads(zlib.decompress(row[0]))
+        except (sqlite3.Error, zlib.error, ValueError) as e:
+            logger.warning(f"⚠️ Odczyt z cache na dysku nie powiódł się: {str(e)}")
+            return None
+        self._touch(key, now)
+        return CompletionResult(**fields), row[1] - now
+
+    def _touch(self, key, now):
+        with self._touch_lock:
+            self._touched[key] = now
+            if time.monotonic() - self._touched_at < self.TOUCH_INTERVAL:
+                return
+            self._touched_at = time.monotonic()
+        try:
+            self._write(self._flush_touched)
+        except sqlite3.Error as e:
+            logger.debug(f"Zapis czasu użycia wpisów cache na dysku nie powiódł się: {str(e)}")
+
+    def _flush_touched(self, connection):
+        with self._touch_lock:
+            touched, self._touched = self._touched, {}
+        connection.executemany("UPDATE responses SET accessed_at = ? WHERE key = ?",
+                               [(accessed_at, key) for key, accessed_at in touched.items()])
+
+    def _write(self, fn):
+        """
+        Wykonuje fn(connection) w transakcji zapisu
+        """
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            fn(connection)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def put(self, key, result, ttl):
+        now = time.time()
+        value = zlib.compress(json.dumps({name: getattr(result, name) for name in CompletionResult.__slots__},
+                                         ensure_ascii=False).encode('utf-8'))
+        if len(value) > self.max_bytes:
+            return False
+        def write(connection):
+            connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                               (key, value, len(value), now + ttl, now))
+            connection.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+            self._flush_touched(connection)
+            self._evict(connection)
+
+        try:
+            self._write(write)
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ Zapis do cache na dysku nie powiódł się: {str(e)}")
+            return False
+        return True
+
+    def _evict(self, connection):
+        excess = connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0] - self.max_bytes
+        if excess <= 0:
+            return
+        evicted = []
+        for key, size in connection.execute("SELECT key, size FROM responses ORDER BY accessed_at"):
+            evicted.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        connection.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def clear(self):
+        try:
+            self._connection().execute("DELETE FROM responses")
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ Czyszczenie cache na dysku nie powiodło się: {str(e)}")
+
+    def stats(self):
+        try:
+            entries, size = self._connection().execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        except sqlite3.Error as e:
+            return {"path": self.path, "error": str(e)}
+        return {"path": self.path, "entries": entries, "bytes": size, "max_bytes": self.max_bytes}
+
+class ResponseCache:
+    """
+    Pamięć podręczna kompletnych odpowiedzi (LRU) z czasem życia zależnym od task_type (RESPONSE_CACHE_TTLS)
+    i limitem łącznego rozmiaru tekstów odpowiedzi w bajtach.
+    Z disk_cache (SQLiteResponseCache) działa jako pierwszy poziom przed trwałym cache na dysku.
+    """
+
+    # Przybliżony narzut wpisu (klucz, metadane) doliczany do rozmiaru tekstu
+    ENTRY_OVERHEAD = 512
+
+    def __init__(self, max_bytes=RESPONSE_CACHE_MAX_BYTES, ttls=None, disk_cache=None):
+        self.max_bytes = max_bytes
+        self.ttls = RESPONSE_CACHE_TTLS if ttls is None else ttls
+        self.disk_cache = disk_cache
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def ttl(self, task_type):
+        return self.ttls.get(task_type, self.ttls.get('default', 0.0))
+
+    def _discard(self, key):
+        # Wywoływane pod blokadą
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    def _memory_get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] <= time.monotonic():
+                self._discard(key)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+        return None
+
+    def _disk_result(self, key, stored):
+        with self._lock:
+            if stored is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        result, ttl = stored
+        self._store(key, result, ttl)
+        return result
+
+    def get(self, key):
+        result = self._memory_get(key)
+        if result is not None:
+            return result
+        return self._disk_result(key, self.disk_cache.get(key) if self.disk_cache is not None else None)
+
+    async def aget(self, key):
+        """
+        Asynchroniczna wersja get() - odczyt z bazy na dysku w wątku roboczym, poza pętlą zdarzeń
+        """
+        result = self._memory_get(key)
+        if result is not None:
+            return result
+        return self._disk_result(key, await asyncio.to_thread(self.disk_cache.get, key)
+                                 if self.disk_cache is not None else None)
+
+    def _store(self, key, result, ttl):
+        size = len(result.text.encode('utf-8')) + self.ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (result, time.monotonic() + ttl, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+
+    def put(self, key, result, task_type):
+        """
+        Zapisuje wynik (CompletionResult); zwraca False, gdy task_type ma wyłączony cache
+        """
+        ttl = self.ttl(task_type)
+        if ttl <= 0:
+            return False
+        self._store(key, result, ttl)
+        if self.disk_cache is not None:
+            self.disk_cache.put(key, result, ttl)
+        return True
+
+    async def aput(self, key, result, task_type):
+        """
+        Asynchroniczna wersja put() - zapis do bazy na dysku (BEGIN IMMEDIATE) w wątku roboczym
+        """
+        ttl = self.ttl(task_type)
+        if ttl <= 0:
+            return False
+        self._store(key, result, ttl)
+        if self.disk_cache is not None:
+            await asyncio.to_thread(self.disk_cache.put, key, result, ttl)
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        if self.disk_cache is not None:
+            self.disk_cache.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = {"entries": len(self._entries), "bytes": self._bytes, "max_bytes": self.max_bytes,
+                     "hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses}
+        if self.disk_cache is not None:
+            stats["disk"] = self.disk_cache.stats()
+        return stats
+
+# Współdzielony cache odpowiedzi modułu - z OPENROUTER_RESPONSE_CACHE_PATH także na dysku
+response_cache = ResponseCache(disk_cache=SQLiteResponseCache(RESPONSE_CACHE_PATH) if RESPONSE_CACHE_PATH else None)
+
+def _response_cache_key(payload, backend, max_total_tokens):
+    """
+    Kanoniczny skrót zapytania - model, prompt systemowy i użytkownika, max_tokens i parametry próbkowania
+    """
+    request = {key: value for key, value in payload.items() if key not in ("metadata", "stream", "usage")}
+    return _request_fingerprint(backend.name, request, max_total_tokens)
+
+class LatencyTracker:
+    """
+    Ostatnie czasy do pierwszego bajtu odpowiedzi (TTFB) dla każdego task_type
+    """
+
+    def __init__(self, window=200):
+        self.window = window
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, task_type, seconds):
+        with self._lock:
+            samples = self._samples.get(task_type)
+            if samples is None:
+                samples = self._samples[task_type] = collections.deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def percentile(self, task_type, fraction, min_samples=1):
+        with self._lock:
+            samples = sorted(self._samples.get(task_type, ()))
+        if len(samples) < max(1, min_samples):
+            return None
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+latency_tracker = LatencyTracker()
+
+class HedgingPolicy:
+    """
+    Gdy pierwszy bajt nie nadejdzie w czasie percentyla ostatnich TTFB danego task_type, wysyłamy
+    duplikat zapytania (opcjonalnie do alternate_model) i bierzemy szybszą odpowiedź.
+    Budżet: każde zapytanie dodaje budget kredytu, hedge zużywa 1 - dodatkowy koszt ≤ budget * 100%.
+    """
+
+    def __init__(self, percentile=HEDGE_PERCENTILE, min_delay=HEDGE_MIN_DELAY, budget=HEDGE_BUDGET,
+                 alternate_model=HEDGE_ALTERNATE_MODEL, min_samples=HEDGE_MIN_SAMPLES, max_burst=5):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.budget = budget
+        self.alternate_model = alternate_model
+        self.min_samples = min_samples
+        self.max_burst = max_burst
+        self._credits = {}
+        self._counters = collections.Counter()
+        self._lock = threading.Lock()
+
+    def hedge_delay(self, task_type):
+        """
+        Opóźnienie, po którym wysyłamy hedge (None - za mało próbek, bez hedgingu)
+        """
+        observed = latency_tracker.percentile(task_type, self.percentile, self.min_samples)
+        return None if observed is None else max(self.min_delay, observed)
+
+    def on_request(self, task_type):
+        with self._lock:
+            self._counters[(task_type, 'requests')] += 1
+            self._credits[task_type] = min(self.max_burst, self._credits.get(task_type, 0.0) + self.budget)
+
+    def try_spend(self, task_type):
+        with self._lock:
+            if self._credits.get(task_type, 0.0) < 1.0:
+                return False
+            self._credits[task_type] -= 1.0
+            self._counters[(task_type, 'hedges')] += 1
+            return True
+
+    def hedge_payload(self, payload):
+        if not self.alternate_model:
+            return payload
+        hedged = dict(payload, model=self.alternate_model)
+        hedged["metadata"] = dict(payload.get("metadata", {}), model_used=self.alternate_model)
+        return hedged
+
+    def stats(self):
+        with self._lock:
+            task_types = {task_type for task_type, _ in self._counters}
+            return {
+                task_type: {
+                    "requests": self._counters[(task_type, 'requests')],
+                    "hedges": self._counters[(task_type, 'hedges')]
+                }
+                for task_type in task_types
+            }
+
+hedging_policy = HedgingPolicy()
+
+def _resolve_hedging(hedge):
+    if hedge is True:
+        return hedging_policy
+    return hedge or None
+
+def _message_text(message):
+    # Treść wiadomości jako tekst lub lista części {"type": "text", "text": ...} (z cache_control)
+    content = message.get("content") or ""
+    if isinstance(content, list):
+        return "".join(part.get("text") or "" for part in content)
+    return content
+
+def _estimate_tokens(payload):
+    """
+    Szacuje koszt zapytania w tokenach: długość wszystkich wiadomości + max_tokens odpowiedzi
+    """
+    prompt_chars = sum(len(_message_text(message)) for message in payload.get("messages", []))
+    return int(prompt_chars / CHARS_PER_TOKEN) + payload.get("max_tokens", 0)
+
+def _actual_tokens(result):
+    usage = result.get('usage') if isinstance(result, dict) else None
+    return usage.get('total_tokens') if isinstance(usage, dict) else None
+
+# SPECJALIZACJE PROMPTU SYSTEMOWEGO DLA TYPÓW ZADAŃ
+TASK_SPECIFIC_PROMPTS = {
+    'cv_optimization': """
+
+🔥 SPECJALIZACJA: OPTYMALIZACJA CV
+- Analizujesz każde słowo pod kątem wpływu na rekrutera
+- Znasz najnowsze trendy w formatowaniu CV
+- Potrafisz dostosować styl do różnych branż i stanowisk
+- Maksymalizujesz szanse przejścia przez filtry ATS
+- Przepisujesz istniejące doświadczenia używając faktów z CV
+- PAMIĘTAJ: Tylko poprawiaj sformułowania, NIE dodawaj nowych firm, stanowisk, dat!""",
+
+    'recruiter_feedback': """
+
+👔 SPECJALIZACJA: OPINIE REKRUTERA
+- Myślisz jak senior recruiter z doświadczeniem w różnych branżach
+- Dostrzegasz detale, które umykają innym
+- Oceniasz CV pod kątem pierwszego wrażenia (6 sekund)
+- Znasz typowe błędy kandydatów i jak ich unikać
+- Potrafisz przewidzieć reakcję hiring managera""",
+
+    'cover_letter': """
+
+📄 SPECJALIZACJA: LISTY MOTYWACYJNE
+- Tworzysz przekonujące narracje osobiste
+- Łączysz doświadczenia kandydata z potrzebami firmy
+- Używasz psychologii przekonywania w copywritingu
+- Dostosowujesz ton do kultury organizacyjnej
+- Unikasz szablonowych zwrotów i klisz""",
+
+    'interview_prep': """
+
+🎤 SPECJALIZACJA: PRZYGOTOWANIE DO ROZMÓW
+- Przewidujesz pytania na podstawie CV i stanowiska
+- Znasz techniki odpowiadania (STAR, CAR)
+- Pomagasz w przygotowaniu historii sukcesu
+- Analizujesz potencjalne słabości i jak je przedstawić
+- Przygotowujesz do różnych typów rozmów (HR, techniczne, z przełożonym)""",
+
+    'cv_improvement': """
+
+🌟 SPECJALIZACJA: POPRAWA CV
+- Skupiasz się na specyficznych aspektach CV (struktura, treść, słowa kluczowe, osiągnięcia)
+- Dostosowujesz podejście do wybranego obszaru poprawy
+- Zapewniasz lepszą prezentację kandydatury
+- Generujesz praktyczne rekomendacje"""
+}
+
+# Language-specific system prompts
+LANGUAGE_SYSTEM_PROMPTS = {
+    'pl': "Jesteś ekspertem w optymalizacji CV i doradcą kariery. ZAWSZE odpowiadaj w języku polskim, niezależnie od języka CV lub opisu pracy. Używaj polskiej terminologii HR i poprawnej polszczyzny. KRYTYCZNE: NIE DODAWAJ żadnych nowych firm, stanowisk, dat ani osiągnięć które nie są w oryginalnym CV - to oszukiwanie kandydata!",
+    'en': "You are an expert resume editor and career advisor. ALWAYS respond in English, regardless of the language of the CV or job description. Use proper English HR terminology and grammar. CRITICAL: DO NOT ADD any new companies, positions, dates or achievements that are not in the original CV - this is deceiving the candidate!"
+}
+
+class PayloadTemplate:
+    """
+    Niezmienna część payloadu dla pary (task_type, language): gotowy prompt systemowy
+    i jego zserializowana wiadomość, wstawiana do treści zapytania bez ponownego kodowania.
+    Prompt systemowy zależy tylko od języka - jest wspólnym prefiksem zapytań wszystkich typów zadań
+    (cache prefiksów u dostawcy), a specjalizacja task_type trafia na koniec wiadomości użytkownika.
+    Wiadomość systemowa jest współdzielona przez wszystkie payloady - nie wolno jej modyfikować.
+    """
+
+    def __init__(self, task_type, language):
+        self.task_type = task_type
+        self.language = language
+        self.system_prompt = DEEP_REASONING_PROMPT + "\n" + LANGUAGE_SYSTEM_PROMPTS[language]
+        self.task_prompt = TASK_SPECIFIC_PROMPTS.get(task_type, "").strip()
+        self.system_message = {"role": "system", "content": self.system_prompt}
+        self._encoded = {}
+
+    def encoded_system_message(self, codec):
+        encoded = self._encoded.get(codec.name)
+        if encoded is None:
+            encoded = self._encoded[codec.name] = codec.dumps(self.system_message)
+        return encoded
+
+# Szablony dla wszystkich specjalizacji i języków budowane przy imporcie modułu
+PAYLOAD_TEMPLATES = {
+    (task_type, language): PayloadTemplate(task_type, language)
+    for task_type in ('default',) + tuple(TASK_SPECIFIC_PROMPTS)
+    for language in LANGUAGE_SYSTEM_PROMPTS
+}
+for _template in PAYLOAD_TEMPLATES.values():
+    _template.encoded_system_message(json_codec)
+
+def get_payload_template(task_type, language='pl'):
+    # Nieznane typy zadań dostają prompt bazowy, nieznane języki - polski
+    if task_type not in TASK_SPECIFIC_PROMPTS:
+        task_type = 'default'
+    if language not in LANGUAGE_SYSTEM_PROMPTS:
+        language = 'pl'
+    return PAYLOAD_TEMPLATES[(task_type, language)]
+
+def _encode_payload(payload):
+    """
+    Serializuje payload kodekiem json_codec - wiadomość systemowa z szablonu jest wklejana jako gotowe bajty
+    """
+    messages = payload.get("messages") or []
+    metadata = payload.get("metadata") or {}
+    template = get_payload_template(metadata.get("task_type"), metadata.get("language"))
+    if not messages or messages[0] is not template.system_message:
+        return json_codec.dumps(payload)
+
+    head = json_codec.dumps({key: value for key, value in payload.items() if key != "messages"})
+    encoded_messages = [template.encoded_system_message(json_codec)]
+    encoded_messages.extend(json_codec.dumps(message) for message in messages[1:])
+    separator = b',' if len(head) > 2 else b''
+    return head[:-1] + separator + b'"messages":[' + b','.join(encoded_messages) + b']}'
+
+def _user_message(prompt, document, model):
+    """
+    Wiadomość użytkownika: najpierw dokument (CV) jako stabilny prefiks, potem instrukcje zadania.
+    Dla modeli z PROMPT_CACHE_CONTROL_MODELS koniec prefiksu oznaczamy znacznikiem cache_control.
+    """
+    if not document:
+        return {"role": "user", "content": prompt}
+    document_block = f"CV KANDYDATA:\n{document}"
+    if model.startswith(PROMPT_CACHE_CONTROL_MODELS):
+        return {"role": "user", "content": [
+            {"type": "text", "text": document_block, "cache_control": {"type": "ephemeral"}},
+            {"type": "text", "text": prompt}
+        ]}
+    return {"role": "user", "content": document_block + "\n\n" + prompt}
+
+def _build_payload(prompt, max_tokens=2000, language='pl', user_tier='free', task_type='default', industry='general',
+                   document=None):
+    """
+    Buduje payload zapytania chat/completions - wspólny dla API synchronicznego i asynchronicznego.
+    Kolejność pod cache prefiksów: stały prompt systemowy, dokument (CV), specjalizacja i instrukcje zadania.
+    """
+    template = get_payload_template(task_type, language)
+    if template.task_prompt:
+        prompt = f"{template.task_prompt}\n\n{prompt}"
+
+    return {
         "model": DEFAULT_MODEL,
         "messages": [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": prompt}
+            template.system_message,
+            _user_message(prompt, document, DEFAULT_MODEL)
         ],
         "max_tokens": max_tokens,
         "temperature": 0.3,
@@ -124,31 +2499,1022 @@ def send_api_request(prompt, max_tokens=2000, language='pl', user_tier='free', t
         }
     }
 
+def _parse_completion(result):
+    # OpenRouter potrafi zwrócić błąd dostawcy w treści odpowiedzi HTTP 200
+    if isinstance(result, dict) and isinstance(result.get('error'), dict):
+        error = result['error']
+        code = error.get('code')
+        raise _status_error(code if isinstance(code, int) else 502, None, error.get('message', error))
+
+    try:
+        if 'choices' in result and len(result['choices']) > 0:
+            return result['choices'][0]['message']['content']
+    except (KeyError, IndexError, TypeError) as e:
+        raise BadResponseError(f"Failed to parse OpenRouter API response: {str(e)}")
+    raise BadResponseError("Failed to parse OpenRouter API response: Unexpected API response format")
+
+def _decode_completion(response):
+    try:
+        return json_codec.loads(response.content)
+    except ValueError as e:
+        raise BadResponseError(f"Failed to parse OpenRouter API response: {str(e)}")
+
+def _finish_reason(result):
+    try:
+        return result['choices'][0].get('finish_reason')
+    except (KeyError, IndexError, TypeError, AttributeError):
+        return None
+
+def _completion_tokens(result, text):
+    usage = result.get('usage') if isinstance(result, dict) else None
+    if isinstance(usage, dict) and isinstance(usage.get('completion_tokens'), int):
+        return usage['completion_tokens']
+    return int(len(text) / CHARS_PER_TOKEN)
+
+def _continuation_tokens(result, produced_tokens, max_tokens, max_total_tokens, piece_tokens, piece_budget,
+                         continuations):
+    """
+    Limit tokenów następnej części odpowiedzi albo 0, gdy odpowiedź jest kompletna, wyczerpano limit łączny
+    lub CONTINUATION_MAX_ROUNDS albo ostatnia część (piece_tokens) była dużo krótsza niż jej limit (piece_budget)
+    """
+    if _finish_reason(result) != "length":
+        return 0
+    if continuations >= CONTINUATION_MAX_ROUNDS:
+        logger.warning(f"Response still cut off after {continuations} continuations, returning it truncated")
+        return 0
+    if piece_tokens < piece_budget * CONTINUATION_MIN_ROUND_RATIO:
+        logger.warning(f"Response cut off after {piece_tokens}/{piece_budget} tokens, not continuing")
+        return 0
+    return max(0, min(max_tokens, max_total_tokens - produced_tokens))
+
+def _continue_payload(payload, text):
+    """
+    Odsyła dotychczasową odpowiedź jako wiadomość asystenta - model dopisuje ją od miejsca ucięcia
+    """
+    messages = payload["messages"]
+    if messages[-1]["role"] == "assistant":
+        messages[-1] = {"role": "assistant", "content": text}
+    else:
+        messages.append({"role": "assistant", "content": text})
+
+class CompletionResult:
+    """
+    Szczegółowy wynik zapytania (detailed=True w send_api_request): tekst odpowiedzi, zużycie tokenów,
+    czas całkowity i do pierwszego bajtu, model i dostawca, który faktycznie odpowiedział, liczba ponowień
+    i kontynuacji oraz status cache. str(result) zwraca sam tekst.
+    """
+
+    __slots__ = ('text', 'model', 'provider', 'finish_reason', 'prompt_tokens', 'completion_tokens', 'wall_time',
+                 'ttfb', 'retries', 'continuations', 'cache_status', 'backend')
+
+    def __init__(self, text="", model=None, provider=None, finish_reason=None, prompt_tokens=0, completion_tokens=0,
+                 wall_time=0.0, ttfb=None, retries=0, continuations=0, cache_status="miss", backend=None):
+        self.text = text
+        self.model = model
+        self.provider = provider
+        self.finish_reason = finish_reason
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.wall_time = wall_time
+        self.ttfb = ttfb
+        self.retries = retries
+        self.continuations = continuations
+        self.cache_status = cache_status
+        self.backend = backend
+
+    @property
+    def total_tokens(self):
+        return self.prompt_tokens + self.completion_tokens
+
+    def as_dict(self):
+        details = {name: getattr(self, name) for name in self.__slots__}
+        details["total_tokens"] = self.total_tokens
+        return details
+
+    def replace(self, **changes):
+        """
+        Kopia wyniku ze zmienionymi polami
+        """
+        fields = {name: getattr(self, name) for name in self.__slots__}
+        fields.update(changes)
+        return CompletionResult(**fields)
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return (f"CompletionResult(model={self.model!r}, finish_reason={self.finish_reason!r}, "
+                f"tokens={self.prompt_tokens}+{self.completion_tokens}, wall_time={self.wall_time:.3f}, "
+                f"retries={self.retries}, cache_status={self.cache_status!r}, text={self.text[:40]!r})")
+
+def _caller_copy(result):
+    """
+    Wynik współdzielony z innymi wywołującymi (single-flight, idempotencja) - CompletionResult jest zmienny,
+    więc każdy wywołujący dostaje własną kopię
+    """
+    return result.replace() if isinstance(result, CompletionResult) else result
+
+def _cached_completion(cached, detailed, started):
+    if not detailed:
+        return cached.text
+    # Odpowiedź z cache nie zużywa tokenów ani nie czeka na upstream
+    return cached.replace(prompt_tokens=0, completion_tokens=0, ttfb=None, retries=0, cache_status="hit",
+                          wall_time=time.monotonic() - started)
+
+def _record_completion(details, result, response):
+    """
+    Dolicza do CompletionResult zużycie i metadane jednej odpowiedzi (pierwszej albo kontynuacji)
+    """
+    usage = result.get('usage') if isinstance(result, dict) else None
+    if isinstance(usage, dict):
+        details.prompt_tokens += usage.get('prompt_tokens') or 0
+        details.completion_tokens += usage.get('completion_tokens') or 0
+    details.model = result.get('model') or details.model
+    details.provider = result.get('provider') or details.provider
+    details.finish_reason = _finish_reason(result)
+    if details.ttfb is None:
+        details.ttfb = getattr(response, 'ttfb', None)
+
+def _resolve_send_options(task_type, backend, deadline, max_tokens, max_total_tokens, stream, detailed,
+                          idempotency_key):
+    """
+    Wspólna walidacja argumentów send_api_request() i async_send_api_request(); zwraca deadline, backend
+    i max_total_tokens (domyślnie max_tokens pierwszego zapytania plus CONTINUATION_MAX_TOKENS)
+    """
+    if stream and detailed:
+        raise ValueError("detailed=True is not supported with stream=True")
+    if stream and idempotency_key is not None:
+        raise ValueError("idempotency_key is not supported with stream=True")
+    if max_total_tokens is None:
+        max_total_tokens = max_tokens + CONTINUATION_MAX_TOKENS if CONTINUATION_MAX_TOKENS > 0 else 0
+    return _resolve_deadline(deadline), get_backend(task_type, backend), max_total_tokens
+
+class _CompletionCall:
+    """
+    Kroki jednego wywołania wspólne dla wersji sync i async (poza samym wysyłaniem): klucz cache, max_tokens
+    kolejnych prób, doklejanie kontynuacji uciętej odpowiedzi i szczegółowy wynik
+    """
+
+    def __init__(self, payload, backend, deadline, max_tokens, max_total_tokens, task_type, stream, cache):
+        self.payload = payload
+        self.backend = backend
+        self.deadline = deadline
+        self.max_tokens = max_tokens
+        self.max_total_tokens = max_total_tokens
+        self.cache = cache
+        self.started = time.monotonic()
+        self.cache_key = None
+        if not stream and response_cache.ttl(task_type) > 0:
+            self.cache_key = _response_cache_key(payload, backend, max_total_tokens)
+        self.estimated_tokens = _estimate_tokens(payload)
+        self.round_tokens = max_tokens
+        self.attempts = 0
+        self.rounds = 1
+        self.text = ""
+        self.produced_tokens = 0
+        self.details = CompletionResult(backend=backend.name)
+
+    def lookup_key(self):
+        """
+        Klucz, pod którym szukamy odpowiedzi w cache, albo None (strumień, TTL 0 lub cache=False)
+        """
+        return self.cache_key if self.cache else None
+
+    def cached(self, cached, detailed):
+        return _cached_completion(cached, detailed, self.started)
+
+    def next_attempt(self):
+        """
+        Payload kolejnej próby z max_tokens przyciętym do deadline
+        """
+        self.attempts += 1
+        round_tokens = self.round_tokens
+        self.payload["max_tokens"] = self.deadline.max_tokens(round_tokens) if self.deadline else round_tokens
+        return self.payload
+
+    def add_response(self, response):
+        """
+        Dolicza odpowiedź (pierwszą albo kontynuację) i ustala limit następnej części
+        """
+        result = _decode_completion(response)
+        self.backend.reconcile(response, self.estimated_tokens, _actual_tokens(result))
+        piece = _parse_completion(result)
+        continuation = self.rounds > 1
+        if continuation and not piece:
+            self.round_tokens = 0
+            return
+        self.text += piece
+        piece_tokens = _completion_tokens(result, piece)
+        self.produced_tokens += piece_tokens
+        _record_completion(self.details, result, response)
+        if continuation:
+            self.details.continuations += 1
+        if self.payload["max_tokens"] < self.round_tokens and _finish_reason(result) == "length":
+            # Limit przyciął deadline - kolejna runda i tak by się w nim nie zmieściła
+            logger.warning(f"Response cut off by the deadline after {piece_tokens} tokens, returning it truncated")
+            self.round_tokens = 0
+            return
+        # Ucięta odpowiedź - płacimy tylko za brakujący fragment zamiast ponawiać całe zapytanie
+        self.round_tokens = _continuation_tokens(result, self.produced_tokens, self.max_tokens, self.max_total_tokens,
+                                                 piece_tokens, self.payload["max_tokens"], self.details.continuations)
+
+    def continue_round(self):
+        """
+        Przygotowuje zapytanie o dalszą część uciętej odpowiedzi; False, gdy nie ma czego kontynuować
+        """
+        if not self.round_tokens:
+            return False
+        logger.info(f"Response cut off by max_tokens, continuing "
+                    f"({self.produced_tokens}/{self.max_total_tokens} tokens)")
+        _continue_payload(self.payload, self.text)
+        self.estimated_tokens = _estimate_tokens(self.payload)
+        self.rounds += 1
+        return True
+
+    def finish(self):
+        details = self.details
+        details.text = self.text
+        details.retries = self.attempts - self.rounds
+        details.wall_time = time.monotonic() - self.started
+        if not self.cache:
+            details.cache_status = "bypass"
+        return details
+
+    def cache_entry(self):
+        """
+        Kopia wyniku do zapisania w cache albo None - ucięte odpowiedzi (np. przez deadline) nie trafiają do cache
+        """
+        if self.cache_key is None or self.details.finish_reason == "length":
+            return None
+        return self.details.replace()
+
+class _SSEDecoder:
+    """
+    Składa pola "data:" strumienia Server-Sent Events w kompletne zdarzenia
+    """
+
+    def __init__(self):
+        self._data_lines = []
+        self.done = False
+
+    def feed(self, line):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.rstrip('\r')
+
+        if not line:
+            return self.flush()
+
+        # Linie komentarzy (np. ": OPENROUTER PROCESSING") służą tylko do podtrzymania połączenia
+        if line.startswith(':'):
+            return None
+
+        field, _, value = line.partition(':')
+        if field == 'data':
+            self._data_lines.append(value[1:] if value.startswith(' ') else value)
+        return None
+
+    def flush(self):
+        if not self._data_lines:
+            return None
+
+        data = '\n'.join(self._data_lines)
+        self._data_lines = []
+        if data == '[DONE]':
+            self.done = True
+            return None
+        return data
+
+def _iter_sse_data(lines):
+    decoder = _SSEDecoder()
+    for line in lines:
+        data = decoder.feed(line)
+        if decoder.done:
+            return
+        if data is not None:
+            yield data
+
+    data = decoder.flush()
+    if data is not None:
+        yield data
+
+async def _aiter_sse_data(lines):
+    decoder = _SSEDecoder()
+    async for line in lines:
+        data = decoder.feed(line)
+        if decoder.done:
+            return
+        if data is not None:
+            yield data
+
+    data = decoder.flush()
+    if data is not None:
+        yield data
+
+class _BaseCompletionStream:
+    """
+    Wspólna logika strumienia odpowiedzi - interpretacja fragmentów chat.completion.chunk
+    """
+
+    def __init__(self, response, deadline=None, limiter=None, on_close=None):
+        self._response = response
+        self._deadline = deadline
+        self._limiter = limiter
+        self._on_close = on_close
+        self._chunks = []
+        self.finish_reason = None
+        self.usage = None
+        self.model = None
+        self._slot_released = False
+
+    def _release_slot(self):
+        # Strumień zajmuje miejsce w limicie współbieżności aż do zamknięcia
+        if not self._slot_released:
+            self._slot_released = True
+            if self._limiter is not None:
+                self._limiter.release()
+            if self._on_close is not None:
+                self._on_close()
+
+    def __del__(self):
+        self._release_slot()
+
+    @property
+    def text(self):
+        return ''.join(self._chunks)
+
+    def _consume(self, data):
+        if self._deadline is not None:
+            self._deadline.check("reading the rest of the stream")
+        try:
+            chunk = json_codec.loads(data)
+        except ValueError as e:
+            raise BadResponseError(f"Failed to parse OpenRouter API response: {str(e)}")
+
+        if 'error' in chunk:
+            error = chunk['error']
+            message = error.get('message', error) if isinstance(error, dict) else error
+            code = error.get('code') if isinstance(error, dict) else None
+            raise _status_error(code if isinstance(code, int) else 502, None, message,
+                                prefix="OpenRouter API stream error")
+
+        self.model = chunk.get('model', self.model)
+        if chunk.get('usage'):
+            self.usage = chunk['usage']
+
+        delta_text = ""
+        for choice in chunk.get('choices') or []:
+            delta_text += (choice.get('delta') or {}).get('content') or ""
+            if choice.get('finish_reason'):
+                self.finish_reason = choice['finish_reason']
+
+        if delta_text:
+            self._chunks.append(delta_text)
+        return delta_text
+
+class CompletionStream(_BaseCompletionStream):
+    """
+    Generator przyrostów tekstu odpowiedzi (stream=True w send_api_request).
+    Po wyczerpaniu udostępnia text, finish_reason, usage i model.
+    """
+
+    def __init__(self, response, deadline=None, limiter=None, on_close=None):
+        super().__init__(response, deadline, limiter, on_close)
+        self._iterator = self._iter_deltas()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._iterator)
+
+    def _iter_deltas(self):
+        try:
+            for data in _iter_sse_data(self._response.iter_lines(decode_unicode=True)):
+                delta_text = self._consume(data)
+                if delta_text:
+                    yield delta_text
+        except _sync_transport_errors() as e:
+            logger.error(f"API stream failed: {str(e)}")
+            raise _transport_error(e)
+        except (KeyError, TypeError, AttributeError) as e:
+            logger.error(f"Error parsing API stream: {str(e)}")
+            raise BadResponseError(f"Failed to parse OpenRouter API response: {str(e)}")
+        finally:
+            self._response.close()
+            self._release_slot()
+
+    def close(self):
+        self._iterator.close()
+        self._response.close()
+        self._release_slot()
+
+    def __del__(self):
+        # Porzucony, niedoczytany strumień - zamykamy też połączenie, zamiast czekać, aż posprząta je pula
+        if not self._slot_released:
+            self._response.close()
+        super().__del__()
+
+class AsyncCompletionStream(_BaseCompletionStream):
+    """
+    Asynchroniczny odpowiednik CompletionStream (async for delta in stream)
+    """
+
+    def __init__(self, response, deadline=None, limiter=None, on_close=None):
+        super().__init__(response, deadline, limiter, on_close)
+        self._iterator = self._iter_deltas()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self._iterator.__anext__()
+
+    async def _iter_deltas(self):
+        try:
+            async for data in _aiter_sse_data(self._response.aiter_lines()):
+                delta_text = self._consume(data)
+                if delta_text:
+                    yield delta_text
+        except httpx.HTTPError as e:
+            logger.error(f"API stream failed: {str(e)}")
+            raise _transport_error(e)
+        except (KeyError, TypeError, AttributeError) as e:
+            logger.error(f"Error parsing API stream: {str(e)}")
+            raise BadResponseError(f"Failed to parse OpenRouter API response: {str(e)}")
+        finally:
+            await self._response.aclose()
+            self._release_slot()
+
+    async def aclose(self):
+        await self._iterator.aclose()
+        await self._response.aclose()
+        self._release_slot()
+
+def _enable_streaming(payload):
+    payload["stream"] = True
+    # Zużycie tokenów w ostatnim fragmencie strumienia
+    payload["usage"] = {"include": True}
+    return payload
+
+def _post_completion(payload, stream=False, timeout=None, estimated_tokens=0, rate_limit_wait=None, deadline=None,
+                     backend=None):
+    """
+    Pojedyncza próba wysłania zapytania - błędy HTTP i sieci zamieniane na typowane wyjątki.
+    Przy stream=True zwraca odpowiedź przed odczytaniem treści i nie zwalnia miejsca
+    w concurrency_limiter - robi to wywołujący po skończeniu odczytu.
+    Oczekiwanie na limitery i timeout zapytania są przycinane do pozostałego czasu z deadline.
+    backend (domyślnie OpenRouter) dostarcza klienta HTTP, nagłówki z kluczem i limit współbieżności.
+    """
+    backend = backend or openrouter_backend
+    limiter = backend.concurrency_limiter
+    task_type = payload["metadata"]["task_type"]
+    user_tier = payload["metadata"]["user_tier"]
+    body = backend.prepare_payload(payload)
+    breaker = circuit_breakers.get(body["model"], backend.client.base_url)
+    breaker.before_call()
+    started = time.monotonic()
+    api_key = None
+    slot_acquired = False
+
+    try:
+        if deadline is not None:
+            deadline.check()
+            rate_limit_wait = deadline.wait(rate_limit_wait)
+        api_key = limiter.acquire(deadline.remaining() if deadline is not None else None, task_type, user_tier,
+                                  backend.credentials, estimated_tokens, rate_limit_wait)
+        slot_acquired = True
+        if deadline is not None:
+            timeout = deadline.timeout(timeout)
+        started = time.monotonic()
+        try:
+            response = backend.client.post(body, request_headers=api_key.headers, stream=stream, timeout=timeout)
+        except _sync_transport_errors() as e:
+            raise _transport_error(e)
+
+        if response.status_code >= 400:
+            error = _status_error(response.status_code, response.headers, _error_detail(response))
+            response.close()
+            raise error
+    except UpstreamError as e:
+        breaker.record_error(e, time.monotonic() - started)
+        if api_key is not None:
+            backend.credentials.on_error(api_key, e)
+            # Bez odpowiedzi nie powstała żadna treść - cały szacunek wraca do kubełka TPM klucza
+            backend.credentials.reconcile(api_key, estimated_tokens, 0)
+        if slot_acquired:
+            limiter.on_error(e)
+            limiter.release()
+        raise
+    except BaseException:
+        breaker.record_error(None, time.monotonic() - started)
+        if api_key is not None:
+            backend.credentials.reconcile(api_key, estimated_tokens, 0)
+        if slot_acquired:
+            limiter.release()
+        raise
+
+    latency = time.monotonic() - started
+    breaker.record_success(latency)
+    backend.credentials.on_success(api_key)
+    limiter.on_success(task_type, latency)
+    if not stream:
+        limiter.release()
+    # Klucz, którym wysłano zapytanie - do rozliczenia faktycznego zużycia tokenów
+    response.api_key = api_key
+    # response.elapsed to czas do otrzymania nagłówków odpowiedzi (TTFB)
+    response.ttfb = response.elapsed.total_seconds()
+    latency_tracker.record(task_type, response.ttfb)
+    return response
+
+_hedge_executor = None
+_hedge_executor_lock = threading.Lock()
+
+def _get_hedge_executor():
+    global _hedge_executor
+    if _hedge_executor is None:
+        with _hedge_executor_lock:
+            if _hedge_executor is None:
+                _hedge_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=HEDGE_MAX_WORKERS, thread_name_prefix="openrouter-hedge"
+                )
+    return _hedge_executor
+
+class _HedgeAttempt:
+    """
+    Jedno z równoległych zapytań hedgingu wykonywane w puli wątków; cancel() zamyka jego połączenie
+    """
+
+    def __init__(self, payload, timeout, estimated_tokens, rate_limit_wait, deadline=None, backend=None):
+        self.first_byte = threading.Event()
+        self._cancelled = False
+        self._response = None
+        self._lock = threading.Lock()
+        self._backend = backend or openrouter_backend
+        self.future = _get_hedge_executor().submit(self._run, payload, timeout, estimated_tokens, rate_limit_wait,
+                                                   deadline)
+
+    def _run(self, payload, timeout, estimated_tokens, rate_limit_wait, deadline):
+        try:
+            # stream=True - wracamy po nagłówkach, treść czytamy osobno, żeby dało się ją przerwać
+            response = _post_completion(payload, True, timeout, estimated_tokens, rate_limit_wait, deadline,
+                                        self._backend)
+        finally:
+            self.first_byte.set()
+
+        try:
+            with self._lock:
+                self._response = response
+                cancelled = self._cancelled
+            if cancelled:
+                response.close()
+                return None
+
+            try:
+                response.content
+            except _sync_transport_errors() as e:
+                raise _transport_error(e)
+            return response
+        finally:
+            self._backend.concurrency_limiter.release()
+
+    def cancel(self):
+        with self._lock:
+            self._cancelled = True
+            response = self._response
+        self.future.cancel()
+        if response is not None:
+            response.close()
+
+def _hedged_post_completion(payload, policy, timeout=None, estimated_tokens=0, rate_limit_wait=None, deadline=None,
+                            backend=None):
+    """
+    Zapytanie z hedgingiem - po przekroczeniu progu TTFB wysyła duplikat i zwraca szybszą odpowiedź
+    """
+    task_type = payload["metadata"]["task_type"]
+    policy.on_request(task_type)
+    delay = policy.hedge_delay(task_type)
+    if delay is None:
+        return _post_completion(payload, False, timeout, estimated_tokens, rate_limit_wait, deadline, backend)
+
+    primary = _HedgeAttempt(payload, timeout, estimated_tokens, rate_limit_wait, deadline, backend)
+    if primary.first_byte.wait(delay) or not policy.try_spend(task_type):
+        return primary.future.result()
+
+    logger.info(f"⏱️ Brak odpowiedzi od {delay:.1f}s ({task_type}) - wysyłam zapytanie zabezpieczające")
+    hedge = _HedgeAttempt(policy.hedge_payload(payload), timeout, estimated_tokens, rate_limit_wait, deadline, backend)
+
+    pending = {primary.future: primary, hedge.future: hedge}
+    first_error = None
+    while pending:
+        done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            pending.pop(future)
+            try:
+                response = future.result()
+            except UpstreamError as e:
+                first_error = first_error or e
+                continue
+            for loser in pending.values():
+                loser.cancel()
+            return response
+    raise first_error
+
+# BACKENDY ZAPYTAŃ - OpenRouter, dowolny serwer zgodny z OpenAI oraz backend w pamięci do testów
+
+class _StaticCredentials:
+    """
+    Stałe nagłówki zamiast puli kluczy - dla serwerów bez limitów po stronie klienta
+    """
+
+    def __init__(self, request_headers):
+        self.headers = request_headers
+
+    def acquire(self, tokens=0, wait=None):
+        return self
+
+    async def acquire_async(self, tokens=0, wait=None):
+        return self
+
+    def on_success(self, key):
+        pass
+
+    def on_error(self, key, error):
+        pass
+
+    def reconcile(self, key, estimated_tokens, actual_tokens):
+        pass
+
+# Bez nagłówków - AdaptiveConcurrencyLimiter.acquire() wywołany bez puli kluczy
+_no_credentials = _StaticCredentials(None)
+
+class OpenAICompatibleBackend:
+    """
+    Backend dla serwera zgodnego z OpenAI Chat Completions (llama.cpp, vLLM, ...).
+    Ma własnego klienta HTTP, limit współbieżności i circuit breaker (model@base_url),
+    bez puli kluczy i limitów RPM/TPM. model nadpisuje model z payloadu.
+    """
+
+    supports_hedging = True
+
+    def __init__(self, base_url, api_key=None, model=None, name="openai_compatible", transport=None):
+        self.name = name
+        self.model = model
+        self.client = create_client(transport, base_url)
+        self.async_client = AsyncOpenRouterClient(base_url=base_url,
+                                                  http2=(transport or HTTP_TRANSPORT).lower() == "http2")
+        request_headers = {"Content-Type": "application/json"}
+        if api_key:
+            request_headers["Authorization"] = f"Bearer {api_key}"
+        self.credentials = _StaticCredentials(request_headers)
+        self.concurrency_limiter = AdaptiveConcurrencyLimiter()
+
+    def prepare_payload(self, payload):
+        """
+        Usuwa pola specyficzne dla OpenRouter (metadata, usage) - zużycie tokenów w strumieniu przez stream_options
+        """
+        body = {key: value for key, value in payload.items() if key not in ("metadata", "usage")}
+        if self.model:
+            body["model"] = self.model
+        if payload.get("stream"):
+            body["stream_options"] = {"include_usage": True}
+        return body
+
+    def post(self, payload, stream=False, timeout=None, estimated_tokens=0, rate_limit_wait=None, deadline=None):
+        return _post_completion(payload, stream, timeout, estimated_tokens, rate_limit_wait, deadline, self)
+
+    async def apost(self, payload, stream=False, timeout=None, estimated_tokens=0, rate_limit_wait=None, deadline=None):
+        return await _apost_completion(payload, stream, timeout, estimated_tokens, rate_limit_wait, deadline, self)
+
+    def reconcile(self, response, estimated_tokens, actual_tokens):
+        self.credentials.reconcile(response.api_key, estimated_tokens, actual_tokens)
+
+class OpenRouterBackend(OpenAICompatibleBackend):
+    """
+    Domyślny backend - OpenRouter z pulą kluczy API, współdzielonymi klientami modułu
+    i procesowym concurrency_limiter
+    """
+
+    def __init__(self):
+        self.name = "openrouter"
+        self.model = None
+        self.concurrency_limiter = concurrency_limiter
+
+    # Klienci i pula kluczy czytani z modułu przy każdym zapytaniu - można je podmienić w trakcie działania
+    @property
+    def client(self):
+        return client
+
+    @property
+    def async_client(self):
+        return async_client
+
+    @property
+    def credentials(self):
+        return api_key_pool
+
+    def prepare_payload(self, payload):
+        return payload
+
+    def _check_api_keys(self):
+        if not api_key_pool:
+            logger.error(API_KEY_ERROR_MESSAGE)
+            raise ValueError(API_KEY_ERROR_MESSAGE)
+
+    def post(self, payload, stream=False, timeout=None, estimated_tokens=0, rate_limit_wait=None, deadline=None):
+        self._check_api_keys()
+        return super().post(payload, stream, timeout, estimated_tokens, rate_limit_wait, deadline)
+
+    async def apost(self, payload, stream=False, timeout=None, estimated_tokens=0, rate_limit_wait=None, deadline=None):
+        self._check_api_keys()
+        return await super().apost(payload, stream, timeout, estimated_tokens, rate_limit_wait, deadline)
+
+class _FakeResponse:
+    """
+    Odpowiedź FakeBackend z interfejsem odpowiedzi HTTP używanym przez moduł (treść JSON lub strumień SSE)
+    """
+
+    def __init__(self, payload, text):
+        self._payload = payload
+        # Jak prawdziwy model - odpowiedź dłuższa niż max_tokens jest ucinana z finish_reason "length"
+        limit = payload.get("max_tokens") or 0
+        self._finish_reason = "stop"
+        if limit and len(text) > limit * CHARS_PER_TOKEN:
+            text = text[:int(limit * CHARS_PER_TOKEN)]
+            self._finish_reason = "length"
+        self._text = text
+        self.status_code = 200
+        self.headers = {}
+        self.encoding = 'utf-8'
+        self.elapsed = datetime.timedelta(0)
+        self.ttfb = 0.0
+        self.api_key = None
+
+    def _usage(self):
+        prompt_tokens = _estimate_tokens(dict(self._payload, max_tokens=0))
+        completion_tokens = int(len(self._text) / CHARS_PER_TOKEN)
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens}
+
+    @property
+    def content(self):
+        return json_codec.dumps({
+            "model": self._payload["model"],
+            "choices": [{"message": {"role": "assistant", "content": self._text},
+                         "finish_reason": self._finish_reason}],
+            "usage": self._usage()
+        })
+
+    def _sse_lines(self):
+        for index, word in enumerate(self._text.split(" ")):
+            chunk = {"model": self._payload["model"],
+                     "choices": [{"delta": {"content": (" " if index else "") + word}, "finish_reason": None}]}
+            yield "data: " + json_codec.dumps(chunk).decode('utf-8')
+            yield ""
+        chunk = {"choices": [{"delta": {}, "finish_reason": self._finish_reason}], "usage": self._usage()}
+        yield "data: " + json_codec.dumps(chunk).decode('utf-8')
+        yield ""
+        yield "data: [DONE]"
+        yield ""
+
+    def iter_lines(self, decode_unicode=False):
+        return self._sse_lines()
+
+    async def aiter_lines(self):
+        for line in self._sse_lines():
+            yield line
+
+    def close(self):
+        pass
+
+    async def aclose(self):
+        pass
+
+class FakeBackend:
+    """
+    Backend w pamięci do testów offline - nie wysyła zapytań sieciowych. Moduł go nie rejestruje:
+    testy przekazują obiekt w backend= albo rejestrują go same (register_backend).
+    responses: tekst, lista tekstów/wyjątków zwracanych kolejno albo funkcja payload -> tekst;
+    domyślnie zwraca treść ostatniej wiadomości. Odpowiedź dłuższa niż max_tokens jest ucinana
+    (finish_reason "length"). Wysłane payloady trafiają do requests.
+    """
+
+    supports_hedging = False
+    concurrency_limiter = None
+
+    def __init__(self, responses=None, latency=0.0, name="fake"):
+        self.name = name
+        self.responses = responses
+        self.latency = latency
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def _reply(self, payload):
+        with self._lock:
+            # Kopia - kontynuacje dopisują wiadomości do tego samego payloadu
+            self.requests.append(dict(payload, messages=list(payload["messages"])))
+            responses = self.responses
+            if responses is None:
+                return _message_text(payload["messages"][-1])
+            if callable(responses):
+                return responses(payload)
+            if isinstance(responses, list):
+                return responses.pop(0) if len(responses) > 1 else responses[0]
+            return responses
+
+    def _respond(self, payload, deadline):
+        if deadline is not None:
+            deadline.check()
+        reply = self._reply(payload)
+        if isinstance(reply, BaseException):
+            raise reply
+        return _FakeResponse(payload, reply)
+
+    def post(self, payload, stream=False, timeout=None, estimated_tokens=0, rate_limit_wait=None, deadline=None):
+        if self.latency:
+            time.sleep(self.latency)
+        return self._respond(payload, deadline)
+
+    async def apost(self, payload, stream=False, timeout=None, estimated_tokens=0, rate_limit_wait=None, deadline=None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._respond(payload, deadline)
+
+    def reconcile(self, response, estimated_tokens, actual_tokens):
+        pass
+
+openrouter_backend = OpenRouterBackend()
+
+# Zarejestrowane backendy - nazwy używane w BACKEND_ROUTES i opcji backend=
+completion_backends = {openrouter_backend.name: openrouter_backend}
+
+def register_backend(backend, task_types=()):
+    """
+    Rejestruje backend pod backend.name i opcjonalnie kieruje do niego podane typy zadań
+    """
+    completion_backends[backend.name] = backend
+    for task_type in task_types:
+        BACKEND_ROUTES[task_type] = backend.name
+    return backend
+
+def get_backend(task_type='default', backend=None):
+    """
+    Backend dla zapytania: jawnie podany (nazwa lub obiekt), przypisany do task_type albo OpenRouter
+    """
+    if backend is None:
+        backend = BACKEND_ROUTES.get(task_type, openrouter_backend.name)
+    if isinstance(backend, str):
+        try:
+            return completion_backends[backend]
+        except KeyError:
+            raise ValueError(f"Nieznany backend: {backend} (zarejestrowane: {', '.join(completion_backends)})")
+    return backend
+
+if OPENAI_COMPATIBLE_BASE_URL:
+    register_backend(OpenAICompatibleBackend(OPENAI_COMPATIBLE_BASE_URL, OPENAI_COMPATIBLE_API_KEY,
+                                             OPENAI_COMPATIBLE_MODEL))
+
+def send_api_request(prompt, max_tokens=2000, language='pl', user_tier='free', task_type='default', industry='general',
+                     stream=False, timeout=None, max_retries=None, rate_limit_wait=None, hedge=False,
+                     idempotency_key=None, deadline=None, backend=None, max_total_tokens=None, detailed=False,
+                     cache=True, coalesce=True, document=None):
+    """
+    Send a request to the OpenRouter API with enhanced configuration.
+    With stream=True returns a CompletionStream yielding text deltas as they arrive.
+    timeout is a (connect, read) pair or a number of seconds; max_retries=0 fails fast.
+    Raises UpstreamError subclasses (RateLimitedError, UpstreamTimeoutError, UpstreamServerError,
+    CircuitOpenError when the upstream circuit breaker is open, ...).
+    rate_limit_wait bounds the wait for the client-side rate limiter: None blocks,
+    0 rejects immediately with RateLimitExceededError, N waits at most N seconds.
+    hedge=True (or a HedgingPolicy) sends a duplicate request when the first one is slow;
+    hedging applies to non-streamed requests only.
+    Calls repeated with the same idempotency_key within IDEMPOTENCY_TTL attach to the
+    in-flight call or return its stored result instead of calling the API again.
+    deadline (a Deadline or seconds from now) bounds the whole call, retries and waits included;
+    timeouts and max_tokens shrink to fit and DeadlineExceededError is raised once it runs out.
+    backend (a registered name or a backend object) overrides the backend routed for task_type.
+    A non-streamed answer cut off by max_tokens is continued with follow-up requests and stitched
+    together, up to max_total_tokens completion tokens in all (by default max_tokens plus
+    CONTINUATION_MAX_TOKENS, 0 disables) and CONTINUATION_MAX_ROUNDS follow-up requests.
+    An answer cut off because the deadline shrank max_tokens is returned truncated, not continued.
+    detailed=True returns a CompletionResult (token usage, wall time, TTFB, served model, retries,
+    cache status) instead of the plain response text; it applies to non-streamed requests only.
+    Complete non-streamed answers are cached in response_cache for the task_type TTL (RESPONSE_CACHE_TTLS);
+    cache=False bypasses the lookup and refreshes the cached answer.
+    Concurrent identical non-streamed calls (with the same cache flag) share one upstream call and its
+    result or exception unless coalesce=False; if the shared call is cancelled, a waiting caller takes it over.
+    document (the CV) is sent ahead of the prompt so that calls about one CV share a cacheable prefix
+    with the provider; the prompt itself should only hold the task instructions.
+    """
+    deadline, backend, max_total_tokens = _resolve_send_options(task_type, backend, deadline, max_tokens,
+                                                                max_total_tokens, stream, detailed, idempotency_key)
+    if idempotency_key is not None:
+        return _caller_copy(idempotency_store.run(
+            idempotency_key,
+            _request_fingerprint(prompt, max_tokens, language, user_tier, task_type, industry, max_total_tokens,
+                                 detailed, document),
+            lambda: send_api_request(prompt, max_tokens, language, user_tier, task_type, industry, timeout=timeout,
+                                     max_retries=max_retries, rate_limit_wait=rate_limit_wait, hedge=hedge,
+                                     deadline=deadline, backend=backend, max_total_tokens=max_total_tokens,
+                                     detailed=detailed, cache=cache, document=document),
+            deadline))
+    if coalesce and not stream:
+        return _caller_copy(single_flight.do(
+            _request_fingerprint("send_api_request", backend.name, prompt, max_tokens, language, user_tier, task_type,
+                                 industry, max_total_tokens, detailed, cache, document),
+            lambda: send_api_request(prompt, max_tokens, language, user_tier, task_type, industry, timeout=timeout,
+                                     max_retries=max_retries, rate_limit_wait=rate_limit_wait, hedge=hedge,
+                                     deadline=deadline, backend=backend, max_total_tokens=max_total_tokens,
+                                     detailed=detailed, cache=cache, coalesce=False, document=document),
+            deadline))
+
+    payload = _build_payload(prompt, max_tokens, language, user_tier, task_type, industry, document)
+    if stream:
+        _enable_streaming(payload)
+    call = _CompletionCall(payload, backend, deadline, max_tokens, max_total_tokens, task_type, stream, cache)
+    policy = None if stream or not backend.supports_hedging else _resolve_hedging(hedge)
+
+    def attempt():
+        payload = call.next_attempt()
+        if policy:
+            return _hedged_post_completion(payload, policy, timeout, call.estimated_tokens, rate_limit_wait, deadline,
+                                           backend)
+        return backend.post(payload, stream, timeout, call.estimated_tokens, rate_limit_wait, deadline)
+
+    # Zamykany klient nie serwuje już nawet odpowiedzi z cache
+    drain_controller.enter()
+    completion_stream = None
     try:
+        cache_key = call.lookup_key()
+        cached = response_cache.get(cache_key) if cache_key is not None else None
+        if cached is not None:
+            logger.debug("Response served from cache")
+            return call.cached(cached, detailed)
         logger.debug(f"Sending request to OpenRouter API")
-        response = requests.post(OPENROUTER_BASE_URL, headers=headers, json=payload)
-        response.raise_for_status()
-
-        result = response.json()
+        response = _with_retries(attempt, max_retries, deadline)
+        if stream:
+            # SSE zawsze w UTF-8, nawet bez charset w Content-Type
+            response.encoding = 'utf-8'
+            # Od tej chwili wywołanie trwa do zamknięcia strumienia
+            completion_stream = CompletionStream(response, deadline, backend.concurrency_limiter,
+                                                 drain_controller.exit)
+            return completion_stream
+
+        call.add_response(response)
         logger.debug("Received response from OpenRouter API")
-
-        if 'choices' in result and len(result['choices']) > 0:
-            return result['choices'][0]['message']['content']
-        else:
-            raise ValueError("Unexpected API response format")
-
-    except requests.exceptions.RequestException as e:
+        while call.continue_round():
+            try:
+                call.add_response(_with_retries(attempt, max_retries, deadline))
+            except UpstreamError as e:
+                logger.warning(f"Continuation failed, returning truncated response: {str(e)}")
+                break
+
+        details = call.finish()
+        entry = call.cache_entry()
+        if entry is not None:
+            response_cache.put(call.cache_key, entry, task_type)
+        return details if detailed else details.text
+
+    except UpstreamError as e:
         logger.error(f"API request failed: {str(e)}")
-        raise Exception(f"Failed to communicate with OpenRouter API: {str(e)}")
-
-    except (KeyError, IndexError, json.JSONDecodeError) as e:
-        logger.error(f"Error parsing API response: {str(e)}")
-        raise Exception(f"Failed to parse OpenRouter API response: {str(e)}")
-
-def analyze_cv_score(cv_text, job_description="", language='pl'):
+        raise
+    finally:
+        if completion_stream is None:
+            drain_controller.exit()
+
+# Spacje o różnej szerokości (w tym niełamiące) i tabulatory - zamieniane na zwykłą spację
+_SPACES_RE = re.compile(r'[ \t\u00a0\u1680\u2000-\u200a\u202f\u205f\u3000]+')
+# Pojedyncze spacje nietypowe we wcięciu - zamieniane na zwykłe spacje jedna do jednej (wcięcie zostaje)
+_INDENT_SPACE_RE = re.compile(r'[\u00a0\u1680\u2000-\u200a\u202f\u205f\u3000]')
+_ZERO_WIDTH_RE = re.compile(r'[\u200b-\u200d\u2060\ufeff]')
+# Punktor na początku linii (znaki typograficzne albo "-", "*", półpauza i pauza przed spacją)
+_BULLET_RE = re.compile(r'^(?:[•◦▪▫●○■□➢➤►▸‣⁃∙·✓✔]\s*|[-*–—]\s+)')
+_BLANK_LINES_RE = re.compile(r'\n{3,}')
+
+def _canonical_line(line):
+    # Wcięcie (np. zagnieżdżone punktory) zostaje - ujednolicamy tylko spacje i punktor za nim
+    line = line.rstrip()
+    body = line.lstrip()
+    indent = _INDENT_SPACE_RE.sub(' ', line[:len(line) - len(body)])
+    return indent + _BULLET_RE.sub('- ', _SPACES_RE.sub(' ', body))
+
+def canonicalize_text(text):
     """
-    Analizuje CV i przyznaje ocenę punktową 1-100 z szczegółowym uzasadnieniem
+    Kanoniczna postać wklejonego tekstu CV lub ogłoszenia: Unicode NFC, końce linii LF, jednolite spacje,
+    punktory "- ", bez spacji na końcach linii i z najwyżej jedną pustą linią z rzędu; wcięcia zostają.
+    Ten sam dokument wklejony z różnych edytorów daje ten sam prompt (i klucz cache) i mniej tokenów.
     """
+    if not text:
+        return text
+    text = unicodedata.normalize('NFC', text)
+    text = text.replace('\r\n', '\n').replace('\r', '\n').replace('\u2028', '\n').replace('\u2029', '\n')
+    text = _ZERO_WIDTH_RE.sub('', text)
+    text = '\n'.join(_canonical_line(line) for line in text.split('\n'))
+    return _BLANK_LINES_RE.sub('\n\n', text).strip('\n')
+
+def _analyze_cv_score_request(cv_text, job_description="", language='pl'):
+    cv_text = canonicalize_text(cv_text)
+    job_description = canonicalize_text(job_description)
     prompt = f"""
     Przeanalizuj poniższe CV i przyznaj mu ocenę punktową od 1 do 100, gdzie:
     - 90-100: Doskonałe CV, gotowe do wysłania
@@ -159,7 +3525,7 @@ def analyze_cv_score(cv_text, job_description="", language='pl'):
     - Poniżej 50: CV wymagające całkowitego przepisania
 
     CV do oceny:
-    {cv_text}
+    (pełna treść w sekcji "CV KANDYDATA" na początku wiadomości)
 
     {"Wymagania z oferty pracy: " + job_description if job_description else ""}
 
@@ -189,26 +3555,31 @@ def analyze_cv_score(cv_text, job_description="", language='pl'):
         "summary": "Krótkie podsumowanie oceny CV"
     }}
     """
-    return send_api_request(
-        prompt, 
-        max_tokens=2500, 
+    return dict(
+        prompt=prompt,
+        document=cv_text,
+        max_tokens=2500,
         language=language,
         user_tier='free',
         task_type='cv_optimization'
     )
 
-def analyze_keywords_match(cv_text, job_description, language='pl'):
+def analyze_cv_score(cv_text, job_description="", language='pl', **options):
     """
-    Analizuje dopasowanie słów kluczowych z CV do wymagań oferty pracy
+    Analizuje CV i przyznaje ocenę punktową 1-100 z szczegółowym uzasadnieniem
     """
-    if not job_description:
-        return "Brak opisu stanowiska do analizy słów kluczowych."
+    return send_api_request(**_analyze_cv_score_request(cv_text, job_description, language), **options)
+
+NO_JOB_DESCRIPTION_MESSAGE = "Brak opisu stanowiska do analizy słów kluczowych."
 
+def _analyze_keywords_match_request(cv_text, job_description, language='pl'):
+    cv_text = canonicalize_text(cv_text)
+    job_description = canonicalize_text(job_description)
     prompt = f"""
     Przeanalizuj dopasowanie słów kluczowych między CV a wymaganiami oferty pracy.
 
     CV:
-    {cv_text}
+    (pełna treść w sekcji "CV KANDYDATA" na początku wiadomości)
 
     Oferta pracy:
     {job_description}
@@ -227,23 +3598,33 @@ def analyze_keywords_match(cv_text, job_description, language='pl'):
         "summary": "Krótkie podsumowanie analizy dopasowania"
     }}
     """
-    return send_api_request(
-        prompt, 
-        max_tokens=2000, 
+    return dict(
+        prompt=prompt,
+        document=cv_text,
+        max_tokens=2000,
         language=language,
         user_tier='free',
         task_type='cv_optimization'
     )
 
-def check_grammar_and_style(cv_text, language='pl'):
+def analyze_keywords_match(cv_text, job_description, language='pl', **options):
     """
-    Sprawdza gramatykę, styl i poprawność językową CV
+    Analizuje dopasowanie słów kluczowych z CV do wymagań oferty pracy
     """
+    # Ogłoszenie z samych spacji i znaków niewidocznych też jest puste
+    job_description = canonicalize_text(job_description)
+    if not job_description:
+        return NO_JOB_DESCRIPTION_MESSAGE
+
+    return send_api_request(**_analyze_keywords_match_request(cv_text, job_description, language), **options)
+
+def _check_grammar_and_style_request(cv_text, language='pl'):
+    cv_text = canonicalize_text(cv_text)
     prompt = f"""
     Przeanalizuj poniższe CV pod kątem gramatyki, stylu i poprawności językowej.
 
     CV:
-    {cv_text}
+    (pełna treść w sekcji "CV KANDYDATA" na początku wiadomości)
 
     Sprawdź:
     1. Błędy gramatyczne i ortograficzne
@@ -270,23 +3651,29 @@ def check_grammar_and_style(cv_text, language='pl'):
         "summary": "Podsumowanie analizy językowej"
     }}
     """
-    return send_api_request(
-        prompt, 
+    return dict(
+        prompt=prompt,
+        document=cv_text,
         max_tokens=1500,
         language=language,
         user_tier='free',
         task_type='cv_optimization'
     )
 
-def optimize_for_position(cv_text, job_title, job_description="", language='pl'):
+def check_grammar_and_style(cv_text, language='pl', **options):
     """
-    Optymalizuje CV pod konkretne stanowisko
+    Sprawdza gramatykę, styl i poprawność językową CV
     """
+    return send_api_request(**_check_grammar_and_style_request(cv_text, language), **options)
+
+def _optimize_for_position_request(cv_text, job_title, job_description="", language='pl'):
+    cv_text = canonicalize_text(cv_text)
+    job_description = canonicalize_text(job_description)
     prompt = f"""
     Zoptymalizuj poniższe CV specjalnie pod stanowisko: {job_title}
 
     CV:
-    {cv_text}
+    (pełna treść w sekcji "CV KANDYDATA" na początku wiadomości)
 
     {"Wymagania z oferty: " + job_description if job_description else ""}
 
@@ -307,23 +3694,29 @@ def optimize_for_position(cv_text, job_title, job_description="", language='pl')
         "summary": "Podsumowanie optymalizacji"
     }}
     """
-    return send_api_request(
-        prompt, 
+    return dict(
+        prompt=prompt,
+        document=cv_text,
         max_tokens=2500,
         language=language,
         user_tier='free',
         task_type='cv_optimization'
     )
 
-def generate_interview_tips(cv_text, job_description="", language='pl'):
+def optimize_for_position(cv_text, job_title, job_description="", language='pl', **options):
     """
-    Generuje spersonalizowane tipy na rozmowę kwalifikacyjną
+    Optymalizuje CV pod konkretne stanowisko
     """
+    return send_api_request(**_optimize_for_position_request(cv_text, job_title, job_description, language), **options)
+
+def _generate_interview_tips_request(cv_text, job_description="", language='pl'):
+    cv_text = canonicalize_text(cv_text)
+    job_description = canonicalize_text(job_description)
     prompt = f"""
     Na podstawie CV i opisu stanowiska, przygotuj spersonalizowane tipy na rozmowę kwalifikacyjną.
 
     CV:
-    {cv_text}
+    (pełna treść w sekcji "CV KANDYDATA" na początku wiadomości)
 
     {"Stanowisko: " + job_description if job_description else ""}
 
@@ -355,18 +3748,23 @@ def generate_interview_tips(cv_text, job_description="", language='pl'):
         "summary": "Kluczowe rady dla tego kandydata"
     }}
     """
-    return send_api_request(
-        prompt, 
+    return dict(
+        prompt=prompt,
+        document=cv_text,
         max_tokens=2000,
         language=language,
         user_tier='free',
         task_type='interview_prep'
     )
 
-def generate_improved_cv(cv_text, improvement_focus='general', target_industry='', language='pl', is_premium=False, payment_verified=False):
+def generate_interview_tips(cv_text, job_description="", language='pl', **options):
     """
-    Generate an improved version of CV based on focus area
+    Generuje spersonalizowane tipy na rozmowę kwalifikacyjną
     """
+    return send_api_request(**_generate_interview_tips_request(cv_text, job_description, language), **options)
+
+def _generate_improved_cv_request(cv_text, improvement_focus='general', target_industry='', language='pl', is_premium=False, payment_verified=False):
+    cv_text = canonicalize_text(cv_text)
     focus_prompts = {
         'general': "Przeprowadź ogólną poprawę CV zwiększając jego atrakcyjność dla rekruterów",
         'structure': "Popraw strukturę i organizację CV dla lepszej czytelności",
@@ -390,7 +3788,7 @@ def generate_improved_cv(cv_text, improvement_focus='general', target_industry='
     {industry_context}
 
     ORYGINALNE CV:
-    {cv_text}
+    (pełna treść w sekcji "CV KANDYDATA" na początku wiadomości)
 
     POZIOM USŁUGI: {"Premium Advanced" if is_premium else "Standard Paid"}
 
@@ -417,25 +3815,33 @@ def generate_improved_cv(cv_text, improvement_focus='general', target_industry='
 
     max_tokens = 4000 if is_premium else 2500
 
-    return send_api_request(
-        prompt,
+    return dict(
+        prompt=prompt,
+        document=cv_text,
         max_tokens=max_tokens,
         language=language,
         user_tier='premium' if is_premium else 'paid',
         task_type='cv_improvement'
     )
 
+def generate_improved_cv(cv_text, improvement_focus='general', target_industry='', language='pl', is_premium=False, payment_verified=False, **options):
+    """
+    Generate an improved version of CV based on focus area
+    """
+    return send_api_request(**_generate_improved_cv_request(cv_text, improvement_focus, target_industry, language, is_premium, payment_verified), **options)
+
 
-def apply_recruiter_feedback_to_cv(cv_text, recruiter_feedback, job_description="", language='pl', is_premium=False, payment_verified=False):
-    """Apply recruiter feedback to improve CV"""
+def _apply_recruiter_feedback_to_cv_request(cv_text, recruiter_feedback, job_description="", language='pl', is_premium=False, payment_verified=False):
+    cv_text = canonicalize_text(cv_text)
+    job_description = canonicalize_text(job_description)
     prompt = f"""
     Zastosuj poniższe uwagi rekrutera do CV i popraw je zgodnie z sugestiami.
 
     ORYGINALNE CV:
-    {cv_text}
+    (pełna treść w sekcji "CV KANDYDATA" na początku wiadomości)
 
     UWAGI REKRUTERA:
-    {feedback}
+    {recruiter_feedback}
 
     OPIS STANOWISKA (jeśli dostępny):
     {job_description}
@@ -447,18 +3853,21 @@ def apply_recruiter_feedback_to_cv(cv_text, recruiter_feedback, job_description=
         "improvement_summary": "Podsumowanie ulepszeń"
     }}
     """
-    return send_api_request(
-        prompt, 
+    return dict(
+        prompt=prompt,
+        document=cv_text,
         max_tokens=3000,
         language=language,
         user_tier='premium' if is_premium else ('paid' if payment_verified else 'free'),
         task_type='cv_optimization'
     )
 
-def analyze_polish_job_posting(job_description, language='pl'):
-    """
-    Analizuje polskie ogłoszenia o pracę i wyciąga kluczowe informacje
-    """
+def apply_recruiter_feedback_to_cv(cv_text, recruiter_feedback, job_description="", language='pl', is_premium=False, payment_verified=False, **options):
+    """Apply recruiter feedback to improve CV"""
+    return send_api_request(**_apply_recruiter_feedback_to_cv_request(cv_text, recruiter_feedback, job_description, language, is_premium, payment_verified), **options)
+
+def _analyze_polish_job_posting_request(job_description, language='pl'):
+    job_description = canonicalize_text(job_description)
     prompt = f"""
     Przeanalizuj poniższe polskie ogłoszenie o pracę i wyciągnij z niego najważniejsze informacje.
 
@@ -543,19 +3952,23 @@ def analyze_polish_job_posting(job_description, language='pl'):
         "summary": "zwięzłe podsumowanie stanowiska i wymagań"
     }}
     """
-    return send_api_request(
-        prompt, 
+    return dict(
+        prompt=prompt,
         max_tokens=2000,
         language=language,
         user_tier='free',
         task_type='cv_optimization'
     )
 
-def optimize_cv_for_specific_position(cv_text, target_position, job_description, company_name="", language='pl', is_premium=False, payment_verified=False):
+def analyze_polish_job_posting(job_description, language='pl', **options):
     """
-    ZAAWANSOWANA OPTYMALIZACJA CV - analizuje każde poprzednie stanowisko i inteligentnie je przepisuje
-    pod kątem konkretnego stanowiska docelowego, zachowując pełną autentyczność danych
+    Analizuje polskie ogłoszenia o pracę i wyciąga kluczowe informacje
     """
+    return send_api_request(**_analyze_polish_job_posting_request(job_description, language), **options)
+
+def _optimize_cv_for_specific_position_request(cv_text, target_position, job_description, company_name="", language='pl', is_premium=False, payment_verified=False):
+    cv_text = canonicalize_text(cv_text)
+    job_description = canonicalize_text(job_description)
     prompt = f"""
     ZADANIE: Przepisz to CV używając WYŁĄCZNIE faktów z oryginalnego tekstu. NIE DODAWAJ, NIE WYMYŚLAJ, NIE TWÓRZ nowych informacji.
 
@@ -573,7 +3986,7 @@ def optimize_cv_for_specific_position(cv_text, target_position, job_description,
     {job_description}
 
     ORYGINALNE CV (UŻYWAJ TYLKO TYCH FAKTÓW):
-    {cv_text}
+    (pełna treść w sekcji "CV KANDYDATA" na początku wiadomości)
 
     PRZEPISZ CV zachowując wszystkie oryginalne fakty, ale lepiej je prezentując. Odpowiedź w formacie JSON:
 
@@ -589,18 +4002,24 @@ def optimize_cv_for_specific_position(cv_text, target_position, job_description,
 
     max_tokens = 8000 if is_premium or payment_verified else 4000
 
-    return send_api_request(
-        prompt,
+    return dict(
+        prompt=prompt,
+        document=cv_text,
         max_tokens=max_tokens,
         language=language,
         user_tier='premium' if is_premium else ('paid' if payment_verified else 'free'),
         task_type='cv_optimization'
     )
 
-def generate_complete_cv_content(target_position, experience_level, industry, brief_background, language='pl'):
+def optimize_cv_for_specific_position(cv_text, target_position, job_description, company_name="", language='pl', is_premium=False, payment_verified=False, **options):
     """
-    Generate complete CV content from minimal user input using AI
+    ZAAWANSOWANA OPTYMALIZACJA CV - analizuje każde poprzednie stanowisko i inteligentnie je przepisuje
+    pod kątem konkretnego stanowiska docelowego, zachowując pełną autentyczność danych.
+    Z stream=True zwraca CompletionStream - pierwsze fragmenty tekstu trafiają do UI od razu.
     """
+    return send_api_request(**_optimize_cv_for_specific_position_request(cv_text, target_position, job_description, company_name, language, is_premium, payment_verified), **options)
+
+def _generate_complete_cv_content_request(target_position, experience_level, industry, brief_background, language='pl'):
     prompt = f"""
     ZADANIE: Wygeneruj kompletną treść CV na podstawie minimalnych informacji od użytkownika.
 
@@ -669,19 +4088,23 @@ def generate_complete_cv_content(target_position, experience_level, industry, br
         "generation_notes": "Informacje o logice generowania tego CV"
     }}
     """
-    return send_api_request(
-        prompt,
+    return dict(
+        prompt=prompt,
         max_tokens=4000,
         language=language,
         user_tier='free',
         task_type='cv_optimization'
     )
 
-def optimize_cv(cv_text, job_description, language='pl', is_premium=False, payment_verified=False):
+def generate_complete_cv_content(target_position, experience_level, industry, brief_background, language='pl', **options):
     """
-    Create a clean, optimized version of CV using ONLY authentic data from the original CV
-    Returns only the improved CV text without extra metadata
+    Generate complete CV content from minimal user input using AI
     """
+    return send_api_request(**_generate_complete_cv_content_request(target_position, experience_level, industry, brief_background, language), **options)
+
+def _optimize_cv_request(cv_text, job_description, language='pl', is_premium=False, payment_verified=False):
+    cv_text = canonicalize_text(cv_text)
+    job_description = canonicalize_text(job_description)
     prompt = f"""
     ZADANIE: Stwórz ulepszoną wersję CV używając WYŁĄCZNIE prawdziwych informacji z oryginalnego CV.
 
@@ -717,7 +4140,7 @@ def optimize_cv(cv_text, job_description, language='pl', is_premium=False, payme
     - Pogrupuj je logicznie (Techniczne, Komunikacyjne, itp.)
 
     ORYGINALNE CV:
-    {cv_text}
+    (pełna treść w sekcji "CV KANDYDATA" na początku wiadomości)
 
     OPIS STANOWISKA (dla kontekstu):
     {job_description}
@@ -748,18 +4171,25 @@ def optimize_cv(cv_text, job_description, language='pl', is_premium=False, payme
     - Czytelne formatowanie
     """
 
-    return send_api_request(
-        prompt,
+    return dict(
+        prompt=prompt,
+        document=cv_text,
         max_tokens=max_tokens,
         language=language,
         user_tier='premium' if is_premium else ('paid' if payment_verified else 'free'),
         task_type='cv_optimization'
     )
 
-def generate_recruiter_feedback(cv_text, job_description="", language='pl'):
+def optimize_cv(cv_text, job_description, language='pl', is_premium=False, payment_verified=False, **options):
     """
-    Generate feedback on a CV as if from an AI recruiter
+    Create a clean, optimized version of CV using ONLY authentic data from the original CV
+    Returns only the improved CV text without extra metadata
     """
+    return send_api_request(**_optimize_cv_request(cv_text, job_description, language, is_premium, payment_verified), **options)
+
+def _generate_recruiter_feedback_request(cv_text, job_description="", language='pl'):
+    cv_text = canonicalize_text(cv_text)
+    job_description = canonicalize_text(job_description)
     context = ""
     if job_description:
         context = f"Opis stanowiska do kontekstu:\n{job_description}"
@@ -782,7 +4212,7 @@ def generate_recruiter_feedback(cv_text, job_description="", language='pl'):
     {context}
 
     CV do oceny:
-    {cv_text}
+    (pełna treść w sekcji "CV KANDYDATA" na początku wiadomości)
 
     Odpowiedź w formacie JSON:
     {{
@@ -812,18 +4242,24 @@ def generate_recruiter_feedback(cv_text, job_description="", language='pl'):
 
     Bądź szczery, ale konstruktywny. Oceniaj tylko to co rzeczywiście jest w CV, nie dodawaj od siebie.
     """
-    return send_api_request(
-        prompt, 
-        max_tokens=3000, 
+    return dict(
+        prompt=prompt,
+        document=cv_text,
+        max_tokens=3000,
         language=language,
         user_tier='premium',
         task_type='recruiter_feedback'
     )
 
-def generate_cover_letter(cv_text, job_description, language='pl'):
+def generate_recruiter_feedback(cv_text, job_description="", language='pl', **options):
     """
-    Generate a cover letter based on a CV and job description
+    Generate feedback on a CV as if from an AI recruiter
     """
+    return send_api_request(**_generate_recruiter_feedback_request(cv_text, job_description, language), **options)
+
+def _generate_cover_letter_request(cv_text, job_description, language='pl'):
+    cv_text = canonicalize_text(cv_text)
+    job_description = canonicalize_text(job_description)
     prompt = f"""
     ZADANIE: Napisz spersonalizowany list motywacyjny w języku polskim WYŁĄCZNIE na podstawie faktów z CV.
 
@@ -853,116 +4289,176 @@ def generate_cover_letter(cv_text, job_description, language='pl'):
     {job_description}
 
     CV kandydata:
-    {cv_text}
+    (pełna treść w sekcji "CV KANDYDATA" na początku wiadomości)
 
     Napisz kompletny list motywacyjny w języku polskim. Użyj profesjonalnego, ale ciepłego tonu.
     """
-    return send_api_request(
-        prompt,
+    return dict(
+        prompt=prompt,
+        document=cv_text,
         max_tokens=2000,
         language=language,
         user_tier='free',
         task_type='cover_letter'
     )
 
-def analyze_job_url(url):
+def generate_cover_letter(cv_text, job_description, language='pl', **options):
     """
-    Extract job description from a URL with improved handling for popular job sites
+    Generate a cover letter based on a CV and job description.
+    Pass stream=True to receive a CompletionStream of text deltas.
     """
-    try:
-        logger.debug(f"Analyzing job URL: {url}")
+    return send_api_request(**_generate_cover_letter_request(cv_text, job_description, language), **options)
 
-        parsed_url = urllib.parse.urlparse(url)
-        if not parsed_url.scheme or not parsed_url.netloc:
-            raise ValueError("Invalid URL format")
+JOB_PAGE_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+}
 
-        response = requests.get(url, headers={
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-        })
-        response.raise_for_status()
+def _parse_job_url(url):
+    parsed_url = urllib.parse.urlparse(url)
+    if not parsed_url.scheme or not parsed_url.netloc:
+        raise ValueError("Invalid URL format")
+    return parsed_url
+
+# Parametry śledzące w linkach udostępnianych ogłoszeń - nie zmieniają treści strony
+_TRACKING_QUERY_PARAMS = {'fbclid', 'gclid', 'msclkid', 'ref', 'trk', 'trackingid'}
+
+def _canonical_job_url(url):
+    """
+    Kanoniczna postać linku do ogłoszenia (klucz łączenia wywołań): małe litery w schemacie i hoście,
+    bez fragmentu i parametrów śledzących
+    """
+    parsed_url = urllib.parse.urlsplit(url.strip())
+    query = [(name, value) for name, value in urllib.parse.parse_qsl(parsed_url.query, keep_blank_values=True)
+             if not name.lower().startswith('utm_') and name.lower() not in _TRACKING_QUERY_PARAMS]
+    return urllib.parse.urlunsplit((parsed_url.scheme.lower(), parsed_url.netloc.lower(), parsed_url.path or '/',
+                                    urllib.parse.urlencode(query), ''))
+
+def _extract_job_text(html, domain):
+    """
+    Wyciąga treść ogłoszenia z HTML strony - wspólne dla API synchronicznego i asynchronicznego
+    """
+    # bs4 ładowany dopiero przy pierwszej analizie ogłoszenia
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, 'html.parser')
+
+    job_text = ""
+
+    if 'linkedin.com' in domain:
+        containers = soup.select('.description__text, .show-more-less-html, .jobs-description__content')
+        if containers:
+            job_text = containers[0].get_text(separator='\n', strip=True)
+
+    elif 'indeed.com' in domain:
+        container = soup.select_one('#jobDescriptionText')
+        if container:
+            job_text = container.get_text(separator='\n', strip=True)
+
+    elif 'pracuj.pl' in domain:
+        containers = soup.select('[data-test="section-benefit-expectations-text"], [data-test="section-description-text"]')
+        if containers:
+            job_text = '\n'.join([c.get_text(separator='\n', strip=True) for c in containers])
 
-        soup = BeautifulSoup(response.text, 'html.parser')
+    elif 'olx.pl' in domain or 'praca.pl' in domain:
+        containers = soup.select('.offer-description, .offer-content, .description')
+        if containers:
+            job_text = containers[0].get_text(separator='\n', strip=True)
 
-        job_text = ""
-        domain = parsed_url.netloc.lower()
+    if not job_text:
+        potential_containers = soup.select('.job-description, .description, .details, article, .job-content, [class*=job], [class*=description], [class*=offer]')
+        if potential_containers:
+            for container in potential_containers:
+                container_text = container.get_text(separator='\n', strip=True)
+                if len(container_text) > len(job_text):
+                    job_text = container_text
 
-        if 'linkedin.com' in domain:
-            containers = soup.select('.description__text, .show-more-less-html, .jobs-description__content')
-            if containers:
-                job_text = containers[0].get_text(separator='\n', strip=True)
+        if not job_text and soup.body:
+            for tag in soup.select('nav, header, footer, script, style, iframe'):
+                tag.decompose()
 
-        elif 'indeed.com' in domain:
-            container = soup.select_one('#jobDescriptionText')
-            if container:
-                job_text = container.get_text(separator='\n', strip=True)
+            job_text = soup.body.get_text(separator='\n', strip=True)
 
-        elif 'pracuj.pl' in domain:
-            containers = soup.select('[data-test="section-benefit-expectations-text"], [data-test="section-description-text"]')
-            if containers:
-                job_text = '\n'.join([c.get_text(separator='\n', strip=True) for c in containers])
+            if len(job_text) > 10000:
+                paragraphs = job_text.split('\n')
+                keywords = ['requirements', 'responsibilities', 'qualifications', 'skills', 'experience', 'about the job',
+                            'wymagania', 'obowiązki', 'kwalifikacje', 'umiejętności', 'doświadczenie', 'o pracy']
 
-        elif 'olx.pl' in domain or 'praca.pl' in domain:
-            containers = soup.select('.offer-description, .offer-content, .description')
-            if containers:
-                job_text = containers[0].get_text(separator='\n', strip=True)
+                relevant_paragraphs = []
+                found_relevant = False
 
-        if not job_text:
-            potential_containers = soup.select('.job-description, .description, .details, article, .job-content, [class*=job], [class*=description], [class*=offer]')
-            if potential_containers:
-                for container in potential_containers:
-                    container_text = container.get_text(separator='\n', strip=True)
-                    if len(container_text) > len(job_text):
-                        job_text = container_text
+                for paragraph in paragraphs:
+                    if any(keyword.lower() in paragraph.lower() for keyword in keywords):
+                        found_relevant = True
+                    if found_relevant and len(paragraph.strip()) > 50:
+                        relevant_paragraphs.append(paragraph)
 
-            if not job_text and soup.body:
-                for tag in soup.select('nav, header, footer, script, style, iframe'):
-                    tag.decompose()
+                if relevant_paragraphs:
+                    job_text = '\n'.join(relevant_paragraphs)
 
-                job_text = soup.body.get_text(separator='\n', strip=True)
 
-                if len(job_text) > 10000:
-                    paragraphs = job_text.split('\n')
-                    keywords = ['requirements', 'responsibilities', 'qualifications', 'skills', 'experience', 'about the job',
-                                'wymagania', 'obowiązki', 'kwalifikacje', 'umiejętności', 'doświadczenie', 'o pracy']
+    job_text = '\n'.join([' '.join(line.split()) for line in job_text.split('\n') if line.strip()])
 
-                    relevant_paragraphs = []
-                    found_relevant = False
+    if not job_text:
+        raise ValueError("Could not extract job description from the URL")
 
-                    for paragraph in paragraphs:
-                        if any(keyword.lower() in paragraph.lower() for keyword in keywords):
-                            found_relevant = True
-                        if found_relevant and len(paragraph.strip()) > 50:
-                            relevant_paragraphs.append(paragraph)
+    return job_text
 
-                    if relevant_paragraphs:
-                        job_text = '\n'.join(relevant_paragraphs)
+JOB_FETCH_ERROR_PREFIX = "Failed to fetch job posting from URL"
 
+def _job_fetch_timeout(deadline):
+    timeout = (CONNECT_TIMEOUT, JOB_FETCH_TIMEOUT)
+    return deadline.timeout(timeout, "fetching the job posting") if deadline is not None else timeout
 
-        job_text = '\n'.join([' '.join(line.split()) for line in job_text.split('\n') if line.strip()])
+def _fetch_job_page(url, deadline=None):
+    try:
+        response = client.get(url, headers=JOB_PAGE_HEADERS, timeout=_job_fetch_timeout(deadline))
+    except _sync_transport_errors() as e:
+        raise _transport_error(e, prefix=JOB_FETCH_ERROR_PREFIX)
+
+    if response.status_code >= 400:
+        raise _status_error(response.status_code, response.headers, response.reason, prefix=JOB_FETCH_ERROR_PREFIX)
+    return response.text
+
+def analyze_job_url(url, idempotency_key=None, deadline=None, coalesce=True):
+    """
+    Extract job description from a URL with improved handling for popular job sites.
+    Concurrent calls for the same (canonical) URL share one fetch and summary unless coalesce=False.
+    """
+    deadline = _resolve_deadline(deadline)
+    if idempotency_key is not None:
+        return idempotency_store.run(idempotency_key, _request_fingerprint("analyze_job_url", url),
+                                     lambda: analyze_job_url(url, deadline=deadline), deadline)
+    if coalesce:
+        return single_flight.do(_request_fingerprint("analyze_job_url", _canonical_job_url(url)),
+                                lambda: analyze_job_url(url, deadline=deadline, coalesce=False), deadline)
+
+    try:
+        logger.debug(f"Analyzing job URL: {url}")
 
-        if not job_text:
-            raise ValueError("Could not extract job description from the URL")
+        parsed_url = _parse_job_url(url)
+
+        html = _with_retries(lambda: _fetch_job_page(url, deadline), deadline=deadline)
+
+        job_text = _extract_job_text(html, parsed_url.netloc.lower())
 
         logger.debug(f"Successfully extracted job description from URL")
 
         if len(job_text) > 4000:
             logger.debug(f"Job description is long ({len(job_text)} chars), summarizing with AI")
-            job_text = summarize_job_description(job_text)
+            job_text = summarize_job_description(job_text, deadline=deadline)
 
         return job_text
 
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error fetching job URL: {str(e)}")
-        raise Exception(f"Failed to fetch job posting from URL: {str(e)}")
+    except UpstreamError as e:
+        logger.error(f"Upstream error while analyzing job URL: {str(e)}")
+        raise
 
     except Exception as e:
         logger.error(f"Error analyzing job URL: {str(e)}")
         raise Exception(f"Failed to analyze job posting: {str(e)}")
 
-def summarize_job_description(job_text):
-    """
-    Summarize a long job description using the AI
-    """
+def _summarize_job_description_request(job_text):
+    job_text = canonicalize_text(job_text)
     prompt = f"""
     ZADANIE: Wyciągnij i podsumuj kluczowe informacje z tego ogłoszenia o pracę w języku polskim.
 
@@ -982,18 +4478,23 @@ def summarize_job_description(job_text):
 
     Odpowiedź w języku polskim.
     """
-    return send_api_request(
-        prompt,
+    return dict(
+        prompt=prompt,
         max_tokens=1500,
         language='pl',
         user_tier='free',
         task_type='cv_optimization'
     )
 
-def ats_optimization_check(cv_text, job_description="", language='pl'):
+def summarize_job_description(job_text, **options):
     """
-    Check CV against ATS (Applicant Tracking System) and provide suggestions for improvement
+    Summarize a long job description using the AI
     """
+    return send_api_request(**_summarize_job_description_request(job_text), **options)
+
+def _ats_optimization_check_request(cv_text, job_description="", language='pl'):
+    cv_text = canonicalize_text(cv_text)
+    job_description = canonicalize_text(job_description)
     context = ""
     if job_description:
         context = f"Ogłoszenie o pracę dla odniesienia:\n{job_description[:2000]}"
@@ -1036,7 +4537,7 @@ def ats_optimization_check(cv_text, job_description="", language='pl'):
     {context}
 
     CV do analizy:
-    {cv_text}
+    (pełna treść w sekcji "CV KANDYDATA" na początku wiadomości)
 
     Odpowiedz w tym samym języku co CV. Jeśli CV jest po polsku, odpowiedz po polsku.
     Dodaj główny nagłówek: "ANALIZA ATS CV"
@@ -1071,18 +4572,23 @@ def ats_optimization_check(cv_text, job_description="", language='pl'):
     9. PODSUMOWANIE:
     [Krótkie podsumowanie i zachęta]
     """
-    return send_api_request(
-        prompt,
+    return dict(
+        prompt=prompt,
+        document=cv_text,
         max_tokens=1800,
         language=language,
         user_tier='free',
         task_type='cv_optimization'
     )
 
-def analyze_cv_strengths(cv_text, job_title="analityk danych", language='pl'):
+def ats_optimization_check(cv_text, job_description="", language='pl', **options):
     """
-    Analyze CV strengths for a specific job position and provide improvement suggestions
+    Check CV against ATS (Applicant Tracking System) and provide suggestions for improvement
     """
+    return send_api_request(**_ats_optimization_check_request(cv_text, job_description, language), **options)
+
+def _analyze_cv_strengths_request(cv_text, job_title="analityk danych", language='pl'):
+    cv_text = canonicalize_text(cv_text)
     prompt = f"""
     ZADANIE: Przeprowadź dogłębną analizę mocnych stron tego CV w kontekście stanowiska {job_title}.
 
@@ -1093,22 +4599,28 @@ def analyze_cv_strengths(cv_text, job_title="analityk danych", language='pl'):
     5. Zaproponuj, jak lepiej zaprezentować osiągnięcia i umiejętności, aby były bardziej przekonujące.
 
     CV:
-    {cv_text}
+    (pełna treść w sekcji "CV KANDYDATA" na początku wiadomości)
 
     Pamiętaj, aby Twoja analiza była praktyczna i pomocna. Używaj konkretnych przykładów z CV i odnoś je do wymagań typowych dla stanowiska {job_title}.
     """
-    return send_api_request(
-        prompt,
+    return dict(
+        prompt=prompt,
+        document=cv_text,
         max_tokens=2500,
         language=language,
         user_tier='free',
         task_type='cv_optimization'
     )
 
-def generate_interview_questions(cv_text, job_description="", language='pl'):
+def analyze_cv_strengths(cv_text, job_title="analityk danych", language='pl', **options):
     """
-    Generate likely interview questions based on CV and job description
+    Analyze CV strengths for a specific job position and provide improvement suggestions
     """
+    return send_api_request(**_analyze_cv_strengths_request(cv_text, job_title, language), **options)
+
+def _generate_interview_questions_request(cv_text, job_description="", language='pl'):
+    cv_text = canonicalize_text(cv_text)
+    job_description = canonicalize_text(job_description)
     context = ""
     if job_description:
         context = f"Uwzględnij poniższe ogłoszenie o pracę przy tworzeniu pytań:\n{job_description[:2000]}"
@@ -1132,7 +4644,7 @@ def generate_interview_questions(cv_text, job_description="", language='pl'):
     {context}
 
     CV:
-    {cv_text}
+    (pełna treść w sekcji "CV KANDYDATA" na początku wiadomości)
 
     Odpowiedz w tym samym języku co CV. Jeśli CV jest po polsku, odpowiedz po polsku.
     Dodatkowo, do każdego pytania dodaj krótką wskazówkę, jak można by na nie odpowiedzieć w oparciu o informacje z CV.
@@ -1140,73 +4652,24 @@ def generate_interview_questions(cv_text, job_description="", language='pl'):
     - Pytanie rekrutacyjne
       * Wskazówka jak odpowiedzieć: [wskazówka]
     """
-    return send_api_request(
-        prompt,
+    return dict(
+        prompt=prompt,
+        document=cv_text,
         max_tokens=2000,
         language=language,
         user_tier='free',
         task_type='interview_prep'
     )
 
-def get_enhanced_system_prompt(task_type, language='pl'):
+def generate_interview_questions(cv_text, job_description="", language='pl', **options):
     """
-    Generuje spersonalizowany prompt systemowy dla różnych typów zadań
+    Generate likely interview questions based on CV and job description
     """
-    base_prompt = DEEP_REASONING_PROMPT
-
-    task_specific_prompts = {
-        'cv_optimization': """
-
-🔥 SPECJALIZACJA: OPTYMALIZACJA CV
-- Analizujesz każde słowo pod kątem wpływu na rekrutera
-- Znasz najnowsze trendy w formatowaniu CV
-- Potrafisz dostosować styl do różnych branż i stanowisk
-- Maksymalizujesz szanse przejścia przez filtry ATS
-- Przepisujesz istniejące doświadczenia używając faktów z CV
-- PAMIĘTAJ: Tylko poprawiaj sformułowania, NIE dodawaj nowych firm, stanowisk, dat!""",
-
-        'recruiter_feedback': """
-
-👔 SPECJALIZACJA: OPINIE REKRUTERA
-- Myślisz jak senior recruiter z doświadczeniem w różnych branżach
-- Dostrzegasz detale, które umykają innym
-- Oceniasz CV pod kątem pierwszego wrażenia (6 sekund)
-- Znasz typowe błędy kandydatów i jak ich unikać
-- Potrafisz przewidzieć reakcję hiring managera""",
-
-        'cover_letter': """
-
-📄 SPECJALIZACJA: LISTY MOTYWACYJNE
-- Tworzysz przekonujące narracje osobiste
-- Łączysz doświadczenia kandydata z potrzebami firmy
-- Używasz psychologii przekonywania w copywritingu
-- Dostosowujesz ton do kultury organizacyjnej
-- Unikasz szablonowych zwrotów i klisz""",
+    return send_api_request(**_generate_interview_questions_request(cv_text, job_description, language), **options)
 
-        'interview_prep': """
-
-🎤 SPECJALIZACJA: PRZYGOTOWANIE DO ROZMÓW
-- Przewidujesz pytania na podstawie CV i stanowiska
-- Znasz techniki odpowiadania (STAR, CAR)
-- Pomagasz w przygotowaniu historii sukcesu
-- Analizujesz potencjalne słabości i jak je przedstawić
-- Przygotowujesz do różnych typów rozmów (HR, techniczne, z przełożonym)""",
-
-        'cv_improvement': """
-
-🌟 SPECJALIZACJA: POPRAWA CV
-- Skupiasz się na specyficznych aspektach CV (struktura, treść, słowa kluczowe, osiągnięcia)
-- Dostosowujesz podejście do wybranego obszaru poprawy
-- Zapewniasz lepszą prezentację kandydatury
-- Generujesz praktyczne rekomendacje"""
-    }
-
-    return base_prompt + task_specific_prompts.get(task_type, "")
-
-def enhanced_cv_optimization_with_reasoning(cv_text, job_description, language='pl', is_premium=False, payment_verified=False):
-    """
-    Enhanced CV optimization with AI reasoning - premium feature
-    """
+def _enhanced_cv_optimization_with_reasoning_request(cv_text, job_description, language='pl', is_premium=False, payment_verified=False):
+    cv_text = canonicalize_text(cv_text)
+    job_description = canonicalize_text(job_description)
     prompt = f"""
     ZADANIE EKSPERCKIE: Przeprowadź zaawansowaną optymalizację CV z głęboką analizą i uzasadnieniem każdej zmiany.
 
@@ -1218,7 +4681,7 @@ def enhanced_cv_optimization_with_reasoning(cv_text, job_description, language='
     5. Maksymalizuj ATS compatibility i human readability
 
     ORYGINALNE CV:
-    {cv_text}
+    (pełna treść w sekcji "CV KANDYDATA" na początku wiadomości)
 
     KONTEKST STANOWISKA:
     {job_description}
@@ -1252,14 +4715,22 @@ def enhanced_cv_optimization_with_reasoning(cv_text, job_description, language='
 
     max_tokens = 6000 if is_premium or payment_verified else 3000
 
-    return send_api_request(
-        prompt,
+    return dict(
+        prompt=prompt,
+        document=cv_text,
         max_tokens=max_tokens,
         language=language,
         user_tier='premium' if is_premium else ('paid' if payment_verified else 'free'),
         task_type='cv_optimization'
     )
 
+def enhanced_cv_optimization_with_reasoning(cv_text, job_description, language='pl', is_premium=False, payment_verified=False, **options):
+    """
+    Enhanced CV optimization with AI reasoning - premium feature.
+    Pass stream=True to receive a CompletionStream of text deltas.
+    """
+    return send_api_request(**_enhanced_cv_optimization_with_reasoning_request(cv_text, job_description, language, is_premium, payment_verified), **options)
+
 def get_model_performance_stats():
     """
     Zwróć informacje o używanych modelach AI - tylko Qwen z rozszerzonymi możliwościami
@@ -1313,14 +4784,14 @@ def intelligent_response_parser(response_text, expected_format='json'):
         if json_match:
             json_string = json_match.group(0)
             try:
-                data = json.loads(json_string)
+                data = json_codec.loads(json_string)
                 # Basic validation: check if it's a dictionary (common for JSON responses)
                 if isinstance(data, dict):
                     return data
                 else:
                     logger.warning("Parsed JSON is not a dictionary.")
                     return {"error": "Parsed JSON is not a dictionary.", "raw_response": response_text}
-            except json.JSONDecodeError:
+            except ValueError:
                 logger.warning("Failed to decode JSON from extracted string.")
                 return {"error": "Failed to decode JSON.", "extracted_json": json_string, "raw_response": response_text}
             except Exception as e:
@@ -1331,4 +4802,438 @@ def intelligent_response_parser(response_text, expected_format='json'):
             return {"error": "No JSON object found in the response.", "raw_response": response_text}
     else:
         # If other formats are needed in the future, add them here
-        return {"error": f"Unsupported expected format: {expected_format}", "raw_response": response_text}
\ No newline at end of file
+        return {"error": f"Unsupported expected format: {expected_format}", "raw_response": response_text}
+
+# ASYNCHRONICZNE API (asyncio) - korzysta z tych samych builderów promptów co wersje synchroniczne
+
+async def _apost_completion(payload, stream=False, timeout=None, estimated_tokens=0, rate_limit_wait=None,
+                            deadline=None, backend=None):
+    """
+    Asynchroniczna wersja _post_completion()
+    """
+    backend = backend or openrouter_backend
+    limiter = backend.concurrency_limiter
+    task_type = payload["metadata"]["task_type"]
+    user_tier = payload["metadata"]["user_tier"]
+    body = backend.prepare_payload(payload)
+    breaker = circuit_breakers.get(body["model"], backend.async_client.base_url)
+    breaker.before_call()
+    started = time.monotonic()
+    api_key = None
+    slot_acquired = False
+
+    try:
+        if deadline is not None:
+            deadline.check()
+            rate_limit_wait = deadline.wait(rate_limit_wait)
+        api_key = await limiter.acquire_async(deadline.remaining() if deadline is not None else None, task_type,
+                                              user_tier, backend.credentials, estimated_tokens, rate_limit_wait)
+        slot_acquired = True
+        if deadline is not None:
+            timeout = deadline.timeout(timeout)
+        started = time.monotonic()
+        try:
+            # Zawsze w trybie strumieniowym httpx - moment powrotu to czas do pierwszego bajtu (TTFB)
+            response = await backend.async_client.post(body, request_headers=api_key.headers, stream=True,
+                                                       timeout=timeout)
+            ttfb = time.monotonic() - started
+            if response.status_code >= 400 or not stream:
+                try:
+                    await response.aread()
+                except BaseException:
+                    await response.aclose()
+                    raise
+        except httpx.HTTPError as e:
+            raise _transport_error(e)
+
+        if response.status_code >= 400:
+            error = _status_error(response.status_code, response.headers, _error_detail(response))
+            await response.aclose()
+            raise error
+    except UpstreamError as e:
+        breaker.record_error(e, time.monotonic() - started)
+        if api_key is not None:
+            backend.credentials.on_error(api_key, e)
+            # Bez odpowiedzi nie powstała żadna treść - cały szacunek wraca do kubełka TPM klucza
+            backend.credentials.reconcile(api_key, estimated_tokens, 0)
+        if slot_acquired:
+            limiter.on_error(e)
+            limiter.release()
+        raise
+    except BaseException:
+        # Anulowanie (np. CancelledError) nie świadczy o kondycji upstream, ale zwalnia slot próbny
+        breaker.record_error(None, time.monotonic() - started)
+        if api_key is not None:
+            backend.credentials.reconcile(api_key, estimated_tokens, 0)
+        if slot_acquired:
+            limiter.release()
+        raise
+
+    latency = time.monotonic() - started
+    breaker.record_success(latency)
+    backend.credentials.on_success(api_key)
+    limiter.on_success(task_type, latency)
+    if not stream:
+        limiter.release()
+    # Klucz, którym wysłano zapytanie - do rozliczenia faktycznego zużycia tokenów
+    response.api_key = api_key
+    response.ttfb = ttfb
+    latency_tracker.record(task_type, ttfb)
+    return response
+
+async def _ahedged_post_completion(payload, policy, timeout=None, estimated_tokens=0, rate_limit_wait=None,
+                                   deadline=None, backend=None):
+    """
+    Asynchroniczna wersja _hedged_post_completion() - przegrane zadanie jest anulowane
+    """
+    task_type = payload["metadata"]["task_type"]
+    policy.on_request(task_type)
+    delay = policy.hedge_delay(task_type)
+    if delay is None:
+        return await _apost_completion(payload, False, timeout, estimated_tokens, rate_limit_wait, deadline, backend)
+
+    limiter = (backend or openrouter_backend).concurrency_limiter
+
+    async def run(attempt_payload, first_byte):
+        try:
+            response = await _apost_completion(attempt_payload, True, timeout, estimated_tokens, rate_limit_wait,
+                                               deadline, backend)
+        finally:
+            first_byte.set()
+        try:
+            await response.aread()
+        except httpx.HTTPError as e:
+            raise _transport_error(e)
+        finally:
+            await response.aclose()
+            limiter.release()
+        return response
+
+    primary_first_byte = asyncio.Event()
+    primary = asyncio.ensure_future(run(payload, primary_first_byte))
+    try:
+        await asyncio.wait_for(primary_first_byte.wait(), delay)
+        headers_received = True
+    except asyncio.TimeoutError:
+        headers_received = False
+    if headers_received or not policy.try_spend(task_type):
+        return await primary
+
+    logger.info(f"⏱️ Brak odpowiedzi od {delay:.1f}s ({task_type}) - wysyłam zapytanie zabezpieczające")
+    hedge = asyncio.ensure_future(run(policy.hedge_payload(payload), asyncio.Event()))
+
+    pending = {primary, hedge}
+    first_error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                try:
+                    return task.result()
+                except UpstreamError as e:
+                    first_error = first_error or e
+        raise first_error
+    finally:
+        for task in pending:
+            task.cancel()
+
+async def async_send_api_request(prompt, max_tokens=2000, language='pl', user_tier='free', task_type='default', industry='general',
+                                 stream=False, timeout=None, max_retries=None, rate_limit_wait=None, hedge=False,
+                                 idempotency_key=None, deadline=None, backend=None, max_total_tokens=None,
+                                 detailed=False, cache=True, coalesce=True, document=None):
+    """
+    Asynchroniczna wersja send_api_request() - dla stream=True zwraca AsyncCompletionStream
+    """
+    _require_httpx()
+    deadline, backend, max_total_tokens = _resolve_send_options(task_type, backend, deadline, max_tokens,
+                                                                max_total_tokens, stream, detailed, idempotency_key)
+    if idempotency_key is not None:
+        return _caller_copy(await idempotency_store.arun(
+            idempotency_key,
+            _request_fingerprint(prompt, max_tokens, language, user_tier, task_type, industry, max_total_tokens,
+                                 detailed, document),
+            lambda: async_send_api_request(prompt, max_tokens, language, user_tier, task_type, industry,
+                                           timeout=timeout, max_retries=max_retries,
+                                           rate_limit_wait=rate_limit_wait, hedge=hedge, deadline=deadline,
+                                           backend=backend, max_total_tokens=max_total_tokens,
+                                           detailed=detailed, cache=cache, document=document),
+            deadline))
+    if coalesce and not stream:
+        return _caller_copy(await single_flight.ado(
+            _request_fingerprint("send_api_request", backend.name, prompt, max_tokens, language, user_tier, task_type,
+                                 industry, max_total_tokens, detailed, cache, document),
+            lambda: async_send_api_request(prompt, max_tokens, language, user_tier, task_type, industry,
+                                           timeout=timeout, max_retries=max_retries,
+                                           rate_limit_wait=rate_limit_wait, hedge=hedge, deadline=deadline,
+                                           backend=backend, max_total_tokens=max_total_tokens,
+                                           detailed=detailed, cache=cache, coalesce=False,
+                                           document=document),
+            deadline))
+
+    payload = _build_payload(prompt, max_tokens, language, user_tier, task_type, industry, document)
+    if stream:
+        _enable_streaming(payload)
+    call = _CompletionCall(payload, backend, deadline, max_tokens, max_total_tokens, task_type, stream, cache)
+    policy = None if stream or not backend.supports_hedging else _resolve_hedging(hedge)
+
+    def attempt():
+        payload = call.next_attempt()
+        if policy:
+            return _ahedged_post_completion(payload, policy, timeout, call.estimated_tokens, rate_limit_wait, deadline,
+                                            backend)
+        return backend.apost(payload, stream, timeout, call.estimated_tokens, rate_limit_wait, deadline)
+
+    # Zamykany klient nie serwuje już nawet odpowiedzi z cache
+    task = asyncio.current_task()
+    drain_controller.enter(task)
+    completion_stream = None
+    try:
+        cache_key = call.lookup_key()
+        cached = await response_cache.aget(cache_key) if cache_key is not None else None
+        if cached is not None:
+            logger.debug("Response served from cache")
+            return call.cached(cached, detailed)
+        logger.debug(f"Sending async request to OpenRouter API")
+        response = await _awith_retries(attempt, max_retries, deadline)
+        if stream:
+            completion_stream = AsyncCompletionStream(response, deadline, backend.concurrency_limiter,
+                                                      drain_controller.exit)
+            return completion_stream
+
+        call.add_response(response)
+        logger.debug("Received async response from OpenRouter API")
+        while call.continue_round():
+            try:
+                call.add_response(await _awith_retries(attempt, max_retries, deadline))
+            except UpstreamError as e:
+                logger.warning(f"Continuation failed, returning truncated response: {str(e)}")
+                break
+
+        details = call.finish()
+        entry = call.cache_entry()
+        if entry is not None:
+            await response_cache.aput(call.cache_key, entry, task_type)
+        return details if detailed else details.text
+
+    except UpstreamError as e:
+        logger.error(f"API request failed: {str(e)}")
+        raise
+    finally:
+        drain_controller.release_task(task)
+        if completion_stream is None:
+            drain_controller.exit()
+
+async def async_analyze_cv_score(cv_text, job_description="", language='pl', **options):
+    """
+    Asynchroniczna wersja analyze_cv_score()
+    """
+    return await async_send_api_request(**_analyze_cv_score_request(cv_text, job_description, language), **options)
+
+async def async_analyze_keywords_match(cv_text, job_description, language='pl', **options):
+    """
+    Asynchroniczna wersja analyze_keywords_match()
+    """
+    job_description = canonicalize_text(job_description)
+    if not job_description:
+        return NO_JOB_DESCRIPTION_MESSAGE
+
+    return await async_send_api_request(**_analyze_keywords_match_request(cv_text, job_description, language), **options)
+
+async def async_check_grammar_and_style(cv_text, language='pl', **options):
+    """
+    Asynchroniczna wersja check_grammar_and_style()
+    """
+    return await async_send_api_request(**_check_grammar_and_style_request(cv_text, language), **options)
+
+async def async_optimize_for_position(cv_text, job_title, job_description="", language='pl', **options):
+    """
+    Asynchroniczna wersja optimize_for_position()
+    """
+    return await async_send_api_request(**_optimize_for_position_request(cv_text, job_title, job_description, language), **options)
+
+async def async_generate_interview_tips(cv_text, job_description="", language='pl', **options):
+    """
+    Asynchroniczna wersja generate_interview_tips()
+    """
+    return await async_send_api_request(**_generate_interview_tips_request(cv_text, job_description, language), **options)
+
+async def async_generate_improved_cv(cv_text, improvement_focus='general', target_industry='', language='pl', is_premium=False, payment_verified=False, **options):
+    """
+    Asynchroniczna wersja generate_improved_cv()
+    """
+    return await async_send_api_request(**_generate_improved_cv_request(cv_text, improvement_focus, target_industry, language, is_premium, payment_verified), **options)
+
+async def async_apply_recruiter_feedback_to_cv(cv_text, recruiter_feedback, job_description="", language='pl', is_premium=False, payment_verified=False, **options):
+    """
+    Asynchroniczna wersja apply_recruiter_feedback_to_cv()
+    """
+    return await async_send_api_request(**_apply_recruiter_feedback_to_cv_request(cv_text, recruiter_feedback, job_description, language, is_premium, payment_verified), **options)
+
+async def async_analyze_polish_job_posting(job_description, language='pl', **options):
+    """
+    Asynchroniczna wersja analyze_polish_job_posting()
+    """
+    return await async_send_api_request(**_analyze_polish_job_posting_request(job_description, language), **options)
+
+async def async_optimize_cv_for_specific_position(cv_text, target_position, job_description, company_name="", language='pl', is_premium=False, payment_verified=False, **options):
+    """
+    Asynchroniczna wersja optimize_cv_for_specific_position()
+    """
+    return await async_send_api_request(**_optimize_cv_for_specific_position_request(cv_text, target_position, job_description, company_name, language, is_premium, payment_verified), **options)
+
+async def async_generate_complete_cv_content(target_position, experience_level, industry, brief_background, language='pl', **options):
+    """
+    Asynchroniczna wersja generate_complete_cv_content()
+    """
+    return await async_send_api_request(**_generate_complete_cv_content_request(target_position, experience_level, industry, brief_background, language), **options)
+
+async def async_optimize_cv(cv_text, job_description, language='pl', is_premium=False, payment_verified=False, **options):
+    """
+    Asynchroniczna wersja optimize_cv()
+    """
+    return await async_send_api_request(**_optimize_cv_request(cv_text, job_description, language, is_premium, payment_verified), **options)
+
+async def async_generate_recruiter_feedback(cv_text, job_description="", language='pl', **options):
+    """
+    Asynchroniczna wersja generate_recruiter_feedback()
+    """
+    return await async_send_api_request(**_generate_recruiter_feedback_request(cv_text, job_description, language), **options)
+
+async def async_generate_cover_letter(cv_text, job_description, language='pl', **options):
+    """
+    Asynchroniczna wersja generate_cover_letter()
+    """
+    return await async_send_api_request(**_generate_cover_letter_request(cv_text, job_description, language), **options)
+
+async def async_summarize_job_description(job_text, **options):
+    """
+    Asynchroniczna wersja summarize_job_description()
+    """
+    return await async_send_api_request(**_summarize_job_description_request(job_text), **options)
+
+async def async_ats_optimization_check(cv_text, job_description="", language='pl', **options):
+    """
+    Asynchroniczna wersja ats_optimization_check()
+    """
+    return await async_send_api_request(**_ats_optimization_check_request(cv_text, job_description, language), **options)
+
+async def async_analyze_cv_strengths(cv_text, job_title="analityk danych", language='pl', **options):
+    """
+    Asynchroniczna wersja analyze_cv_strengths()
+    """
+    return await async_send_api_request(**_analyze_cv_strengths_request(cv_text, job_title, language), **options)
+
+async def async_generate_interview_questions(cv_text, job_description="", language='pl', **options):
+    """
+    Asynchroniczna wersja generate_interview_questions()
+    """
+    return await async_send_api_request(**_generate_interview_questions_request(cv_text, job_description, language), **options)
+
+async def async_enhanced_cv_optimization_with_reasoning(cv_text, job_description, language='pl', is_premium=False, payment_verified=False, **options):
+    """
+    Asynchroniczna wersja enhanced_cv_optimization_with_reasoning()
+    """
+    return await async_send_api_request(**_enhanced_cv_optimization_with_reasoning_request(cv_text, job_description, language, is_premium, payment_verified), **options)
+
+async def _afetch_job_page(url, deadline=None):
+    try:
+        response = await async_client.get(url, headers=JOB_PAGE_HEADERS, timeout=_job_fetch_timeout(deadline))
+    except httpx.HTTPError as e:
+        raise _transport_error(e, prefix=JOB_FETCH_ERROR_PREFIX)
+
+    if response.status_code >= 400:
+        raise _status_error(response.status_code, response.headers, response.reason_phrase, prefix=JOB_FETCH_ERROR_PREFIX)
+    return response.text
+
+async def async_analyze_job_url(url, idempotency_key=None, deadline=None, coalesce=True):
+    """
+    Asynchroniczna wersja analyze_job_url()
+    """
+    _require_httpx()
+    deadline = _resolve_deadline(deadline)
+    if idempotency_key is not None:
+        return await idempotency_store.arun(idempotency_key, _request_fingerprint("analyze_job_url", url),
+                                            lambda: async_analyze_job_url(url, deadline=deadline), deadline)
+    if coalesce:
+        return await single_flight.ado(_request_fingerprint("analyze_job_url", _canonical_job_url(url)),
+                                       lambda: async_analyze_job_url(url, deadline=deadline, coalesce=False),
+                                       deadline)
+
+    try:
+        logger.debug(f"Analyzing job URL: {url}")
+
+        parsed_url = _parse_job_url(url)
+
+        html = await _awith_retries(lambda: _afetch_job_page(url, deadline), deadline=deadline)
+
+        # Parsowanie HTML obciąża CPU - wykonujemy je poza pętlą zdarzeń
+        job_text = await asyncio.to_thread(_extract_job_text, html, parsed_url.netloc.lower())
+
+        logger.debug(f"Successfully extracted job description from URL")
+
+        if len(job_text) > 4000:
+            logger.debug(f"Job description is long ({len(job_text)} chars), summarizing with AI")
+            job_text = await async_summarize_job_description(job_text, deadline=deadline)
+
+        return job_text
+
+    except UpstreamError as e:
+        logger.error(f"Upstream error while analyzing job URL: {str(e)}")
+        raise
+
+    except Exception as e:
+        logger.error(f"Error analyzing job URL: {str(e)}")
+        raise Exception(f"Failed to analyze job posting: {str(e)}")
+
+async def async_warmup(connections=HTTP_POOL_CONNECTIONS, timeout=None):
+    """
+    Asynchroniczna wersja warmup() - rozgrzewa klienta httpx w bieżącej pętli zdarzeń
+    """
+    _require_httpx()
+    started = time.monotonic()
+    stats = {"transport": async_client.transport, "api_keys": len(api_key_pool), "dns_seconds": None, "connections": 0}
+    try:
+        step_started = time.monotonic()
+        await asyncio.to_thread(_resolve_host, async_client.base_url)
+        stats["dns_seconds"] = time.monotonic() - step_started
+        stats["connections"] = await async_client.warmup(connections, timeout)
+    except (OSError, httpx.HTTPError) as e:
+        logger.warning(f"⚠️ Rozgrzewanie połączeń z OpenRouter nie powiodło się: {str(e)}")
+    stats["seconds"] = time.monotonic() - started
+    logger.info(f"🔥 Asynchroniczny klient OpenRouter rozgrzany w {stats['seconds']:.2f}s "
+                f"({stats['connections']} połączeń {stats['transport']})")
+    return stats
+
+def _backend_clients(attribute):
+    """
+    Klienci HTTP (attribute: "client" albo "async_client") klienta modułu i zarejestrowanych backendów, bez powtórzeń
+    """
+    clients = {}
+    for owner in [openrouter_backend, *completion_backends.values()]:
+        backend_client = getattr(owner, attribute, None)
+        if backend_client is not None:
+            clients.setdefault(id(backend_client), backend_client)
+    return list(clients.values())
+
+def shutdown(grace=None):
+    """
+    Łagodne zamknięcie klienta (np. w hooku zamykania workera): odrzuca nowe wywołania, czeka do grace
+    sekund (SHUTDOWN_GRACE_PERIOD) na trwające, anuluje resztę pracy asynchronicznej i w tle
+    oraz zapisuje magazyn wyników idempotencji, jeśli ma ustawioną ścieżkę
+    """
+    stats = drain_controller.shutdown(grace)
+    for backend_client in _backend_clients("client"):
+        backend_client.close()
+    return stats
+
+async def async_shutdown(grace=None):
+    """
+    Asynchroniczna wersja shutdown() - czeka na wywołania bez blokowania bieżącej pętli zdarzeń
+    """
+    stats = await drain_controller.async_shutdown(grace)
+    for backend_client in _backend_clients("client"):
+        backend_client.close()
+    if httpx is not None:
+        for backend_client in _backend_clients("async_client"):
+            await backend_client.aclose()
+    return stats
@@ -0,0 +1,841 @@
+"""
+Testy regresji łączenia identycznych wywołań (single-flight) na FakeBackend - bez sieci i kluczy API.
+Uruchomienie: python -m pytest attached_assets/test_openrouter_api.py
+"""
+import asyncio
+import gc
+import http.server
+import importlib.util
+import json
+import os
+import pathlib
+import tempfile
+import threading
+import time
+import unicodedata
+import unittest
+from unittest import mock
+
+MODULE_PATH = pathlib.Path(__file__).with_name("openrouter_api (2)_1755899042592.py")
+_spec = importlib.util.spec_from_file_location("openrouter_api", MODULE_PATH)
+openrouter_api = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(openrouter_api)
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def setUp(self):
+        openrouter_api.response_cache.clear()
+        self.backend = openrouter_api.FakeBackend(latency=0.3)
+
+    def test_owner_cancellation_is_taken_over_by_async_waiter(self):
+        async def scenario():
+            owner = asyncio.create_task(openrouter_api.async_send_api_request("oferta", backend=self.backend))
+            await asyncio.sleep(0.05)
+            waiter = asyncio.create_task(openrouter_api.async_send_api_request("oferta", backend=self.backend))
+            await asyncio.sleep(0.05)
+            owner.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await owner
+            return await waiter
+
+        self.assertEqual(asyncio.run(scenario()), "oferta")
+        # Anulowany właściciel nie doczekał odpowiedzi - jedyne zapytanie wykonał przejmujący oczekujący
+        self.assertEqual(len(self.backend.requests), 1)
+
+    def test_owner_cancellation_is_taken_over_by_sync_waiter(self):
+        outcome = {}
+
+        def sync_waiter():
+            try:
+                outcome["result"] = openrouter_api.send_api_request("oferta", backend=self.backend)
+            except BaseException as e:
+                outcome["error"] = e
+
+        async def scenario():
+            owner = asyncio.create_task(openrouter_api.async_send_api_request("oferta", backend=self.backend))
+            await asyncio.sleep(0.05)
+            thread = threading.Thread(target=sync_waiter)
+            thread.start()
+            await asyncio.sleep(0.05)
+            owner.cancel()
+            await asyncio.gather(owner, return_exceptions=True)
+            await asyncio.to_thread(thread.join)
+
+        asyncio.run(scenario())
+        self.assertEqual(outcome, {"result": "oferta"})
+
+    def test_waiter_deadline_bounds_the_wait(self):
+        self.backend.latency = 0.45
+        owner = threading.Thread(target=openrouter_api.send_api_request, args=("cv",),
+                                 kwargs={"backend": self.backend})
+        owner.start()
+        time.sleep(0.05)
+        started = time.monotonic()
+        with self.assertRaises(openrouter_api.DeadlineExceededError):
+            openrouter_api.send_api_request("cv", backend=self.backend, deadline=0.1)
+        self.assertLess(time.monotonic() - started, 0.3)
+        owner.join()
+
+    def test_async_waiter_deadline_bounds_the_wait(self):
+        async def scenario():
+            owner = asyncio.create_task(openrouter_api.async_send_api_request("cv", backend=self.backend))
+            await asyncio.sleep(0.05)
+            started = time.monotonic()
+            with self.assertRaises(openrouter_api.DeadlineExceededError):
+                await openrouter_api.async_send_api_request("cv", backend=self.backend, deadline=0.1)
+            waited = time.monotonic() - started
+            return await owner, waited
+
+        result, waited = asyncio.run(scenario())
+        self.assertEqual(result, "cv")
+        self.assertLess(waited, 0.2)
+
+    def test_cache_bypass_is_not_coalesced_with_cached_call(self):
+        self.backend.responses = ["stara odpowiedź", "nowa odpowiedź"]
+        results = {}
+        normal = threading.Thread(target=lambda: results.setdefault(
+            "normal", openrouter_api.send_api_request("ocena", backend=self.backend)))
+        normal.start()
+        time.sleep(0.05)
+        results["refresh"] = openrouter_api.send_api_request("ocena", backend=self.backend, cache=False)
+        normal.join()
+        self.assertEqual(results, {"normal": "stara odpowiedź", "refresh": "nowa odpowiedź"})
+        self.assertEqual(len(self.backend.requests), 2)
+
+    def test_coalesced_callers_get_their_own_detailed_result(self):
+        async def scenario():
+            return await asyncio.gather(*(openrouter_api.async_send_api_request("cv", backend=self.backend,
+                                                                                detailed=True)
+                                          for _ in range(3)))
+
+        results = asyncio.run(scenario())
+        self.assertEqual(len(self.backend.requests), 1)
+        self.assertEqual(len({id(result) for result in results}), 3)
+        results[0].text = "zmieniony"
+        self.assertEqual([result.text for result in results[1:]], ["cv", "cv"])
+
+
+class DeadlineTest(unittest.TestCase):
+
+    def test_close_deadline_shrinks_max_tokens_instead_of_failing(self):
+        deadline = openrouter_api.Deadline(0.5)
+        self.assertEqual(deadline.max_tokens(4000), openrouter_api.DEADLINE_MIN_TOKENS)
+        self.assertEqual(deadline.max_tokens(10), 10)
+
+    def test_passed_deadline_raises(self):
+        deadline = openrouter_api.Deadline(0)
+        with self.assertRaises(openrouter_api.DeadlineExceededError):
+            deadline.max_tokens(4000)
+
+
+class ContinuationTest(unittest.TestCase):
+
+    def setUp(self):
+        openrouter_api.response_cache.clear()
+        self.answer = " ".join(f"punkt{i}" for i in range(400))
+        # Kontynuacja dostaje dotychczasową odpowiedź jako ostatnią wiadomość i dopisuje resztę
+        self.backend = openrouter_api.FakeBackend(
+            lambda payload: self.answer[len(openrouter_api._message_text(payload["messages"][-1]))
+                                        if payload["messages"][-1]["role"] == "assistant" else 0:])
+
+    def test_cut_off_answer_is_stitched_from_continuations(self):
+        result = openrouter_api.send_api_request("cv", max_tokens=300, backend=self.backend, detailed=True)
+        self.assertEqual(result.text, self.answer)
+        self.assertEqual(result.finish_reason, "stop")
+        self.assertEqual(result.continuations, len(self.backend.requests) - 1)
+        self.assertGreaterEqual(result.continuations, 1)
+
+    def test_default_cap_counts_only_continuation_tokens(self):
+        self.answer = "x" * int(9000 * openrouter_api.CHARS_PER_TOKEN)
+        result = openrouter_api.send_api_request("cv", max_tokens=8000, backend=self.backend, detailed=True)
+        self.assertEqual(result.text, self.answer)
+        self.assertEqual(result.continuations, 1)
+
+    def test_max_total_tokens_zero_disables_continuation(self):
+        result = openrouter_api.send_api_request("cv", max_tokens=300, backend=self.backend, detailed=True,
+                                                 max_total_tokens=0)
+        self.assertEqual(result.finish_reason, "length")
+        self.assertEqual(len(self.backend.requests), 1)
+
+    def test_answer_cut_off_by_deadline_is_not_continued(self):
+        result = openrouter_api.send_api_request("cv", max_tokens=1000, backend=self.backend, detailed=True,
+                                                 deadline=2)
+        self.assertEqual(result.finish_reason, "length")
+        self.assertEqual(len(self.backend.requests), 1)
+        self.assertLess(self.backend.requests[0]["max_tokens"], 1000)
+
+
+class APIKeyPoolTest(unittest.TestCase):
+
+    KEYS = ["sk-or-v1-" + "a" * 40, "sk-or-v1-" + "b" * 40]
+
+    def test_requests_rotate_to_the_key_with_most_headroom(self):
+        pool = openrouter_api.APIKeyPool(self.KEYS, requests_per_minute=1, tokens_per_minute=0)
+        first, second = pool.acquire(wait=0), pool.acquire(wait=0)
+        self.assertIsNot(first, second)
+        with self.assertRaises(openrouter_api.RateLimitExceededError):
+            pool.acquire(wait=0)
+
+    def test_rate_limited_key_cools_down_and_error_moves_to_another_key(self):
+        pool = openrouter_api.APIKeyPool(self.KEYS, requests_per_minute=0, tokens_per_minute=0)
+        key = pool.acquire()
+        error = openrouter_api._status_error(429, {}, "limit")
+        pool.on_error(key, error)
+        self.assertTrue(error.retryable)
+        for _ in range(3):
+            self.assertIsNot(pool.acquire(), key)
+
+    def test_last_key_is_not_parked_longer_than_retry_backoff(self):
+        pool = openrouter_api.APIKeyPool(self.KEYS[:1], requests_per_minute=0, tokens_per_minute=0)
+        key = pool.acquire()
+        pool.on_error(key, openrouter_api._status_error(429, {}, "limit"))
+        self.assertLessEqual(pool.stats()[key.label]["disabled_for"], openrouter_api.RETRY_BACKOFF_MAX)
+
+    def test_failed_request_refunds_the_token_estimate(self):
+        pool = openrouter_api.APIKeyPool(self.KEYS[:1], requests_per_minute=0, tokens_per_minute=1000)
+        # Port 9 na localhost odrzuca połączenie - zapytanie kończy się błędem bez odpowiedzi
+        backend = openrouter_api.OpenAICompatibleBackend("http://127.0.0.1:9/v1/chat/completions")
+        backend.credentials = pool
+        payload = openrouter_api._build_payload("cv", 400, 'pl', 'free', 'default', 'general', None)
+        with self.assertRaises(openrouter_api.UpstreamError):
+            openrouter_api._post_completion(payload, estimated_tokens=600, backend=backend)
+        self.assertGreater(next(iter(pool.stats().values()))["tokens_available"], 990)
+
+    def test_configure_replaces_the_limits_of_every_key(self):
+        pool = openrouter_api.APIKeyPool(self.KEYS, requests_per_minute=1, tokens_per_minute=0)
+        pool.configure(0, 500)
+        for key_stats in pool.stats().values():
+            self.assertIsNone(key_stats["requests_available"])
+            self.assertEqual(key_stats["tokens_available"], 500)
+
+
+class DrainTest(unittest.TestCase):
+
+    def setUp(self):
+        openrouter_api.response_cache.clear()
+        self.backend = openrouter_api.FakeBackend(latency=0.3)
+        # Własny licznik i brak puli hedgingu - shutdown() w teście nie zamyka stanu współdzielonego przez inne testy
+        patcher = mock.patch.multiple(openrouter_api, drain_controller=openrouter_api.DrainController(),
+                                      _hedge_executor=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_shutdown_waits_for_in_flight_calls(self):
+        results = []
+        worker = threading.Thread(target=lambda: results.append(
+            openrouter_api.send_api_request("cv", backend=self.backend)))
+        worker.start()
+        time.sleep(0.05)
+        stats = openrouter_api.drain_controller.shutdown(grace=2)
+        worker.join()
+        self.assertEqual(stats["abandoned"], 0)
+        self.assertEqual(results, ["cv"])
+
+    def test_draining_client_rejects_cached_calls_too(self):
+        self.backend.latency = 0
+        openrouter_api.send_api_request("cv", backend=self.backend)
+        openrouter_api.drain_controller.shutdown(grace=0)
+        with self.assertRaises(openrouter_api.ShuttingDownError):
+            openrouter_api.send_api_request("cv", backend=self.backend)
+        with self.assertRaises(openrouter_api.ShuttingDownError):
+            asyncio.run(openrouter_api.async_send_api_request("cv", backend=self.backend))
+
+    def test_abandoned_stream_closes_its_response(self):
+        response = mock.Mock()
+        openrouter_api.drain_controller.enter()
+        stream = openrouter_api.CompletionStream(response, on_close=openrouter_api.drain_controller.exit)
+        del stream
+        gc.collect()
+        response.close.assert_called()
+        self.assertEqual(openrouter_api.drain_controller.in_flight, 0)
+
+
+class PromptLayoutTest(unittest.TestCase):
+
+    def test_system_prompt_is_shared_by_every_task_type(self):
+        payloads = [openrouter_api._build_payload("zadanie", task_type=task_type, document="CV")
+                    for task_type in ("default", "cv_optimization", "cover_letter")]
+        self.assertEqual(len({payload["messages"][0]["content"] for payload in payloads}), 1)
+
+    def test_document_comes_before_task_instructions(self):
+        payload = openrouter_api._build_payload("zadanie", task_type="cv_optimization", document="Jan Kowalski")
+        user_text = openrouter_api._message_text(payload["messages"][-1])
+        self.assertTrue(user_text.startswith("CV KANDYDATA:\nJan Kowalski"))
+        self.assertTrue(user_text.endswith("zadanie"))
+
+
+class CanonicalizeTextTest(unittest.TestCase):
+
+    def test_pastes_from_different_editors_give_the_same_text(self):
+        word = "Doświadczenie:\r\n\r\n\r\n• Python\u00a0\u00a0i  Django   \r\n"
+        plain = unicodedata.normalize("NFD", "Doświadczenie:\n\n- Python i Django\n")
+        self.assertEqual(openrouter_api.canonicalize_text(word), openrouter_api.canonicalize_text(plain))
+        self.assertEqual(openrouter_api.canonicalize_text(plain), "Doświadczenie:\n\n- Python i Django")
+
+    def test_indentation_is_kept(self):
+        text = "Umiejętności:\n  • Python\n      ◦ asyncio  \n\tSQL"
+        self.assertEqual(openrouter_api.canonicalize_text(text),
+                         "Umiejętności:\n  - Python\n      - asyncio\n\tSQL")
+
+    def test_whitespace_only_job_description_counts_as_missing(self):
+        with mock.patch.object(openrouter_api, "send_api_request") as send:
+            result = openrouter_api.analyze_keywords_match("CV", " \u200b\n\u00a0 ")
+        self.assertEqual(result, openrouter_api.NO_JOB_DESCRIPTION_MESSAGE)
+        send.assert_not_called()
+
+
+class _ModelsHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    paths = []
+
+    def _reply(self, status):
+        self.paths.append((self.command, self.path))
+        body = b'{"data": []}' if status == 200 else b""
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._reply(200 if self.path == "/v1/models" else 405)
+
+    def do_HEAD(self):
+        self._reply(405)
+
+    def log_message(self, *args):
+        pass
+
+
+class WarmupTest(unittest.TestCase):
+
+    def setUp(self):
+        _ModelsHandler.paths = []
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _ModelsHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.base = f"http://127.0.0.1:{self.server.server_port}/v1"
+
+    def test_warmup_gets_the_model_list(self):
+        client = openrouter_api.OpenRouterClient(base_url=self.base + "/chat/completions")
+        self.addCleanup(client.close)
+        self.assertEqual(client.warmup(connections=2), 2)
+        self.assertEqual(_ModelsHandler.paths, [("GET", "/v1/models")] * 2)
+
+    def test_error_response_is_not_counted_as_warm(self):
+        client = openrouter_api.OpenRouterClient(base_url=self.base + "/other")
+        self.addCleanup(client.close)
+        with self.assertLogs(openrouter_api.logger, "WARNING"):
+            self.assertEqual(client.warmup(), 0)
+
+
+class BackendRegistryTest(unittest.TestCase):
+
+    def test_fake_backend_is_not_registered_in_production(self):
+        self.assertNotIn("fake", openrouter_api.completion_backends)
+        with self.assertRaises(ValueError):
+            openrouter_api.get_backend(backend="fake")
+
+    def test_registered_backend_serves_routed_task_types(self):
+        backend = openrouter_api.FakeBackend("lokalnie", name="test_local")
+        with mock.patch.dict(openrouter_api.completion_backends), mock.patch.dict(openrouter_api.BACKEND_ROUTES):
+            openrouter_api.register_backend(backend, task_types=["interview_prep"])
+            self.assertEqual(openrouter_api.send_api_request("pytania", task_type="interview_prep", cache=False),
+                             "lokalnie")
+        self.assertEqual(len(backend.requests), 1)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.breaker = openrouter_api.CircuitBreaker("model@test", min_calls=4, failure_rate=0.5, open_seconds=0.05,
+                                                     half_open_probes=1)
+
+    def fail(self, times):
+        for _ in range(times):
+            self.breaker.before_call()
+            self.breaker.record_error(openrouter_api.UpstreamServerError("HTTP 502", 502), 0.01)
+
+    def test_opens_after_failure_rate_and_rejects_calls(self):
+        self.breaker.before_call()
+        self.breaker.record_success(0.01)
+        self.fail(3)
+        self.assertEqual(self.breaker.state, openrouter_api.CircuitBreaker.OPEN)
+        with self.assertRaises(openrouter_api.CircuitOpenError):
+            self.breaker.before_call()
+
+    def test_client_errors_do_not_open_the_circuit(self):
+        for _ in range(6):
+            self.breaker.before_call()
+            self.breaker.record_error(openrouter_api.UpstreamError("HTTP 400", 400), 0.01)
+        self.assertEqual(self.breaker.state, openrouter_api.CircuitBreaker.CLOSED)
+
+    def test_half_open_probe_closes_the_circuit_on_success(self):
+        self.fail(4)
+        time.sleep(0.06)
+        self.breaker.before_call()
+        self.assertEqual(self.breaker.state, openrouter_api.CircuitBreaker.HALF_OPEN)
+        # Jedno zapytanie próbne naraz - kolejne są odrzucane do jego wyniku
+        with self.assertRaises(openrouter_api.CircuitOpenError):
+            self.breaker.before_call()
+        self.breaker.record_success(0.01)
+        self.assertEqual(self.breaker.state, openrouter_api.CircuitBreaker.CLOSED)
+
+    def test_failed_probe_opens_the_circuit_again(self):
+        self.fail(4)
+        time.sleep(0.06)
+        self.fail(1)
+        self.assertEqual(self.breaker.state, openrouter_api.CircuitBreaker.OPEN)
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def test_bucket_refills_at_the_per_minute_rate(self):
+        bucket = openrouter_api.TokenBucket(60)
+        now = time.monotonic()
+        self.assertEqual(bucket.wait_time(60, now), 0.0)
+        bucket.consume(60)
+        self.assertAlmostEqual(bucket.wait_time(1, now), 1.0)
+        self.assertEqual(bucket.wait_time(1, now + 1.0), 0.0)
+        # Pojemność ogranicza uzupełnianie do limitu na minutę
+        bucket._refill(now + 3600)
+        self.assertEqual(bucket.tokens, 60)
+
+    def test_wait_zero_rejects_when_requests_are_used_up(self):
+        limiter = openrouter_api.RateLimiter(requests_per_minute=2, tokens_per_minute=0)
+        limiter.acquire(wait=0)
+        limiter.acquire(wait=0)
+        with self.assertRaises(openrouter_api.RateLimitExceededError) as raised:
+            limiter.acquire(wait=0)
+        self.assertAlmostEqual(raised.exception.retry_after, 30, delta=1)
+
+    def test_reconcile_returns_unused_tokens(self):
+        limiter = openrouter_api.RateLimiter(requests_per_minute=0, tokens_per_minute=1000)
+        limiter.acquire(tokens=800)
+        limiter.reconcile(800, 300)
+        self.assertAlmostEqual(limiter.stats()["tokens_available"], 700, delta=1)
+        # Zużycie większe niż szacunek niczego nie zwraca
+        limiter.reconcile(100, 300)
+        self.assertAlmostEqual(limiter.stats()["tokens_available"], 700, delta=1)
+
+
+class _ChatHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serwer zgodny z OpenAI: odpowiada nazwą modelu, model spoza fast_models dopiero po slow_seconds
+    """
+    protocol_version = "HTTP/1.1"
+    fast_models = ()
+    slow_seconds = 1.0
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if body["model"] not in self.fast_models:
+            time.sleep(self.slow_seconds)
+        reply = json.dumps({"model": body["model"], "choices": [
+            {"message": {"role": "assistant", "content": body["model"]}, "finish_reason": "stop"}]}).encode()
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(reply)))
+            self.end_headers()
+            self.wfile.write(reply)
+        except OSError:
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class HedgingTest(unittest.TestCase):
+
+    def setUp(self):
+        openrouter_api.response_cache.clear()
+        _ChatHandler.fast_models = ("hedge-model",)
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _ChatHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.backend = openrouter_api.OpenAICompatibleBackend(
+            f"http://127.0.0.1:{self.server.server_port}/v1/chat/completions", name="hedge_test")
+        self.addCleanup(self.backend.client.close)
+        # TTFB z historii task_type ustala próg hedgingu (tu min_delay)
+        openrouter_api.latency_tracker.record("hedge_test", 0.01)
+        self.policy = openrouter_api.HedgingPolicy(min_delay=0.1, budget=1.0, min_samples=1,
+                                                   alternate_model="hedge-model")
+
+    def send(self):
+        return openrouter_api.send_api_request("cv", task_type="hedge_test", backend=self.backend, hedge=self.policy,
+                                               cache=False, max_retries=0)
+
+    def test_faster_hedge_wins_and_slow_primary_is_cancelled(self):
+        started = time.monotonic()
+        self.assertEqual(self.send(), "hedge-model")
+        self.assertLess(time.monotonic() - started, 0.8)
+        self.assertEqual(self.policy.stats()["hedge_test"], {"requests": 1, "hedges": 1})
+        # Anulowana próba główna oddaje miejsce w limicie po nadejściu nagłówków, bez czytania treści
+        time.sleep(_ChatHandler.slow_seconds)
+        deadline = time.monotonic() + 1.0
+        while self.backend.concurrency_limiter.in_flight and time.monotonic() < deadline:
+            time.sleep(0.02)
+        self.assertEqual(self.backend.concurrency_limiter.in_flight, 0)
+
+    def test_no_hedge_without_budget(self):
+        self.policy.budget = 0.0
+        _ChatHandler.slow_seconds = 0.2
+        self.addCleanup(setattr, _ChatHandler, "slow_seconds", 1.0)
+        self.assertEqual(self.send(), openrouter_api.DEFAULT_MODEL)
+        self.assertEqual(self.policy.stats()["hedge_test"], {"requests": 1, "hedges": 0})
+
+
+class AdaptiveConcurrencyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.limiter = openrouter_api.AdaptiveConcurrencyLimiter(initial_limit=4, min_limit=1, max_limit=10,
+                                                                 backoff_ratio=0.5, decrease_cooldown=0.05)
+
+    def test_successes_at_high_utilisation_raise_the_limit(self):
+        for _ in range(4):
+            self.limiter.acquire()
+        for _ in range(8):
+            self.limiter.on_success("default", 0.1)
+        self.assertGreater(self.limiter.limit, 4)
+
+    def test_idle_limiter_does_not_grow(self):
+        for _ in range(20):
+            self.limiter.on_success("default", 0.1)
+        self.assertEqual(self.limiter.limit, 4)
+
+    def test_overload_halves_the_limit_once_per_cooldown(self):
+        self.limiter.on_error(openrouter_api.RateLimitedError("HTTP 429", 429))
+        self.limiter.on_error(openrouter_api.UpstreamServerError("HTTP 503", 503))
+        self.assertEqual(self.limiter.limit, 2)
+        time.sleep(0.06)
+        for _ in range(3):
+            self.limiter.on_error(openrouter_api.UpstreamTimeoutError("timeout"))
+            time.sleep(0.06)
+        self.assertEqual(self.limiter.limit, self.limiter.min_limit)
+
+    def test_client_errors_keep_the_limit(self):
+        self.limiter.on_error(openrouter_api.UpstreamError("HTTP 400", 400))
+        self.assertEqual(self.limiter.limit, 4)
+
+    def test_latency_spike_lowers_the_limit(self):
+        self.limiter.on_success("default", 1.0)
+        self.limiter.on_success("default", 5.0)
+        self.assertEqual(self.limiter.limit, 2)
+
+    def test_full_limit_makes_callers_wait_for_a_release(self):
+        for _ in range(4):
+            self.limiter.acquire()
+        threading.Timer(0.1, self.limiter.release).start()
+        started = time.monotonic()
+        self.limiter.acquire(timeout=1)
+        self.assertGreaterEqual(time.monotonic() - started, 0.09)
+        self.assertEqual(self.limiter.in_flight, 4)
+
+
+class PayloadEncodingTest(unittest.TestCase):
+
+    def test_payloads_share_the_template_system_message(self):
+        first = openrouter_api._build_payload("a", task_type="cv_optimization")
+        second = openrouter_api._build_payload("b", task_type="cv_optimization")
+        self.assertIs(first["messages"][0], second["messages"][0])
+
+    def test_encoded_payload_matches_plain_json(self):
+        payload = openrouter_api._build_payload("zadanie „z cudzysłowem”", document="CV", task_type="cover_letter")
+        for codec in ("json", "auto"):
+            with self.subTest(codec=codec), mock.patch.object(openrouter_api, "json_codec",
+                                                              openrouter_api._resolve_json_codec(codec)):
+                self.assertEqual(json.loads(openrouter_api._encode_payload(payload)), payload)
+
+    def test_modified_system_message_is_encoded_as_is(self):
+        payload = openrouter_api._build_payload("zadanie")
+        payload["messages"][0] = {"role": "system", "content": "inny prompt"}
+        self.assertEqual(json.loads(openrouter_api._encode_payload(payload))["messages"][0]["content"], "inny prompt")
+
+    def test_unknown_codec_is_rejected(self):
+        with self.assertRaises(ValueError):
+            openrouter_api._resolve_json_codec("simplejson")
+
+
+class IdempotencyTest(unittest.TestCase):
+
+    def setUp(self):
+        openrouter_api.response_cache.clear()
+        self.backend = openrouter_api.FakeBackend(["pierwsza", "druga"])
+        patcher = mock.patch.object(openrouter_api, "idempotency_store", openrouter_api.IdempotencyStore(path=None))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def send(self, prompt="cv", **options):
+        return openrouter_api.send_api_request(prompt, backend=self.backend, idempotency_key="zlecenie-1",
+                                               cache=False, **options)
+
+    def test_repeated_key_returns_the_stored_result(self):
+        self.assertEqual(self.send(), "pierwsza")
+        self.assertEqual(self.send(), "pierwsza")
+        self.assertEqual(len(self.backend.requests), 1)
+
+    def test_key_reused_with_different_parameters_is_rejected(self):
+        self.send()
+        with self.assertRaises(ValueError):
+            self.send("inne cv")
+
+    def test_errors_are_not_stored(self):
+        self.backend.responses = [openrouter_api.UpstreamServerError("HTTP 502", 502), "po błędzie"]
+        with self.assertRaises(openrouter_api.UpstreamServerError):
+            self.send(max_retries=0)
+        self.assertEqual(self.send(max_retries=0), "po błędzie")
+
+    def test_saved_results_survive_a_restart(self):
+        self.send()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "idempotency.json")
+        self.assertEqual(openrouter_api.idempotency_store.save(path), 1)
+        with mock.patch.object(openrouter_api, "idempotency_store", openrouter_api.IdempotencyStore(path=path)):
+            self.assertEqual(self.send(), "pierwsza")
+        self.assertEqual(len(self.backend.requests), 1)
+
+
+class LoadSheddingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.limiter = openrouter_api.AdaptiveConcurrencyLimiter(initial_limit=1, max_limit=1, max_queue=4,
+                                                                 max_queue_wait=0.3)
+        self.limiter.acquire()
+        self.waiters = []
+
+    def tearDown(self):
+        for _ in self.waiters:
+            self.limiter.release()
+        for waiter in self.waiters:
+            waiter.join()
+
+    def queue(self, task_type):
+        waiter = threading.Thread(target=self.limiter.acquire, kwargs={"task_type": task_type})
+        waiter.start()
+        self.waiters.append(waiter)
+        deadline = time.monotonic() + 1
+        while self.limiter.stats()["waiting"] < len(self.waiters) and time.monotonic() < deadline:
+            time.sleep(0.005)
+
+    def test_low_priority_tasks_are_shed_first(self):
+        self.queue("default")
+        self.queue("default")
+        # "low" może zająć połowę kolejki, "normal" - 80%
+        with self.assertRaises(openrouter_api.OverloadedError):
+            self.limiter.acquire(task_type="interview_prep")
+        self.queue("default")
+        self.assertEqual(self.limiter.stats()["shed"], {"interview_prep": 1})
+
+    def test_queue_wait_is_bounded(self):
+        started = time.monotonic()
+        with self.assertRaises(openrouter_api.OverloadedError):
+            self.limiter.acquire()
+        self.assertLess(time.monotonic() - started, 0.6)
+        self.limiter.release()
+        self.limiter.acquire()
+
+
+class RateLimitWaitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.limiter = openrouter_api.AdaptiveConcurrencyLimiter(max_queue_wait=0.02)
+        self.pool = openrouter_api.APIKeyPool(["sk-or-v1-" + "c" * 40], requests_per_minute=600, tokens_per_minute=0)
+        for _ in range(600):
+            self.pool.acquire(wait=0)
+
+    def test_rate_wait_is_not_cut_by_the_admission_queue_wait(self):
+        key = self.limiter.acquire(credentials=self.pool)
+        self.assertIsInstance(key, openrouter_api.APIKey)
+        self.limiter.release()
+
+    def test_deadline_bounds_the_rate_wait(self):
+        with self.assertRaises(openrouter_api.DeadlineExceededError):
+            self.limiter.acquire(timeout=0.01, credentials=self.pool)
+        self.assertEqual(self.limiter.in_flight, 0)
+
+
+class TierSchedulerTest(unittest.TestCase):
+
+    def grant_order(self, callers, starvation_age=60.0):
+        """
+        Kolejność przydziału jedynego miejsca wywołującym (nazwa, user_tier, task_type) ustawionym w kolejce
+        """
+        limiter = openrouter_api.AdaptiveConcurrencyLimiter(initial_limit=1, max_limit=1,
+                                                            starvation_age=starvation_age)
+        limiter.acquire()
+        granted = []
+        threads = []
+        for name, user_tier, task_type in callers:
+            thread = threading.Thread(target=lambda *args: (limiter.acquire(5, *args[1:]), granted.append(args[0])),
+                                      args=(name, task_type, user_tier))
+            thread.start()
+            threads.append(thread)
+            while limiter.stats()["waiting"] < len(threads):
+                time.sleep(0.005)
+        for count in range(1, len(callers) + 1):
+            limiter.release()
+            while len(granted) < count:
+                time.sleep(0.005)
+        for thread in threads:
+            thread.join()
+        return granted
+
+    def test_premium_caller_overtakes_queued_free_callers(self):
+        order = self.grant_order([("free1", "free", "default"), ("free2", "free", "default"),
+                                  ("free3", "free", "default"), ("premium", "premium", "default")])
+        self.assertEqual(order, ["premium", "free1", "free2", "free3"])
+
+    def test_high_priority_task_goes_before_low_priority_one(self):
+        order = self.grant_order([("free1", "free", "default"), ("feedback", "free", "recruiter_feedback"),
+                                  ("cv", "free", "cv_optimization")])
+        self.assertLess(order.index("cv"), order.index("feedback"))
+
+    def test_starved_caller_is_served_every_other_grant(self):
+        callers = [("free", "free", "default")] + [(f"premium{i}", "premium", "default") for i in range(4)]
+        self.assertEqual(self.grant_order(callers)[-1], "free")
+        self.assertLessEqual(self.grant_order(callers, starvation_age=0.0).index("free"), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        openrouter_api.response_cache.clear()
+
+    def result(self, text):
+        return openrouter_api.CompletionResult(text=text, model="fake-model", finish_reason="stop")
+
+    def test_least_recently_used_entry_is_evicted_over_max_bytes(self):
+        cache = openrouter_api.ResponseCache(max_bytes=2 * (openrouter_api.ResponseCache.ENTRY_OVERHEAD + 10))
+        for key in ("a", "b"):
+            cache.put(key, self.result(key * 10), "default")
+        self.assertEqual(cache.get("a").text, "a" * 10)
+        cache.put("c", self.result("c" * 10), "default")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual([cache.get(key).text for key in ("a", "c")], ["a" * 10, "c" * 10])
+        self.assertEqual(cache.stats()["entries"], 2)
+
+    def test_entry_expires_after_task_type_ttl(self):
+        cache = openrouter_api.ResponseCache(ttls={"cover_letter": 0.05, "default": 60.0, "ocena": 0.0})
+        cache.put("krotki", self.result("list"), "cover_letter")
+        cache.put("dlugi", self.result("cv"), "default")
+        self.assertFalse(cache.put("wylaczony", self.result("ocena"), "ocena"))
+        time.sleep(0.1)
+        self.assertIsNone(cache.get("krotki"))
+        self.assertIsNone(cache.get("wylaczony"))
+        self.assertEqual(cache.get("dlugi").text, "cv")
+
+    def test_repeated_request_is_served_from_cache(self):
+        backend = openrouter_api.FakeBackend(["pierwsza", "druga"])
+        first = openrouter_api.send_api_request("oferta", backend=backend, detailed=True)
+        second = openrouter_api.send_api_request("oferta", backend=backend, detailed=True)
+        self.assertEqual((first.text, first.cache_status), ("pierwsza", "miss"))
+        self.assertEqual((second.text, second.cache_status), ("pierwsza", "hit"))
+        self.assertEqual((second.prompt_tokens, second.completion_tokens), (0, 0))
+        self.assertEqual(len(backend.requests), 1)
+
+    def test_cache_false_bypasses_lookup_and_refreshes_entry(self):
+        backend = openrouter_api.FakeBackend(["pierwsza", "druga"])
+        openrouter_api.send_api_request("oferta", backend=backend)
+        refreshed = openrouter_api.send_api_request("oferta", backend=backend, detailed=True, cache=False)
+        self.assertEqual((refreshed.text, refreshed.cache_status), ("druga", "bypass"))
+        self.assertEqual(openrouter_api.send_api_request("oferta", backend=backend), "druga")
+        self.assertEqual(len(backend.requests), 2)
+
+
+class SQLiteResponseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "odpowiedzi.db")
+
+    def result(self, text):
+        return openrouter_api.CompletionResult(text=text, model="fake-model", finish_reason="stop",
+                                               completion_tokens=3)
+
+    def test_entry_survives_new_cache_instance(self):
+        openrouter_api.ResponseCache(disk_cache=openrouter_api.SQLiteResponseCache(self.path)).put(
+            "klucz", self.result("zażółć gęślą jaźń"), "default")
+        cache = openrouter_api.ResponseCache(disk_cache=openrouter_api.SQLiteResponseCache(self.path))
+        result = cache.get("klucz")
+        self.assertEqual((result.text, result.model, result.completion_tokens), ("zażółć gęślą jaźń", "fake-model", 3))
+        self.assertEqual((cache.stats()["disk_hits"], cache.stats()["entries"]), (1, 1))
+        # Drugi odczyt trafia już w pierwszy poziom w pamięci
+        cache.get("klucz")
+        self.assertEqual((cache.stats()["hits"], cache.stats()["disk_hits"]), (1, 1))
+
+    def test_expired_entry_is_missed_and_removed_on_write(self):
+        disk = openrouter_api.SQLiteResponseCache(self.path)
+        disk.put("stary", self.result("stary"), 0.05)
+        time.sleep(0.1)
+        self.assertIsNone(disk.get("stary"))
+        disk.put("nowy", self.result("nowy"), 60.0)
+        self.assertEqual(disk.stats()["entries"], 1)
+        result, ttl = disk.get("nowy")
+        self.assertEqual(result.text, "nowy")
+        self.assertTrue(0 < ttl <= 60.0)
+
+    def test_reads_are_flushed_as_access_times_on_write(self):
+        disk = openrouter_api.SQLiteResponseCache(self.path, max_bytes=10 ** 6)
+        for key in ("a", "b"):
+            disk.put(key, self.result(key), 60.0)
+        disk.get("a")
+        self.assertIn("a", disk._touched)
+        # Odczyt nie pisze do bazy - czas użycia trafia tam dopiero przy zapisie
+        disk.put("c", self.result("c"), 60.0)
+        self.assertEqual(disk._touched, {})
+        order = [key for key, in disk._connection().execute("SELECT key FROM responses ORDER BY accessed_at")]
+        self.assertEqual(order, ["b", "a", "c"])
+        disk.max_bytes = disk.stats()["bytes"] - 1
+        disk.put("a", self.result("a"), 60.0)
+        self.assertIsNone(disk.get("b"))
+
+    def test_async_get_and_put_use_disk_cache(self):
+        async def scenario():
+            writer = openrouter_api.ResponseCache(disk_cache=openrouter_api.SQLiteResponseCache(self.path))
+            await writer.aput("klucz", self.result("asynchronicznie"), "default")
+            reader = openrouter_api.ResponseCache(disk_cache=openrouter_api.SQLiteResponseCache(self.path))
+            return await reader.aget("klucz"), await reader.aget("brak"), reader.stats()
+
+        result, missing, stats = asyncio.run(scenario())
+        self.assertEqual(result.text, "asynchronicznie")
+        self.assertIsNone(missing)
+        self.assertEqual((stats["disk_hits"], stats["misses"]), (1, 1))
+
+
+class StreamingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = openrouter_api.FakeBackend("Mocne strony kandydata")
+
+    def test_sse_decoder_joins_data_lines_and_skips_comments(self):
+        lines = [": OPENROUTER PROCESSING", "data: pierwsza", "data:druga\r", "", b"event: ping",
+                 "data: {\"a\": 1}", "", "data: [DONE]", "", "data: po końcu", ""]
+        self.assertEqual(list(openrouter_api._iter_sse_data(lines)), ["pierwsza\ndruga", "{\"a\": 1}"])
+
+    def test_sse_decoder_flushes_event_without_trailing_blank_line(self):
+        self.assertEqual(list(openrouter_api._iter_sse_data(["data: ostatnie"])), ["ostatnie"])
+
+    def test_stream_yields_deltas_and_summary(self):
+        stream = openrouter_api.send_api_request("cv", backend=self.backend, stream=True)
+        self.assertEqual(list(stream), ["Mocne", " strony", " kandydata"])
+        self.assertEqual((stream.text, stream.finish_reason), ("Mocne strony kandydata", "stop"))
+        self.assertGreater(stream.usage["completion_tokens"], 0)
+        self.assertTrue(self.backend.requests[0]["stream"])
+
+    def test_async_stream_yields_same_deltas(self):
+        async def scenario():
+            stream = await openrouter_api.async_send_api_request("cv", backend=self.backend, stream=True)
+            return [delta async for delta in stream], stream.text
+
+        deltas, text = asyncio.run(scenario())
+        self.assertEqual("".join(deltas), "Mocne strony kandydata")
+        self.assertEqual(text, "Mocne strony kandydata")